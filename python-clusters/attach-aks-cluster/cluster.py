@@ -1,9 +1,12 @@
-import os, logging, yaml
+import logging, yaml
 from dataiku.cluster import Cluster
 
 from azure.mgmt.containerservice import ContainerServiceClient
 from dku_utils.access import _is_none_or_blank
 from dku_utils.cluster import make_overrides
+from dku_utils.timing import Timer
+from dku_kube.kubeconfig import write_kube_config_fragment, remove_kube_config_fragment
+from dku_azure.clients import get_client
 from dku_azure.auth import get_credentials_from_connection_info, get_credentials_from_connection_infoV2
 from dku_azure.utils import run_and_process_cloud_error, get_instance_metadata, get_subscription_id
 
@@ -28,7 +31,18 @@ class MyCluster(Cluster):
         return credentials, subscription_id
         
     def start(self):
-        credentials, subscription_id = self._get_credentials()
+        timer = Timer("attach", cluster_id=self.cluster_id, cluster_name=self.cluster_name)
+        try:
+            overrides, data = self._start(timer)
+        except Exception:
+            timer.finish("failed")
+            raise
+        data["timings"] = timer.finish()
+        return [overrides, data]
+
+    def _start(self, timer):
+        with timer.span("credentials"):
+            credentials, subscription_id = self._get_credentials()
 
         # Cluster name
         cluster_name = self.config.get("cluster", None)
@@ -39,30 +53,32 @@ class MyCluster(Cluster):
         # Resource group
         resource_group = self.config.get('resourceGroup', None)
         if _is_none_or_blank(resource_group):
-            metadata = get_instance_metadata()
+            with timer.span("instance metadata"):
+                metadata = get_instance_metadata()
             resource_group = metadata["compute"]["resourceGroupName"]
             logging.info("Using same resource group as DSS: {}".format(resource_group))
 
-        clusters_client = ContainerServiceClient(credentials, subscription_id)
+        clusters_client = get_client(ContainerServiceClient, credentials, subscription_id)
 
         # Get kubeconfig 
         logging.info("Fetching kubeconfig for cluster %s in %s", cluster_name, resource_group)
         def do_fetch():
             return clusters_client.managed_clusters.list_cluster_admin_credentials(resource_group, cluster_name)
-        get_credentials_result = run_and_process_cloud_error(do_fetch)
-        kube_config_content = get_credentials_result.kubeconfigs[0].value.decode('utf8')
-        kube_config_path = os.path.join(os.getcwd(), 'kube_config')
-        with open(kube_config_path, 'w') as f:
-            f.write(kube_config_content)
+        with timer.span("kube config"):
+            get_credentials_result = run_and_process_cloud_error(do_fetch)
+            kube_config_content = get_credentials_result.kubeconfigs[0].value.decode('utf8')
+            kube_config_path = write_kube_config_fragment(self.cluster_id, kube_config_content)
         overrides = make_overrides(self.config, yaml.safe_load(kube_config_content), kube_config_path)
         
         # Get other cluster infos
         def do_inspect():
             return clusters_client.managed_clusters.get(resource_group, cluster_name)
-        get_cluster_result = run_and_process_cloud_error(do_inspect)
+        with timer.span("cluster inspection"):
+            get_cluster_result = run_and_process_cloud_error(do_inspect)
 
-        return [overrides, {'kube_config_path':kube_config_path, 'cluster':get_cluster_result.as_dict()}]
+        return overrides, {'kube_config_path':kube_config_path, 'cluster':get_cluster_result.as_dict()}
 
     def stop(self, data):
-        pass
+        # the cluster itself stays, only the admin credentials written on start go
+        remove_kube_config_fragment(self.cluster_id)
 
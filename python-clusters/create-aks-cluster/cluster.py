@@ -1,20 +1,30 @@
-import os, logging, yaml, time, uuid
+import json, logging, yaml, time, uuid
 from dataiku.cluster import Cluster
 
 from azure.mgmt.containerservice import ContainerServiceClient
 from azure.mgmt.compute import ComputeManagementClient
 from azure.mgmt.msi import ManagedServiceIdentityClient
 from azure.mgmt.authorization import AuthorizationManagementClient
-from azure.core.pipeline.policies import UserAgentPolicy
 from azure.core.exceptions import ResourceNotFoundError, HttpResponseError
 
-from dku_utils.access import _is_none_or_blank
-from dku_utils.cluster import make_overrides
+from dku_utils.access import _is_none_or_blank, LazyJson
+from dku_utils.cluster import make_overrides, invalidate_cluster_snapshot
 from dku_utils.taints import Toleration
+from dku_utils.concurrency import run_concurrently_or_fail, TaskGraph
+from dku_utils.timing import Timer
 from dku_kube.nvidia_utils import add_gpu_driver_if_needed
+from dku_kube.kubeconfig import write_kube_config_fragment, remove_kube_config_fragment
+from dku_azure.clients import get_client, get_client_factory
 from dku_azure.auth import get_credentials_from_connection_info, get_credentials_from_connection_infoV2
-from dku_azure.clusters import ClusterBuilder
+from dku_azure.clusters import ClusterBuilder, format_cluster_plan
 from dku_azure.utils import run_and_process_cloud_error, get_instance_metadata, get_subscription_id
+from dku_azure.operations import wait_for_poller, wait_until
+from dku_azure.quotas import get_vcpus_quota_issues
+from dku_azure.skus import get_sku_catalog_or_none
+
+PREFLIGHT_MAX_WORKERS = 5
+POST_CREATION_MAX_WORKERS = 4
+DEFAULT_STOP_TIMEOUT_MINUTES = 60
 
 class MyCluster(Cluster):
     def __init__(self, cluster_id, cluster_name, config, plugin_config):
@@ -37,14 +47,126 @@ class MyCluster(Cluster):
             subscription_id = get_subscription_id(connection_info_v2)
         return credentials, subscription_id, managed_identity_id
 
+    def _delete_role_assignment(self, credentials, attachment, resource_label):
+        authorization_client = get_client(AuthorizationManagementClient, credentials, attachment["subscription_id"])
+        try:
+            authorization_client.role_assignments.delete_by_id(attachment["role_assignment"]["id"])
+        except ResourceNotFoundError:
+            logging.warn("It looks that the %s role assignment doesnt exist. Ignore this step", resource_label)
+
+    def _check_cluster_does_not_exist(self, clusters_client, resource_group):
+        try:
+            existing = clusters_client.managed_clusters.get(resource_group, self.cluster_name)
+            if existing is not None:
+                raise Exception("A cluster with name %s in resource group %s already exists" % (self.cluster_name, resource_group))
+        except ResourceNotFoundError:
+            logging.info("Cluster doesn't seem to exist yet")
+
+    def _get_dss_host_identity(self, credentials, subscription_id, metadata, managed_identity_id):
+        vm_resource_group = metadata["compute"]["resourceGroupName"]
+        vm_name = metadata["compute"]["name"]
+        compute_client = get_client(ComputeManagementClient, credentials, subscription_id)
+        vm = compute_client.virtual_machines.get(vm_resource_group, vm_name)
+        # No choice here but to use the first one
+        if managed_identity_id is None:
+            managed_identity_id = next(iter(vm.identity.user_assigned_identities.keys()))
+        for managed_identity_resource_id, managed_identity_properties in vm.identity.user_assigned_identities.items():
+            if managed_identity_id == managed_identity_resource_id or managed_identity_id == managed_identity_properties.client_id:
+                break
+        return managed_identity_resource_id, managed_identity_properties
+
+    def _get_user_assigned_identity(self, credentials, identity_resource_id):
+        _,_,mi_subscription_id,_,mi_resource_group,_,_,_,mi_name = identity_resource_id.split("/")
+        msiclient = get_client(ManagedServiceIdentityClient, credentials, mi_subscription_id)
+        return msiclient.user_assigned_identities.get(mi_resource_group, mi_name)
+
+    def _get_node_pools_vnet_id(self, cluster_builder, connection_info, credentials, subscription_id, resource_group, dss_host_resource_group):
+        node_pool_vnets = set()
+        for idx, node_pool_conf in enumerate(self.config.get("nodePools", [])):
+            node_pool_builder = cluster_builder.get_node_pool_builder()
+            nodepool_vnet = node_pool_conf.get("vnet", None)
+            nodepool_subnet = node_pool_conf.get("subnet", None)
+            vnet, _ = node_pool_builder.resolve_network(inherit_from_host=node_pool_conf.get("useSameNetworkAsDSSHost"),
+                                           cluster_vnet=nodepool_vnet,
+                                           cluster_subnet=nodepool_subnet,
+                                           connection_info=connection_info,
+                                           credentials=credentials,
+                                           resource_group=resource_group,
+                                           dss_host_resource_group=dss_host_resource_group)
+            node_pool_vnets.add(vnet)
+            
+        if 1 < len(node_pool_vnets):
+            raise Exception("Node pools must all share the same vnet. Current node pools configuration yields vnets {}.".format(",".join(node_pool_vnets)))
+        elif 0 == len(node_pool_vnets):
+            raise Exception("You cannot deploy a cluster without any node pool.")
+        
+        vnet_id = node_pool_vnets.pop()
+        if not vnet_id.startswith("/"):
+            vnet_name = vnet_id
+            vnet_id = "/subscriptions/{subscription_id}/resourceGroups/{resource_group}/providers/Microsoft.Network/virtualNetworks/{vnet_name}".format(**locals())
+        return vnet_id
+
+    def _check_role_assignment_allowed(self, authorization_client, scope, role_name, resource_label, identity_label, plan_only=False):
+        """
+        Find the role on the scope and run a fake role assignment on it. Depending on the failure
+        type we know if we are Owner or not. Return the role id.
+
+        In plan mode, only the role is looked up, the fake role assignment is a write.
+        """
+        try:
+            roles = list(authorization_client.role_definitions.list(scope, "roleName eq '{}'".format(role_name)))
+        except ResourceNotFoundError:
+            raise Exception("{} {} not found. Check it exists and you are Owner of it.".format(resource_label, scope))
+        if 0 == len(roles):
+            raise Exception("Could not find the {} role on the {} {}. Check you are Owner of it.".format(role_name, resource_label, scope))
+        role_id = roles[0].id
+        logging.info("%s %s role id: %s", resource_label, role_name, role_id)
+        if plan_only:
+            return role_id
+
+        try:
+            authorization_client.role_assignments.create(
+                scope=scope,
+                role_assignment_name=str(uuid.uuid4()),
+                parameters= {
+                    "properties": {
+                        "role_definition_id": role_id,
+                        "principal_id": "00000000-0000-0000-0000-000000000000",
+                    },
+                },
+            )
+        except HttpResponseError as e:
+            if e.reason == "Forbidden" and "AuthorizationFailed" in str(e.error):
+                raise Exception("Cannot create role assignments on {} {}. Check that your are Owner of it or provide an existing {} identity.".format(resource_label, scope, identity_label))
+            elif e.reason == "Bad Request" and "PrincipalNotFound" in str(e.error):
+                logging.info("Fake role assignment on %s looks ok. Identity should be allowed to assign roles in further steps.", resource_label)
+            else:
+                raise(e)
+        return role_id
+
     def start(self):
+        timer = Timer("start", cluster_id=self.cluster_id, cluster_name=self.cluster_name)
+        try:
+            overrides, data = self._start(timer)
+        except Exception:
+            timer.finish("failed")
+            raise
+        data["timings"] = timer.finish()
+        return [overrides, data]
+
+    def _start(self, timer):
         """
         Build the create cluster request.
         """
-        credentials, subscription_id, managed_identity_id = self._get_credentials()
+        with timer.span("credentials"):
+            credentials, subscription_id, managed_identity_id = self._get_credentials()
+        plan_only = self.config.get("planOnly", False)
+        if plan_only:
+            logging.info("Plan mode, the cluster will not be created")
 
         # Fetch metadata about the instance
-        metadata = get_instance_metadata()
+        with timer.span("instance metadata"):
+            metadata = get_instance_metadata()
 
         # Resource group
         resource_group = self.config.get('resourceGroup', None)
@@ -65,28 +187,9 @@ class MyCluster(Cluster):
         if _is_none_or_blank(location):
             raise Exception("A location to put the cluster in is required")
 
-        # AKS Client
-        clusters_client = None
-
-        # Credit the cluster to DATAIKU
-        if os.environ.get("DISABLE_AZURE_USAGE_ATTRIBUTION", "0") == "1":
-            logging.info("Azure usage attribution is disabled")
-            clusters_client = ContainerServiceClient(credentials, subscription_id)
-        else:
-            policy = UserAgentPolicy()
-            policy.add_user_agent('pid-fd3813c7-273c-5eec-9221-77323f62a148')
-            clusters_client = ContainerServiceClient(credentials, subscription_id, user_agent_policy=policy)
-            
-        rest_api_version = clusters_client._get_api_version(clusters_client.managed_clusters)
-
-        # check that the cluster doesn't exist yet, otherwise azure will try to update it
-        # and will almost always fail
-        try:
-            existing = clusters_client.managed_clusters.get(resource_group, self.cluster_name)
-            if existing is not None:
-                raise Exception("A cluster with name %s in resource group %s already exists" % (self.cluster_name, resource_group))
-        except ResourceNotFoundError:
-            logging.info("Cluster doesn't seem to exist yet")
+        # AKS Client (the factory credits the cluster to DATAIKU unless disabled)
+        clusters_client = get_client(ContainerServiceClient, credentials, subscription_id)
+        rest_api_version = get_client_factory().get_api_version(clusters_client, clusters_client.managed_clusters)
 
         cluster_builder = ClusterBuilder(clusters_client)
         cluster_builder.with_name(self.cluster_name)
@@ -124,12 +227,24 @@ class MyCluster(Cluster):
         if self.config.get("useCustomNodeResourceGroup", False):
             cluster_builder.with_node_resource_group(self.config.get("nodeResourceGroup"))
 
+        # Pre-flight checks are independent ARM round trips, run them all at once
+        preflight_checks = {}
+
+        # check that the cluster doesn't exist yet, otherwise azure will try to update it
+        # and will almost always fail
+        preflight_checks["existing cluster"] = lambda: self._check_cluster_does_not_exist(clusters_client, resource_group)
+
+        # VM sizes of the region, to check the node pools sizes and zones
+        compute_client = get_client(ComputeManagementClient, credentials, subscription_id)
+        preflight_checks["VM sizes"] = lambda: get_sku_catalog_or_none(compute_client, subscription_id, location)
+
         # Cluster identity
         connection_info = self.config.get("connectionInfo", None)
         cluster_idendity_legacy_use_distinct_sp = self.config.get("useDistinctSPForCluster", False)
         cluster_idendity_legacy_sp = self.config.get("clusterServicePrincipal", None)
         cluster_identity_type = None
         cluster_identity = None
+        kubelet_mi = None
         if not _is_none_or_blank(connection_info) or cluster_idendity_legacy_use_distinct_sp:
             logging.warn("Using legacy options to configure cluster identity. Clear them to use the new ones.")
             if not cluster_idendity_legacy_use_distinct_sp and not _is_none_or_blank(connection_info):
@@ -145,21 +260,7 @@ class MyCluster(Cluster):
             if cluster_identity_type == "managed-identity":
                 if cluster_identity.get("inheritDSSIdentity",True):
                     logging.info("Need to inspect Managed Identity infos from Azure")
-                    if metadata is None:
-                        metadata = get_instance_metadata()
-                    vm_resource_group = metadata["compute"]["resourceGroupName"]
-                    vm_name = metadata["compute"]["name"]
-                    compute_client = ComputeManagementClient(credentials, subscription_id)
-                    vm = compute_client.virtual_machines.get(vm_resource_group, vm_name)
-                    # No choice here but to use the first one
-                    if managed_identity_id is None:
-                        managed_identity_id = next(iter(vm.identity.user_assigned_identities.keys()))
-                    for managed_identity_resource_id, managed_identity_properties in vm.identity.user_assigned_identities.items():
-                        if managed_identity_id == managed_identity_resource_id or managed_identity_id == managed_identity_properties.client_id:
-                            break
-                    logging.info("Found managed identity id {}".format(managed_identity_resource_id))
-                    cluster_builder.with_managed_identity(managed_identity_resource_id)
-                    cluster_builder.with_kubelet_identity(managed_identity_resource_id, managed_identity_properties.client_id, managed_identity_properties.principal_id)     
+                    preflight_checks["DSS identity"] = lambda: self._get_dss_host_identity(credentials, subscription_id, metadata, managed_identity_id)
                 else:
                     control_plane_mi = None if cluster_identity.get("useAKSManagedIdentity",True) else cluster_identity["controlPlaneUserAssignedIdentity"]
                     cluster_builder.with_managed_identity(control_plane_mi)
@@ -169,11 +270,7 @@ class MyCluster(Cluster):
                         logging.info("Configure cluster with user assigned identity: {}".format(control_plane_mi))
                     if not cluster_identity.get("useAKSManagedKubeletIdentity",True):
                         kubelet_mi = cluster_identity["kubeletUserAssignedIdentity"]
-                        _,_,mi_subscription_id,_,mi_resource_group,_,_,_,mi_name = kubelet_mi.split("/")
-                        msiclient = ManagedServiceIdentityClient(credentials, mi_subscription_id)
-                        mi = msiclient.user_assigned_identities.get(mi_resource_group, mi_name)
-                        cluster_builder.with_kubelet_identity(kubelet_mi, mi.client_id, mi.principal_id)
-                        logging.info("Configure kubelet identity with user assigned identity resourceId=\"{}\", clientId=\"{}\", objectId=\"{}\"".format(kubelet_mi, mi.client_id, mi.principal_id))
+                        preflight_checks["kubelet identity"] = lambda: self._get_user_assigned_identity(credentials, kubelet_mi)
             elif cluster_identity_type == "service-principal":
                 cluster_builder.with_cluster_sp(cluster_identity["clientId"], cluster_identity["password"])
                 logging.info("Configure cluster with service principal")
@@ -182,8 +279,7 @@ class MyCluster(Cluster):
 
 
         # Fail fast for non existing ACRs to avoid drama in case of failure AFTER cluster is created
-        acr_role_id = None
-        authorization_client = None
+        acr_authorization_client = None
         if cluster_identity_type is not None and cluster_identity is not None:
             if cluster_identity_type == "managed-identity" and cluster_identity.get("useAKSManagedKubeletIdentity",True) and not cluster_identity.get("inheritDSSIdentity", True):
                 acr_name = cluster_identity.get("attachToACRName", None)
@@ -197,99 +293,42 @@ class MyCluster(Cluster):
                     elif 2 == len(acr_identifier_splitted):
                         acr_resource_group, acr_name = acr_identifier_splitted
                         
-                    authorization_client = AuthorizationManagementClient(credentials, acr_subscription_id)
+                    acr_authorization_client = get_client(AuthorizationManagementClient, credentials, acr_subscription_id)
                     acr_scope = "/subscriptions/{acr_subscription_id}/resourceGroups/{acr_resource_group}/providers/Microsoft.ContainerRegistry/registries/{acr_name}".format(**locals())
-                    try:
-                        acr_roles = list(authorization_client.role_definitions.list(acr_scope,"roleName eq 'AcrPull'"))
-                    except ResourceNotFoundError:
-                        raise Exception("ACR {} not found. Check it exists and you are Owner of it.".format(acr_scope))
-                    if 0 == len(acr_roles):
-                        raise Exception("Could not find the AcrPull role on the ACR {}. Check you are Owner of it.".format(acr_scope))
-                    else:
-                        acr_role_id = acr_roles[0].id
-                        logging.info("ACR pull role id: %s", acr_role_id)
-                        
-                    # Try to run a fake role assignment. Depending on the failure type we know if we are Owner or not
-                    try:
-                        fake_role_assignment = authorization_client.role_assignments.create(
-                            scope=acr_scope,
-                            role_assignment_name=str(uuid.uuid4()),
-                            parameters= {
-                                "properties": {
-                                    "role_definition_id": acr_role_id,
-                                    "principal_id": "00000000-0000-0000-0000-000000000000",
-                                },
-                            },
-                        )
-                    except HttpResponseError as e:
-                        if e.reason == "Forbidden" and "AuthorizationFailed" in str(e.error):
-                            raise Exception("Cannot create role assignments on ACR {}. Check that your are Owner of it or provide an existing Kubelet identity.".format(acr_scope))
-                        elif e.reason == "Bad Request" and "PrincipalNotFound" in str(e.error):
-                            logging.info("Fake role assignment on ACR looks ok. Identity should be allowed to assign roles in further steps.")
-                        else:
-                            raise(e)
-                    except Exception as e:
-                        raise(e)
-                        
-        # Sanity check for node pools
-        node_pool_vnets = set()
-        for idx, node_pool_conf in enumerate(self.config.get("nodePools", [])):
-            node_pool_builder = cluster_builder.get_node_pool_builder()
-            nodepool_vnet = node_pool_conf.get("vnet", None)
-            nodepool_subnet = node_pool_conf.get("subnet", None)
-            vnet, _ = node_pool_builder.resolve_network(inherit_from_host=node_pool_conf.get("useSameNetworkAsDSSHost"),
-                                           cluster_vnet=nodepool_vnet,
-                                           cluster_subnet=nodepool_subnet,
-                                           connection_info=connection_info,
-                                           credentials=credentials,
-                                           resource_group=resource_group,
-                                           dss_host_resource_group=dss_host_resource_group)
-            node_pool_vnets.add(vnet)
-            
-        if 1 < len(node_pool_vnets):
-            raise Exception("Node pools must all share the same vnet. Current node pools configuration yields vnets {}.".format(",".join(node_pool_vnets)))
-        elif 0 == len(node_pool_vnets):
-            raise Exception("You cannot deploy a cluster without any node pool.")
-        
-        # Check role assignments for vnet like on ACR for fail fast if not doable
-        vnet_id = node_pool_vnets.pop()
-        if not vnet_id.startswith("/"):
-            vnet_name = vnet_id
-            vnet_id = "/subscriptions/{subscription_id}/resourceGroups/{resource_group}/providers/Microsoft.Network/virtualNetworks/{vnet_name}".format(**locals())
-        vnet_role_id = None
+                    preflight_checks["ACR attachment"] = lambda: self._check_role_assignment_allowed(acr_authorization_client, acr_scope, "AcrPull", "ACR", "Kubelet", plan_only)
+
+        # Sanity check for node pools, and role assignments for vnet like on ACR for fail fast if not doable
+        attach_to_vnet = False
+        vnet_authorization_client = None
         if cluster_identity_type is not None and cluster_identity is not None:
             if cluster_identity_type == "managed-identity" and cluster_identity.get("useAKSManagedIdentity",True) and not cluster_identity.get("inheritDSSIdentity", True):
-                authorization_client = AuthorizationManagementClient(credentials, subscription_id)
-                try:
-                    vnet_roles = list(authorization_client.role_definitions.list(vnet_id,"roleName eq 'Contributor'"))
-                except ResourceNotFoundError:
-                    raise Exception("Vnet {} not found. Check it exists and you are Owner of it.".format(vnet_id))
-                if 0 == len(vnet_roles):
-                    raise Exception("Could not find the Contributor role on the vnet {}. Check you are Owner of it.".format(vnet_id))
-                else:
-                    vnet_role_id = vnet_roles[0].id
-                    logging.info("Vnet contributor role id: %s", acr_role_id)              
-                    # Try to run a fake role assignment. Depending on the failure type we know if we are Owner or not
-                    try:
-                        fake_role_assignment = authorization_client.role_assignments.create(
-                            scope=vnet_id,
-                            role_assignment_name=str(uuid.uuid4()),
-                            parameters= {
-                                "properties": {
-                                    "role_definition_id": vnet_role_id,
-                                    "principal_id": "00000000-0000-0000-0000-000000000000",
-                                },
-                            },
-                        )
-                    except HttpResponseError as e:
-                        if e.reason == "Forbidden" and "AuthorizationFailed" in str(e.error):
-                            raise Exception("Cannot create role assignments on Vnet {}. Check that your are Owner of it or provide an existing Controle Plane identity.".format(vnet_id))
-                        elif e.reason == "Bad Request" and "PrincipalNotFound" in str(e.error):
-                            logging.info("Fake role assignment on Vnet looks ok. Identity should be allowed to assign roles in further steps.")
-                        else:
-                            raise(e)
-                    except Exception as e:
-                        raise(e)
+                attach_to_vnet = True
+                vnet_authorization_client = get_client(AuthorizationManagementClient, credentials, subscription_id)
+        def check_vnet():
+            vnet_id = self._get_node_pools_vnet_id(cluster_builder, connection_info, credentials, subscription_id, resource_group, dss_host_resource_group)
+            vnet_role_id = None
+            if attach_to_vnet:
+                vnet_role_id = self._check_role_assignment_allowed(vnet_authorization_client, vnet_id, "Contributor", "Vnet", "Controle Plane", plan_only)
+            return vnet_id, vnet_role_id
+        preflight_checks["node pools network"] = check_vnet
+
+        preflight_checks = {name: timer.wrap("pre-flight %s" % name, check) for name, check in preflight_checks.items()}
+        with timer.span("pre-flight checks"):
+            preflight_results = run_concurrently_or_fail(preflight_checks, "Pre-flight checks failed, cluster creation not started:", max_workers=PREFLIGHT_MAX_WORKERS)
+
+        if "DSS identity" in preflight_results:
+            managed_identity_resource_id, managed_identity_properties = preflight_results["DSS identity"]
+            logging.info("Found managed identity id {}".format(managed_identity_resource_id))
+            cluster_builder.with_managed_identity(managed_identity_resource_id)
+            cluster_builder.with_kubelet_identity(managed_identity_resource_id, managed_identity_properties.client_id, managed_identity_properties.principal_id)     
+        if "kubelet identity" in preflight_results:
+            mi = preflight_results["kubelet identity"]
+            cluster_builder.with_kubelet_identity(kubelet_mi, mi.client_id, mi.principal_id)
+            logging.info("Configure kubelet identity with user assigned identity resourceId=\"{}\", clientId=\"{}\", objectId=\"{}\"".format(kubelet_mi, mi.client_id, mi.principal_id))
+        acr_role_id = preflight_results.get("ACR attachment", None)
+        vnet_id, vnet_role_id = preflight_results["node pools network"]
+        sku_catalog = preflight_results["VM sizes"]
+        cluster_builder.with_sku_catalog(sku_catalog)
 
         # Access level
         if self.config.get("privateAccess"):
@@ -306,115 +345,158 @@ class MyCluster(Cluster):
         # Node pools
         install_gpu_driver = False
         gpu_node_pools_taints = set()
-        for idx, node_pool_conf in enumerate(self.config.get("nodePools", [])):
-            node_pool_builder = cluster_builder.get_node_pool_builder()
-            node_pool_builder.with_idx(idx)
-            node_pool_builder.with_vm_size(node_pool_conf.get("vmSize", None))
-            vnet = node_pool_conf.get("vnet", None)
-            subnet = node_pool_conf.get("subnet", None)
-            node_pool_builder.with_network(inherit_from_host=node_pool_conf.get("useSameNetworkAsDSSHost"),
-                                           cluster_vnet=vnet,
-                                           cluster_subnet=subnet,
-                                           connection_info=connection_info,
-                                           credentials=credentials,
-                                           resource_group=resource_group,
-                                           dss_host_resource_group=dss_host_resource_group)
-
-            node_pool_builder.with_availability_zones(
-                use_availability_zones=node_pool_conf.get("useAvailabilityZones", True))
-
-            node_pool_builder.with_node_count(enable_autoscaling=node_pool_conf.get("autoScaling", False),
-                                              num_nodes=node_pool_conf.get("numNodes", None),
-                                              min_num_nodes=node_pool_conf.get("minNumNodes", None),
-                                              max_num_nodes=node_pool_conf.get("maxNumNodes", None))
-
-            node_pool_builder.with_mode(mode=node_pool_conf.get("mode", "Automatic"),
-                                        system_pods_only=node_pool_conf.get("systemPodsOnly", True))
-
-            node_pool_builder.with_disk_size_gb(disk_size_gb=node_pool_conf.get("osDiskSizeGb", 0))
-            node_pool_builder.with_node_labels(node_pool_conf.get("labels", None))
-            node_pool_builder.with_node_taints(node_pool_conf.get("taints", None))
-            node_pool_builder.with_gpu(node_pool_conf.get("enableGPU", False))
-            if node_pool_conf.get("enableGPU", False) and node_pool_conf.get("taints", None):
-                gpu_node_pools_taints.update(
-                    Toleration.from_taints_config(node_pool_conf.get("taints", None))
-                )
-            install_gpu_driver |= node_pool_builder.gpu
-            node_pool_builder.add_tags(self.config.get("tags", None))
-            node_pool_builder.add_tags(node_pool_conf.get("tags", None))
-            node_pool_builder.build()
-            cluster_builder.with_node_pool(node_pool=node_pool_builder.agent_pool_profile)
-
+        with timer.span("node pools"):
+            for idx, node_pool_conf in enumerate(self.config.get("nodePools", [])):
+                node_pool_builder = cluster_builder.get_node_pool_builder()
+                node_pool_builder.with_idx(idx)
+                node_pool_builder.with_vm_size(node_pool_conf.get("vmSize", None))
+                vnet = node_pool_conf.get("vnet", None)
+                subnet = node_pool_conf.get("subnet", None)
+                node_pool_builder.with_network(inherit_from_host=node_pool_conf.get("useSameNetworkAsDSSHost"),
+                                               cluster_vnet=vnet,
+                                               cluster_subnet=subnet,
+                                               connection_info=connection_info,
+                                               credentials=credentials,
+                                               resource_group=resource_group,
+                                               dss_host_resource_group=dss_host_resource_group)
+
+                node_pool_builder.with_availability_zones(
+                    use_availability_zones=node_pool_conf.get("useAvailabilityZones", True))
+
+                node_pool_builder.with_node_count(enable_autoscaling=node_pool_conf.get("autoScaling", False),
+                                                  num_nodes=node_pool_conf.get("numNodes", None),
+                                                  min_num_nodes=node_pool_conf.get("minNumNodes", None),
+                                                  max_num_nodes=node_pool_conf.get("maxNumNodes", None))
+
+                node_pool_builder.with_mode(mode=node_pool_conf.get("mode", "Automatic"),
+                                            system_pods_only=node_pool_conf.get("systemPodsOnly", True))
+
+                node_pool_builder.with_disk_size_gb(disk_size_gb=node_pool_conf.get("osDiskSizeGb", 0))
+                node_pool_builder.with_node_labels(node_pool_conf.get("labels", None))
+                node_pool_builder.with_node_taints(node_pool_conf.get("taints", None))
+                node_pool_builder.with_gpu(node_pool_conf.get("enableGPU", False))
+                if node_pool_conf.get("enableGPU", False) and node_pool_conf.get("taints", None):
+                    gpu_node_pools_taints.update(
+                        Toleration.from_taints_config(node_pool_conf.get("taints", None))
+                    )
+                install_gpu_driver |= node_pool_builder.gpu
+                node_pool_builder.add_tags(self.config.get("tags", None))
+                node_pool_builder.add_tags(node_pool_conf.get("tags", None))
+                node_pool_builder.build()
+                cluster_builder.with_node_pool(node_pool=node_pool_builder.agent_pool_profile)
+
+        # fail before creating anything if the pools can't reach their max size
+        with timer.span("quota check"):
+            quota_issues = get_vcpus_quota_issues(compute_client, sku_catalog, [(node_pool, 0) for node_pool in cluster_builder.node_pools])
+
+        if plan_only:
+            summary, issues = cluster_builder.plan()
+            issues += quota_issues
+            summary["role_assignments"] = []
+            if acr_role_id is not None:
+                summary["role_assignments"].append({"role": "AcrPull", "identity": "kubelet", "scope": acr_scope})
+            if attach_to_vnet:
+                summary["role_assignments"].append({"role": "Contributor", "identity": "control plane", "scope": vnet_id})
+            summary["gpu_driver"] = install_gpu_driver
+            logging.info("Cluster plan: %s", LazyJson(summary))
+            raise Exception("Plan mode, cluster not created.\n%s" % format_cluster_plan(summary, issues))
+
+        if len(quota_issues) > 0:
+            raise Exception("Not enough vCPU quota, cluster creation not started:\n - %s" % "\n - ".join(quota_issues))
 
         # Run creation
         logging.info("Start creation of cluster")
         def do_creation():
             cluster_create_op = cluster_builder.build()
             return cluster_create_op.result()
-        create_result = run_and_process_cloud_error(do_creation)
+        with timer.span("cluster creation"):
+            create_result = run_and_process_cloud_error(do_creation)
+        invalidate_cluster_snapshot(create_result.id)
         logging.info("Cluster creation finished")
 
 
+        # Post-creation steps, only the GPU driver install depends on the kubeconfig
+        post_creation = TaskGraph(max_workers=POST_CREATION_MAX_WORKERS)
+
         # Attach to ACR
-        acr_attachment = {}
-        if cluster_identity_type is not None and cluster_identity is not None:
-            if cluster_identity_type == "managed-identity" and cluster_identity.get("useAKSManagedKubeletIdentity",True) and not cluster_identity.get("inheritDSSIdentity", True):
-                kubelet_mi_object_id = create_result.identity_profile.get("kubeletidentity").object_id
-                logging.info("Kubelet Managed Identity object id: %s", kubelet_mi_object_id)
-                if not _is_none_or_blank(acr_role_id):
-                    logging.info("Assign ACR pull role id %s to %s", acr_role_id, kubelet_mi_object_id)
-                    role_assignment = authorization_client.role_assignments.create(
-                        scope=acr_scope,
-                        role_assignment_name=str(uuid.uuid4()),
-                        parameters= {
-                            "properties": {
-                                "role_definition_id": acr_role_id,
-                                "principal_id": kubelet_mi_object_id,
+        def attach_to_acr():
+            acr_attachment = {}
+            if cluster_identity_type is not None and cluster_identity is not None:
+                if cluster_identity_type == "managed-identity" and cluster_identity.get("useAKSManagedKubeletIdentity",True) and not cluster_identity.get("inheritDSSIdentity", True):
+                    kubelet_mi_object_id = create_result.identity_profile.get("kubeletidentity").object_id
+                    logging.info("Kubelet Managed Identity object id: %s", kubelet_mi_object_id)
+                    if not _is_none_or_blank(acr_role_id):
+                        logging.info("Assign ACR pull role id %s to %s", acr_role_id, kubelet_mi_object_id)
+                        role_assignment = acr_authorization_client.role_assignments.create(
+                            scope=acr_scope,
+                            role_assignment_name=str(uuid.uuid4()),
+                            parameters= {
+                                "properties": {
+                                    "role_definition_id": acr_role_id,
+                                    "principal_id": kubelet_mi_object_id,
+                                },
                             },
-                        },
-                    )
-                    acr_attachment.update({
-                        "name": acr_name,
-                        "resource_group": acr_resource_group,
-                        "subscription_id": acr_subscription_id,
-                        "resource_id": acr_scope,
-                        "role_assignment": role_assignment.as_dict(),
-                    })
-                    
+                        )
+                        acr_attachment.update({
+                            "name": acr_name,
+                            "resource_group": acr_resource_group,
+                            "subscription_id": acr_subscription_id,
+                            "resource_id": acr_scope,
+                            "role_assignment": role_assignment.as_dict(),
+                        })
+            return acr_attachment
+        post_creation.add_task("acr_attachment", timer.wrap("ACR attachment", attach_to_acr))
+
         # Attach to VNET to allow LoadBalancers creation
-        vnet_attachment = {}
-        if cluster_identity_type is not None and cluster_identity is not None:
-            if cluster_identity_type == "managed-identity" and cluster_identity.get("useAKSManagedIdentity",True) and not cluster_identity.get("inheritDSSIdentity", True):
-                # And here we are blocked because we cant get the principal id of a System Assigned Managed Id easily
-                control_plane_object_id = create_result.identity.principal_id
-                logging.info("Controle Plane Managed Identity object id: %s", control_plane_object_id)
-                if not _is_none_or_blank(vnet_role_id):
-                    logging.info("Assign Vnet contributolr role id %s to %s", vnet_role_id, control_plane_object_id)
-                    vnet_role_assignment = authorization_client.role_assignments.create(
-                        scope=vnet_id,
-                        role_assignment_name=str(uuid.uuid4()),
-                        parameters= {
-                            "properties": {
-                                "role_definition_id": vnet_role_id,
-                                "principal_id": control_plane_object_id,
+        def attach_to_vnet():
+            vnet_attachment = {}
+            if cluster_identity_type is not None and cluster_identity is not None:
+                if cluster_identity_type == "managed-identity" and cluster_identity.get("useAKSManagedIdentity",True) and not cluster_identity.get("inheritDSSIdentity", True):
+                    # And here we are blocked because we cant get the principal id of a System Assigned Managed Id easily
+                    control_plane_object_id = create_result.identity.principal_id
+                    logging.info("Controle Plane Managed Identity object id: %s", control_plane_object_id)
+                    if not _is_none_or_blank(vnet_role_id):
+                        logging.info("Assign Vnet contributolr role id %s to %s", vnet_role_id, control_plane_object_id)
+                        vnet_role_assignment = vnet_authorization_client.role_assignments.create(
+                            scope=vnet_id,
+                            role_assignment_name=str(uuid.uuid4()),
+                            parameters= {
+                                "properties": {
+                                    "role_definition_id": vnet_role_id,
+                                    "principal_id": control_plane_object_id,
+                                },
                             },
-                        },
-                    )
-                    vnet_attachment.update({
-                        "subscription_id": subscription_id,
-                        "resource_id": vnet_id,
-                        "role_assignment": vnet_role_assignment.as_dict(),
-                    })
-
-        logging.info("Fetching kubeconfig for cluster {} in {}...".format(self.cluster_name, resource_group))
-        def do_fetch():
-            return clusters_client.managed_clusters.list_cluster_admin_credentials(resource_group, self.cluster_name)
-        get_credentials_result = run_and_process_cloud_error(do_fetch)
-        kube_config_content = get_credentials_result.kubeconfigs[0].value.decode("utf8")
-        logging.info("Writing kubeconfig file...")
-        kube_config_path = os.path.join(os.getcwd(), "kube_config")
-        with open(kube_config_path, 'w') as f:
-            f.write(kube_config_content)
+                        )
+                        vnet_attachment.update({
+                            "subscription_id": subscription_id,
+                            "resource_id": vnet_id,
+                            "role_assignment": vnet_role_assignment.as_dict(),
+                        })
+            return vnet_attachment
+        post_creation.add_task("vnet_attachment", timer.wrap("vnet attachment", attach_to_vnet))
+
+        def fetch_kube_config():
+            logging.info("Fetching kubeconfig for cluster {} in {}...".format(self.cluster_name, resource_group))
+            def do_fetch():
+                return clusters_client.managed_clusters.list_cluster_admin_credentials(resource_group, self.cluster_name)
+            get_credentials_result = run_and_process_cloud_error(do_fetch)
+            kube_config_content = get_credentials_result.kubeconfigs[0].value.decode("utf8")
+            kube_config_path = write_kube_config_fragment(self.cluster_id, kube_config_content)
+            return kube_config_path, kube_config_content
+        post_creation.add_task("kube_config", timer.wrap("kube config", fetch_kube_config))
+
+        if install_gpu_driver:
+            def install_gpu_driver_task():
+                kube_config_path, _ = post_creation.results["kube_config"]
+                gpu_driver_summary = add_gpu_driver_if_needed(kube_config_path, self.cluster_id, gpu_node_pools_taints)
+                logging.info("GPU driver: %s" % json.dumps(gpu_driver_summary))
+                return gpu_driver_summary
+            post_creation.add_task("gpu_driver", timer.wrap("GPU driver", install_gpu_driver_task), depends_on=["kube_config"])
+
+        post_creation_results = post_creation.run("Cluster was created but some post-creation steps failed:")
+        acr_attachment = post_creation_results["acr_attachment"]
+        vnet_attachment = post_creation_results["vnet_attachment"]
+        kube_config_path, kube_config_content = post_creation_results["kube_config"]
 
         overrides = make_overrides(
                 self.config,
@@ -422,20 +504,33 @@ class MyCluster(Cluster):
                 kube_config_path,
                 acr_name = None if _is_none_or_blank(acr_attachment) else acr_attachment["name"],
         )
-        
-        if install_gpu_driver:
-            add_gpu_driver_if_needed(kube_config_path, self.cluster_id, gpu_node_pools_taints)
 
-        return [overrides, {"kube_config_path": kube_config_path, "cluster": create_result.as_dict(), "acr_attachment": acr_attachment, "vnet_attachment": vnet_attachment}]
+        get_client_factory().log_stats()
+
+        return overrides, {"kube_config_path": kube_config_path, "cluster": create_result.as_dict(), "acr_attachment": acr_attachment, "vnet_attachment": vnet_attachment, "gpu_driver": post_creation_results.get("gpu_driver", None)}
 
 
     def stop(self, data):
-        credentials, _ , _ = self._get_credentials()
+        timer = Timer("stop", cluster_id=self.cluster_id, cluster_name=self.cluster_name)
+        try:
+            self._stop(data, timer)
+        except Exception:
+            timer.finish("failed")
+            raise
+        timer.finish()
+
+    def _stop(self, data, timer):
+        with timer.span("credentials"):
+            credentials, _ , _ = self._get_credentials()
+        deadline = time.time() + 60 * (self.config.get("stopTimeoutMinutes", None) or DEFAULT_STOP_TIMEOUT_MINUTES)
 
         # Do NOT use the conf but the actual values from the cluster here
         cluster_resource_id = data["cluster"]["id"]
         _,_,subscription_id,_,resource_group,_,_,_,cluster_name = cluster_resource_id.split("/")
-        clusters_client = ContainerServiceClient(credentials, subscription_id)
+        clusters_client = get_client(ContainerServiceClient, credentials, subscription_id)
+
+        # Role assignments are independent, detach them all at once
+        detach_tasks = {}
 
         # Try to detach from ACR if required. It is not mandatory but if not done, it would pollute
         # the ACR with multiple invalid role attachments and consume attachment quotas
@@ -449,11 +544,7 @@ class MyCluster(Cluster):
                 _,_,mi_subscription_id,_,mi_resource_group,_,_,_,mi_name = kubelet_mi_resource_id.split("/")
                 if mi_resource_group == node_resource_group:
                     logging.info("Cluster has an AKS managed kubelet identity, try to detach")
-                    authorization_client = AuthorizationManagementClient(credentials, acr_attachment["subscription_id"])
-                    try:
-                        authorization_client.role_assignments.delete_by_id(acr_attachment["role_assignment"]["id"])
-                    except ResourceNotFoundError:
-                        logging.warn("It looks that the ACR role assignment doesnt exist. Ignore this step")
+                    detach_tasks["ACR detachment"] = timer.wrap("ACR detachment", lambda: self._delete_role_assignment(credentials, acr_attachment, "ACR"))
         
         # Detach Vnet like ACR
         vnet_attachment = data.get("vnet_attachment", None)
@@ -461,26 +552,32 @@ class MyCluster(Cluster):
             logging.info("Cluster has an Vnet attachment, check managed identity")
             if "role_assignment" in vnet_attachment:
                 logging.info("Cluster has an AKS managed kubelet identity, try to detach")
-                authorization_client = AuthorizationManagementClient(credentials, vnet_attachment["subscription_id"])
-                try:
-                    authorization_client.role_assignments.delete_by_id(vnet_attachment["role_assignment"]["id"])
-                except ResourceNotFoundError:
-                    logging.warn("It looks that the Vnet role assignment doesnt exist. Ignore this step")
+                detach_tasks["Vnet detachment"] = timer.wrap("vnet detachment", lambda: self._delete_role_assignment(credentials, vnet_attachment, "Vnet"))
+
+        with timer.span("role assignments detachment"):
+            run_concurrently_or_fail(detach_tasks, "Failed to detach the cluster identities:")
 
         def do_delete():
-            future = clusters_client.managed_clusters.begin_delete(resource_group, cluster_name)
-            return future.result()
-        run_and_process_cloud_error(do_delete)
-
-        # delete returns void, so we poll until the cluster is really gone
-        gone = False
-        while not gone:
-            time.sleep(5)
+            poller = clusters_client.managed_clusters.begin_delete(resource_group, cluster_name)
+            invalidate_cluster_snapshot(cluster_resource_id)
+            return wait_for_poller(poller, deadline, "Deletion of cluster %s" % cluster_name)
+        with timer.span("cluster deletion"):
+            run_and_process_cloud_error(do_delete)
+
+        # make sure the cluster is really gone
+        def is_gone():
             try:
                 cluster = clusters_client.managed_clusters.get(resource_group, cluster_name)
-                if cluster.provisioning_state.lower() != 'deleting':
-                    logging.info("Cluster is not deleting anymore, must be deleted now (state = %s)" % cluster.provisioning_state)
             # other exceptions should not be ignored
             except ResourceNotFoundError:
                 logging.info("Cluster doesn't seem to exist anymore, considering it deleted")
-                gone = True
+                return True
+            provisioning_state = (cluster.provisioning_state or '').lower()
+            if provisioning_state == 'deleting':
+                return None
+            raise Exception("Cluster %s is not deleting anymore but still exists (state = %s)" % (cluster_name, cluster.provisioning_state))
+        with timer.span("deletion check"):
+            wait_until(is_gone, deadline, "cluster %s to disappear" % cluster_name)
+        remove_kube_config_fragment(self.cluster_id)
+
+        get_client_factory().log_stats()
@@ -1,7 +1,28 @@
+import hashlib, threading
+
 from azure.identity import DefaultAzureCredential, ManagedIdentityCredential, ClientSecretCredential
 
 from dku_utils.access import _is_none_or_blank
 
+# credentials memoized by identity settings, so that their tokens and the clients built on them are reused
+_credentials = {}
+_credentials_lock = threading.Lock()
+
+
+def _get_or_create_credentials(key, create):
+    with _credentials_lock:
+        credentials = _credentials.get(key, None)
+        if credentials is None:
+            credentials = create()
+            _credentials[key] = credentials
+        return credentials
+
+
+def _secret_digest(secret):
+    # don't keep the secret itself as a key
+    return hashlib.sha256((secret or '').encode("utf8")).hexdigest()
+
+
 def get_credentials_from_connection_info(connection_info, connection_info_secret):
     client_id = connection_info.get('clientId', None)
     tenant_id = connection_info.get('tenantId', None)
@@ -9,8 +30,8 @@ def get_credentials_from_connection_info(connection_info, connection_info_secret
     if _is_none_or_blank(client_id) or _is_none_or_blank(password) or _is_none_or_blank(tenant_id):
         raise Exception('Client, password and tenant must all be defined')
 
-    credentials = ClientSecretCredential(tenant_id, client_id, password)
-    return credentials
+    key = ("service-principal", tenant_id, client_id, _secret_digest(password))
+    return _get_or_create_credentials(key, lambda: ClientSecretCredential(tenant_id, client_id, password))
 
 
 def get_credentials_from_connection_infoV2(connection_infos):
@@ -18,18 +39,21 @@ def get_credentials_from_connection_infoV2(connection_infos):
     identity_type = infos.get('identityType','default')
     managed_identity_id = None
     if identity_type == 'default':
-        credentials = DefaultAzureCredential()
+        credentials = _get_or_create_credentials(("default",), DefaultAzureCredential)
     elif identity_type == 'user-assigned':
         managed_identity_id = infos.get('userManagedIdentityId')
         if managed_identity_id.startswith("/"):
-            credentials = ManagedIdentityCredential(identity_config={'msi_res_id': managed_identity_id})
+            credentials = _get_or_create_credentials(("user-assigned", managed_identity_id),
+                                                     lambda: ManagedIdentityCredential(identity_config={'msi_res_id': managed_identity_id}))
         else:
-            credentials = ManagedIdentityCredential(client_id=managed_identity_id)
+            credentials = _get_or_create_credentials(("user-assigned", managed_identity_id),
+                                                     lambda: ManagedIdentityCredential(client_id=managed_identity_id))
     elif identity_type == 'service-principal':
         client_id = infos.get('clientId', None)
         password = infos.get('password', None)
         tenant_id = infos.get('tenantId', None)
-        credentials = ClientSecretCredential(tenant_id, client_id, password)
+        key = ("service-principal", tenant_id, client_id, _secret_digest(password))
+        credentials = _get_or_create_credentials(key, lambda: ClientSecretCredential(tenant_id, client_id, password))
     else:
         raise Exception("Identity type {} is unknown and cannot be used".format(identity_type))
 
@@ -0,0 +1,118 @@
+import os, logging, threading
+from collections import OrderedDict
+import requests
+from requests.adapters import HTTPAdapter
+
+from azure.core.pipeline.policies import UserAgentPolicy
+from azure.core.pipeline.transport import RequestsTransport
+
+DATAIKU_USAGE_ATTRIBUTION = 'pid-fd3813c7-273c-5eec-9221-77323f62a148'
+POOL_CONNECTIONS = 10
+POOL_MAXSIZE = 32
+MAX_CLIENTS = 64 # least recently used clients are dropped past this
+
+
+class AzureClientFactory(object):
+    """
+    Hand out Azure management clients keyed by (client class, credentials, subscription, client options).
+
+    Credentials are memoized by identity settings in dku_azure.auth, so the same identity gives the
+    same credentials object, and thus the same clients.
+
+    All the clients share one pooled HTTP transport and one user agent policy, so that
+    TLS connections and tokens are reused across the SDK clients of an operation.
+    """
+
+    def __init__(self, usage_attribution=None, pool_connections=POOL_CONNECTIONS, pool_maxsize=POOL_MAXSIZE, max_clients=MAX_CLIENTS):
+        if usage_attribution is None:
+            usage_attribution = os.environ.get("DISABLE_AZURE_USAGE_ATTRIBUTION", "0") != "1"
+        self.user_agent_policy = UserAgentPolicy()
+        if usage_attribution:
+            # Credit the resources to DATAIKU
+            self.user_agent_policy.add_user_agent(DATAIKU_USAGE_ATTRIBUTION)
+        else:
+            logging.info("Azure usage attribution is disabled")
+        self.session = requests.Session()
+        self.adapter = HTTPAdapter(pool_connections=pool_connections, pool_maxsize=pool_maxsize)
+        self.session.mount("https://", self.adapter)
+        self.transport = RequestsTransport(session=self.session, session_owner=False)
+        self.clients = OrderedDict()
+        self.max_clients = max_clients
+        self.api_versions = {}
+        self.clients_created = 0
+        self.clients_reused = 0
+        self.lock = threading.Lock()
+
+    def get_client(self, client_class, credentials, subscription_id, **kwargs):
+        key = (client_class, id(credentials), subscription_id, tuple(sorted(kwargs.items())))
+        with self.lock:
+            entry = self.clients.get(key, None)
+            if entry is not None:
+                self.clients_reused += 1
+                self.clients.move_to_end(key)
+                return entry[1]
+            logging.info("Creating %s for subscription %s" % (client_class.__name__, subscription_id))
+            client = client_class(credentials, subscription_id,
+                                  transport=self.transport,
+                                  user_agent_policy=self.user_agent_policy,
+                                  **kwargs)
+            # keep a reference on the credentials so that their id() is not recycled
+            self.clients[key] = (credentials, client)
+            self.clients_created += 1
+            while len(self.clients) > self.max_clients:
+                _, (_, evicted_client) = self.clients.popitem(last=False)
+                # its id() can be recycled by a new client
+                for api_version_key in [k for k in self.api_versions if k[0] == id(evicted_client)]:
+                    del self.api_versions[api_version_key]
+            return client
+
+    def get_api_version(self, client, operation_group):
+        """
+        Resolve the REST api version used by an operation group, once per client.
+        """
+        key = (id(client), type(operation_group).__name__)
+        with self.lock:
+            if key not in self.api_versions:
+                self.api_versions[key] = client._get_api_version(operation_group)
+            return self.api_versions[key]
+
+    def get_stats(self):
+        """
+        Counters about client and connection reuse.
+        """
+        connections, requests_sent = 0, 0
+        pools = self.adapter.poolmanager.pools
+        for pool_key in list(pools.keys()):
+            pool = pools.get(pool_key)
+            if pool is None:
+                continue
+            connections += getattr(pool, "num_connections", 0)
+            requests_sent += getattr(pool, "num_requests", 0)
+        with self.lock:
+            return {
+                "clients_created": self.clients_created,
+                "clients_reused": self.clients_reused,
+                "connections_opened": connections,
+                "requests_sent": requests_sent,
+                "connections_reused": max(0, requests_sent - connections),
+            }
+
+    def log_stats(self):
+        logging.info("Azure clients usage: %s" % self.get_stats())
+
+
+_default_factory = None
+_default_factory_lock = threading.Lock()
+
+def get_client_factory():
+    """
+    Return the process-wide client factory.
+    """
+    global _default_factory
+    with _default_factory_lock:
+        if _default_factory is None:
+            _default_factory = AzureClientFactory()
+        return _default_factory
+
+def get_client(client_class, credentials, subscription_id, **kwargs):
+    return get_client_factory().get_client(client_class, credentials, subscription_id, **kwargs)
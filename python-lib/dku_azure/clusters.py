@@ -2,9 +2,45 @@ from dku_azure.utils import get_host_network, get_subnet_id
 from azure.mgmt.containerservice.models import ManagedClusterAgentPoolProfile, ManagedClusterAPIServerAccessProfile, ManagedClusterServicePrincipalProfile
 from azure.mgmt.containerservice.models import ContainerServiceNetworkProfile, ManagedClusterAutoUpgradeProfile, ManagedCluster
 from azure.mgmt.containerservice.models import AgentPool
-from dku_utils.access import _default_if_blank, _merge_objects, _print_as_json
+from dku_utils.access import _default_if_blank, _merge_objects, LazyJson
 
-import logging, json
+import logging, json, re, ipaddress
+
+AGENT_POOL_NAME_PATTERN = re.compile(r'^[a-z][a-z0-9]{0,11}$')
+UPGRADE_CHANNELS = ['none', 'patch', 'stable', 'rapid', 'node-image']
+NODE_OS_UPGRADE_CHANNELS = ['None', 'Unmanaged', 'SecurityPatch', 'NodeImage']
+DEFAULT_AVAILABILITY_ZONES = ["1", "2", "3"] # when the VM sizes of the region aren't known
+
+
+class NetworkResolutionCache(object):
+    """
+    Memoize the (vnet, subnet id) resolution of node pools, so that each distinct network
+    is resolved once per operation, whatever the number of node pools using it.
+    """
+
+    def __init__(self):
+        self.resolved = {}
+
+    def resolve(self, inherit_from_host, cluster_vnet, cluster_subnet, connection_info, credentials, resource_group, dss_host_resource_group):
+        inherit_from_host = bool(inherit_from_host)
+        if inherit_from_host:
+            key = (inherit_from_host, None, None, dss_host_resource_group)
+        else:
+            key = (inherit_from_host, cluster_vnet, cluster_subnet, resource_group)
+        if key not in self.resolved:
+            if inherit_from_host:
+                logging.info("Inheriting VNET/subnet from DSS host")
+                vnet, subnet_id = get_host_network(credentials=credentials,
+                                                   resource_group=dss_host_resource_group,
+                                                   connection_info=connection_info)
+            else:
+                logging.info("Using custom VNET ({}) and subnet ({}) for cluster".format(cluster_vnet, cluster_subnet))
+                vnet = cluster_vnet
+                subnet_id = get_subnet_id(resource_group=resource_group, connection_info=connection_info, vnet=cluster_vnet, subnet=cluster_subnet)
+            self.resolved[key] = (vnet, subnet_id)
+        else:
+            logging.info("Reusing already resolved network for {}".format(key))
+        return self.resolved[key]
 
 
 class ClusterBuilder(object):
@@ -32,6 +68,8 @@ class ClusterBuilder(object):
         self.auto_upgrade_profile = None
         self.oidc_issuer = None
         self.workload_identity = None
+        self.network_cache = NetworkResolutionCache()
+        self.sku_catalog = None
 
     def with_name(self, name):
         self.name = name
@@ -48,6 +86,10 @@ class ClusterBuilder(object):
     def with_location(self, location):
         self.location = _default_if_blank(location, None)
 
+    def with_sku_catalog(self, sku_catalog):
+        self.sku_catalog = sku_catalog
+        return self
+
     def with_oidc_issuer(self, oidc_issuer):
         self.oidc_issuer = oidc_issuer
         return self
@@ -85,7 +127,7 @@ class ClusterBuilder(object):
             network_plugin = network_plugin,
             docker_bridge_cidr = docker_bridge_cidr
         )
-        logging.info("With network profile: %s", json.dumps(self.network_profile.as_dict()))
+        logging.info("With network profile: %s", LazyJson(self.network_profile))
         return self
 
     def with_node_resource_group(self, node_resource_group):
@@ -157,7 +199,10 @@ class ClusterBuilder(object):
         self.custom_config = _default_if_blank(custom_config, None)
         return self
 
-    def build(self):
+    def build_config(self):
+        """
+        The ManagedCluster to create, after merging the custom config.
+        """
         cluster_params = {}
         cluster_params["location"] = self.location
         cluster_params["dns_prefix"] = self.dns_prefix
@@ -187,19 +232,40 @@ class ClusterBuilder(object):
 
         self.cluster_config = ManagedCluster(**cluster_params)
 
-        logging.info("Cluster configuration:")
-        logging.info(_print_as_json(self.cluster_config))
+        logging.info("Cluster configuration: %s", LazyJson(self.cluster_config))
+        return self.cluster_config
 
+    def build(self):
+        self.build_config()
+        vm_size_issues = get_vm_size_issues(self.cluster_config, self.sku_catalog)
+        if len(vm_size_issues) > 0:
+            raise Exception("Invalid VM sizes, cluster creation not started:\n - %s" % "\n - ".join(vm_size_issues))
         future = self.clusters_client.managed_clusters.begin_create_or_update(self.resource_group, self.name, self.cluster_config)
         return future
 
+    def plan(self):
+        """
+        Build the final payload, custom config included, and check it locally. No call to Azure is made.
+
+        :return: a (summary, issues) pair, summary being a dict describing what would be created
+        """
+        cluster_config = self.build_config()
+        issues = validate_cluster_config(cluster_config) + get_vm_size_issues(cluster_config, self.sku_catalog)
+        return summarize_cluster_config(self.name, self.resource_group, cluster_config), issues
+
 
 class NodePoolBuilder(object):
     """
     """
 
-    def __init__(self, cluster_builder):
+    def __init__(self, cluster_builder, network_cache=None, sku_catalog=None):
         self.cluster_builder = cluster_builder
+        if network_cache is None:
+            network_cache = cluster_builder.network_cache if cluster_builder is not None else NetworkResolutionCache()
+        self.network_cache = network_cache
+        if sku_catalog is None and cluster_builder is not None:
+            sku_catalog = cluster_builder.sku_catalog
+        self.sku_catalog = sku_catalog
         self.name = None
         self.vm_size = None
         self.vnet = None
@@ -242,17 +308,7 @@ class NodePoolBuilder(object):
         return self
     
     def resolve_network(self, inherit_from_host, cluster_vnet, cluster_subnet, connection_info, credentials, resource_group, dss_host_resource_group):
-        vnet, subnet_id = None, None
-        if inherit_from_host:
-            logging.info("Inheriting VNET/subnet from DSS host")
-            vnet, subnet_id = get_host_network(credentials=credentials,
-                                                         resource_group=dss_host_resource_group,
-                                                         connection_info=connection_info)
-        else:
-            logging.info("Using custom VNET ({}) and subnet ({}) for cluster".format(cluster_vnet, cluster_subnet))
-            vnet = cluster_vnet
-            subnet_id = get_subnet_id(resource_group=resource_group, connection_info=connection_info, vnet=cluster_vnet, subnet=cluster_subnet)
-        return vnet, subnet_id
+        return self.network_cache.resolve(inherit_from_host, cluster_vnet, cluster_subnet, connection_info, credentials, resource_group, dss_host_resource_group)
 
     def with_network(self, inherit_from_host, cluster_vnet, cluster_subnet, connection_info, credentials, resource_group, dss_host_resource_group):
         self.vnet, self.subnet_id = self.resolve_network(inherit_from_host, cluster_vnet, cluster_subnet, connection_info, credentials, resource_group, dss_host_resource_group)
@@ -313,8 +369,18 @@ class NodePoolBuilder(object):
         agent_pool_profile_params["count"] = self.num_nodes
         agent_pool_profile_params["os_disk_size_gb"] = self.disk_size_gb
         agent_pool_profile_params["vnet_subnet_id"] = self.subnet_id
+        # in a cluster, the VM sizes are checked by the ClusterBuilder, so that a plan lists them with the other issues
+        if self.cluster_builder is None and self.sku_catalog is not None and self.vm_size is not None:
+            self.sku_catalog.check_vm_size(self.vm_size)
         if self.use_availability_zones:
-            agent_pool_profile_params["availability_zones"] = ["1", "2", "3"]
+            if self.sku_catalog is not None:
+                zones = self.sku_catalog.get_zones(self.vm_size)
+            else:
+                zones = DEFAULT_AVAILABILITY_ZONES
+            if len(zones) > 0:
+                agent_pool_profile_params["availability_zones"] = zones
+            else:
+                logging.warn("VM size %s is not offered in any availability zone of %s, the node pool won't use zones" % (self.vm_size, self.sku_catalog.location))
         if self.enable_autoscaling:
             agent_pool_profile_params["enable_auto_scaling"] = self.enable_autoscaling
             agent_pool_profile_params["min_count"] = self.min_num_nodes
@@ -326,8 +392,208 @@ class NodePoolBuilder(object):
         if self.tags:
             agent_pool_profile_params["tags"] = self.tags
 
-        logging.info("Adding agent pool profile: %s" % agent_pool_profile_params)
+        logging.info("Adding agent pool profile: %s", LazyJson(agent_pool_profile_params))
 
         self.agent_pool_profile = ManagedClusterAgentPoolProfile(**agent_pool_profile_params)
         self.agent_pool = AgentPool(**agent_pool_profile_params)
         return self
+
+
+def _get_field(o, name):
+    """
+    Read a field on a model, or on a dict coming from the custom config (snake or camel case).
+    """
+    if o is None:
+        return None
+    if isinstance(o, dict):
+        camel_name = re.sub(r'_([a-z])', lambda m: m.group(1).upper(), name)
+        return o.get(name, o.get(camel_name, None))
+    return getattr(o, name, None)
+
+
+def summarize_cluster_config(name, resource_group, cluster_config):
+    """
+    What a ManagedCluster payload would create, as a plain dict.
+    """
+    network_profile = _get_field(cluster_config, "network_profile")
+    identity = _get_field(cluster_config, "identity")
+    service_principal = _get_field(cluster_config, "service_principal_profile")
+    kubelet_identity = (_get_field(cluster_config, "identity_profile") or {}).get("kubeletidentity", None)
+    auto_upgrade_profile = _get_field(cluster_config, "auto_upgrade_profile")
+    pools = []
+    for pool in _get_field(cluster_config, "agent_pool_profiles") or []:
+        pools.append({
+            "name": _get_field(pool, "name"),
+            "mode": _get_field(pool, "mode"),
+            "vm_size": _get_field(pool, "vm_size"),
+            "count": _get_field(pool, "count"),
+            "autoscaling": bool(_get_field(pool, "enable_auto_scaling")),
+            "min_count": _get_field(pool, "min_count"),
+            "max_count": _get_field(pool, "max_count"),
+            "availability_zones": _get_field(pool, "availability_zones"),
+            "subnet": _get_field(pool, "vnet_subnet_id"),
+            "taints": _get_field(pool, "node_taints"),
+            "labels": _get_field(pool, "node_labels")
+        })
+    if service_principal is not None:
+        identity_summary = {"type": "service-principal", "client_id": _get_field(service_principal, "client_id")}
+    elif identity is not None:
+        identity_summary = {"type": _get_field(identity, "type"),
+                            "user_assigned_identities": list((_get_field(identity, "user_assigned_identities") or {}).keys())}
+    else:
+        identity_summary = {"type": None}
+    if kubelet_identity is not None:
+        identity_summary["kubelet_identity"] = _get_field(kubelet_identity, "resource_id")
+    return {
+        "name": name,
+        "resource_group": resource_group,
+        "location": _get_field(cluster_config, "location"),
+        "kubernetes_version": _get_field(cluster_config, "kubernetes_version"),
+        "node_resource_group": _get_field(cluster_config, "node_resource_group"),
+        "tags": _get_field(cluster_config, "tags"),
+        "node_pools": pools,
+        "network": {
+            "plugin": _get_field(network_profile, "network_plugin"),
+            "service_cidr": _get_field(network_profile, "service_cidr"),
+            "dns_service_ip": _get_field(network_profile, "dns_service_ip"),
+            "load_balancer_sku": _get_field(network_profile, "load_balancer_sku"),
+            "outbound_type": _get_field(network_profile, "outbound_type"),
+            "private_cluster": bool(_get_field(_get_field(cluster_config, "api_server_access_profile"), "enable_private_cluster"))
+        },
+        "identity": identity_summary,
+        "upgrades": {
+            "upgrade_channel": _get_field(auto_upgrade_profile, "upgrade_channel"),
+            "node_os_upgrade_channel": _get_field(auto_upgrade_profile, "node_os_upgrade_channel")
+        }
+    }
+
+
+def validate_cluster_config(cluster_config):
+    """
+    Local checks of a ManagedCluster payload, for the mistakes that Azure would only report during the creation.
+
+    :return: list of issues, empty if none was found
+    """
+    issues = []
+    if _get_field(cluster_config, "location") is None:
+        issues.append("No location")
+    if _get_field(cluster_config, "dns_prefix") is None:
+        issues.append("No DNS prefix")
+
+    pools = _get_field(cluster_config, "agent_pool_profiles") or []
+    if len(pools) == 0:
+        issues.append("No node pool")
+    names = set()
+    vnets = set()
+    for pool in pools:
+        name = _get_field(pool, "name")
+        label = "Node pool %s" % name
+        if name is None or not AGENT_POOL_NAME_PATTERN.match(name):
+            issues.append("%s: the name must be lowercase letters and digits, start with a letter and be at most 12 characters" % label)
+        if name in names:
+            issues.append("%s: the name is used by several node pools" % label)
+        names.add(name)
+        if _get_field(pool, "vm_size") is None:
+            issues.append("%s: no VM size" % label)
+        mode = _get_field(pool, "mode")
+        if mode not in ("System", "User", "Automatic", None):
+            issues.append("%s: mode must be System or User, not %s" % (label, mode))
+        count, min_count, max_count = _get_field(pool, "count"), _get_field(pool, "min_count"), _get_field(pool, "max_count")
+        if _get_field(pool, "enable_auto_scaling"):
+            if min_count is None or max_count is None:
+                issues.append("%s: autoscaling needs a min and a max number of nodes" % label)
+            elif min_count > max_count:
+                issues.append("%s: min number of nodes %s is above the max %s" % (label, min_count, max_count))
+            elif count is not None and not (min_count <= count <= max_count):
+                issues.append("%s: number of nodes %s is not between min %s and max %s" % (label, count, min_count, max_count))
+        elif count is None or count < 0:
+            issues.append("%s: invalid number of nodes %s" % (label, count))
+        if mode == "System" and (max_count if _get_field(pool, "enable_auto_scaling") else count) in (0, None):
+            issues.append("%s: a System node pool needs at least one node" % label)
+        subnet_id = _get_field(pool, "vnet_subnet_id")
+        if subnet_id is not None:
+            vnets.add('/'.join(subnet_id.split('/')[:-2]).lower())
+    if len(pools) > 0 and "System" not in [_get_field(pool, "mode") for pool in pools]:
+        issues.append("At least one node pool must be in System mode")
+    if len(vnets) > 1:
+        issues.append("Node pools must all share the same vnet, they use %s" % ", ".join(sorted(vnets)))
+
+    network_profile = _get_field(cluster_config, "network_profile")
+    service_cidr, dns_service_ip = _get_field(network_profile, "service_cidr"), _get_field(network_profile, "dns_service_ip")
+    service_network = None
+    if service_cidr is not None:
+        try:
+            service_network = ipaddress.ip_network(u"%s" % service_cidr, strict=False)
+        except ValueError as e:
+            issues.append("Invalid service CIDR %s: %s" % (service_cidr, str(e)))
+    if dns_service_ip is not None:
+        try:
+            ip = ipaddress.ip_address(u"%s" % dns_service_ip)
+            if service_network is not None and ip not in service_network:
+                issues.append("DNS IP %s is not in the service CIDR %s" % (dns_service_ip, service_cidr))
+        except ValueError as e:
+            issues.append("Invalid DNS IP %s: %s" % (dns_service_ip, str(e)))
+    if _get_field(_get_field(cluster_config, "api_server_access_profile"), "enable_private_cluster") and _get_field(network_profile, "load_balancer_sku") not in (None, "Standard", "standard"):
+        issues.append("A private cluster needs the Standard load balancer SKU")
+
+    auto_upgrade_profile = _get_field(cluster_config, "auto_upgrade_profile")
+    upgrade_channel = _get_field(auto_upgrade_profile, "upgrade_channel")
+    node_os_upgrade_channel = _get_field(auto_upgrade_profile, "node_os_upgrade_channel")
+    if upgrade_channel is not None and upgrade_channel not in UPGRADE_CHANNELS:
+        issues.append("Unknown upgrade channel %s" % upgrade_channel)
+    if node_os_upgrade_channel is not None and node_os_upgrade_channel not in NODE_OS_UPGRADE_CHANNELS:
+        issues.append("Unknown node OS upgrade channel %s" % node_os_upgrade_channel)
+    if upgrade_channel == 'node-image' and node_os_upgrade_channel not in (None, 'NodeImage'):
+        issues.append("The node-image upgrade channel requires the NodeImage node OS upgrade channel")
+
+    if _get_field(cluster_config, "service_principal_profile") is None and _get_field(cluster_config, "identity") is None:
+        issues.append("No identity for the cluster: set a service principal or a managed identity")
+    if _get_field(_get_field(cluster_config, "security_profile"), "workload_identity") and not _get_field(_get_field(cluster_config, "oidc_issuer_profile"), "enabled"):
+        issues.append("Workload identity needs the OIDC issuer")
+    return issues
+
+
+def get_vm_size_issues(cluster_config, sku_catalog):
+    """
+    The node pools of a ManagedCluster payload whose VM size is unknown or restricted in the region.
+
+    :param sku_catalog: the dku_azure.skus.SkuCatalog of the region, no check is done if None
+    :return: list of issues, empty if none was found
+    """
+    if sku_catalog is None:
+        return []
+    issues = []
+    for pool in _get_field(cluster_config, "agent_pool_profiles") or []:
+        vm_size = _get_field(pool, "vm_size")
+        if vm_size is None:
+            continue # reported by validate_cluster_config
+        issue = sku_catalog.get_vm_size_issue(vm_size)
+        if issue is not None:
+            issues.append("Node pool %s: %s" % (_get_field(pool, "name"), issue))
+    return issues
+
+
+def format_cluster_plan(summary, issues):
+    """
+    Human readable version of a plan, ie. of summarize_cluster_config output plus the role assignments and issues.
+    """
+    lines = ["Cluster %s in resource group %s, location %s, Kubernetes %s" % (summary["name"], summary["resource_group"], summary["location"], summary["kubernetes_version"] or "default")]
+    for pool in summary["node_pools"]:
+        if pool["autoscaling"]:
+            size = "%s-%s nodes (autoscaling)" % (pool["min_count"], pool["max_count"])
+        else:
+            size = "%s nodes" % pool["count"]
+        lines.append("  node pool %s (%s): %s x %s, zones %s, subnet %s" % (pool["name"], pool["mode"], size, pool["vm_size"], pool["availability_zones"] or "none", pool["subnet"] or "default"))
+    network = summary["network"]
+    lines.append("  network: %s, services %s, DNS %s, %s load balancer, outbound %s%s" % (network["plugin"], network["service_cidr"], network["dns_service_ip"],
+                                                                                     network["load_balancer_sku"], network["outbound_type"], ", private" if network["private_cluster"] else ""))
+    lines.append("  identity: %s" % ", ".join(["%s=%s" % (k, v) for k, v in sorted(summary["identity"].items())]))
+    lines.append("  upgrades: %s, node OS %s" % (summary["upgrades"]["upgrade_channel"], summary["upgrades"]["node_os_upgrade_channel"]))
+    for role_assignment in summary.get("role_assignments", []):
+        lines.append("  role assignment: %s to %s on %s" % (role_assignment["role"], role_assignment["identity"], role_assignment["scope"]))
+    if len(issues) > 0:
+        lines.append("Issues:")
+        lines.extend(["  - %s" % issue for issue in issues])
+    else:
+        lines.append("No issue found")
+    return "\n".join(lines)
@@ -0,0 +1,137 @@
+import logging
+
+from dku_utils.access import _is_none_or_blank
+from dku_utils.taints import Toleration
+from dku_azure.clusters import NodePoolBuilder
+
+
+def get_node_pool_vnet(subnet_id):
+    # Extract the full resource id of the vnet from the subnet id
+    return '/'.join(subnet_id.split('/')[:-2])
+
+
+def next_node_pool_name(node_pool_ids):
+    cnt = 0
+    while ('nodepool%s' % cnt) in node_pool_ids:
+        cnt += 1
+    return 'nodepool%s' % cnt
+
+
+def build_agent_pool(node_pool_id, node_pool_config, node_pools, dss_cluster_config, connection_info, credentials,
+                     resource_group, dss_host_resource_group, node_pool_builder=None):
+    """
+    Build the agent pool model for a node-pool-request preset, checking that it shares the vnet of the existing pools.
+
+    :return: the (agent_pool, gpu_node_pools_taints) pair, the latter being the tolerations needed by the GPU driver
+    """
+    node_pool_builder = node_pool_builder or NodePoolBuilder(None)
+    gpu_node_pools_taints = set()
+    vnet = node_pool_config.get("vnet", None)
+    subnet = node_pool_config.get("subnet", None)
+
+    # Sanity check for node pools
+    node_pool_vnets = set([get_node_pool_vnet(node_pool.vnet_subnet_id) for node_pool in node_pools if node_pool.vnet_subnet_id is not None])
+    if len(node_pool_vnets) > 0:
+        _, node_pool_subnet = node_pool_builder.resolve_network(inherit_from_host=node_pool_config.get("useSameNetworkAsDSSHost"),
+                                                                cluster_vnet=vnet,
+                                                                cluster_subnet=subnet,
+                                                                connection_info=connection_info,
+                                                                credentials=credentials,
+                                                                resource_group=resource_group,
+                                                                dss_host_resource_group=dss_host_resource_group)
+        node_pool_vnet = get_node_pool_vnet(node_pool_subnet)
+        if not node_pool_vnet in node_pool_vnets:
+            node_pool_vnets.add(node_pool_vnet)
+            raise Exception("Node pools must all share the same vnet. Current node pools configuration yields vnets {}.".format(",".join(node_pool_vnets)))
+
+    node_pool_builder.with_name(node_pool_id)
+    node_pool_builder.with_vm_size(node_pool_config.get("vmSize", None))
+    node_pool_builder.with_network(inherit_from_host=node_pool_config.get("useSameNetworkAsDSSHost"),
+                                   cluster_vnet=vnet,
+                                   cluster_subnet=subnet,
+                                   connection_info=connection_info,
+                                   credentials=credentials,
+                                   resource_group=resource_group,
+                                   dss_host_resource_group=dss_host_resource_group)
+
+    node_pool_builder.with_availability_zones(
+        use_availability_zones=node_pool_config.get("useAvailabilityZones", True))
+
+    node_pool_builder.with_node_count(enable_autoscaling=node_pool_config.get("autoScaling", False),
+                                      num_nodes=node_pool_config.get("numNodes", None),
+                                      min_num_nodes=node_pool_config.get("minNumNodes", None),
+                                      max_num_nodes=node_pool_config.get("maxNumNodes", None))
+
+    node_pool_builder.with_mode(mode=node_pool_config.get("mode", "Automatic"),
+                                system_pods_only=node_pool_config.get("systemPodsOnly", True))
+
+    node_pool_builder.with_disk_size_gb(disk_size_gb=node_pool_config.get("osDiskSizeGb", 0))
+    node_pool_builder.with_node_labels(node_pool_config.get("labels", None))
+    node_pool_builder.with_node_taints(node_pool_config.get("taints", None))
+    node_pool_builder.with_gpu(node_pool_config.get("enableGPU", False))
+    if node_pool_config.get("enableGPU", False) and node_pool_config.get("taints", None):
+        gpu_node_pools_taints.update(
+            Toleration.from_taints_config(node_pool_config.get("taints", None))
+        )
+    node_pool_builder.add_tags(dss_cluster_config.get("tags", None))
+    node_pool_builder.add_tags(node_pool_config.get("tags", None))
+    node_pool_builder.build()
+
+    agent_pool = node_pool_builder.agent_pool
+    # force the name
+    agent_pool.name = node_pool_id
+    return agent_pool, gpu_node_pools_taints
+
+
+def apply_node_count(node_pool, autoscaling_enabled, num_nodes=None, min_nodes=None, max_nodes=None):
+    """
+    Set the requested size on an existing agent pool model.
+
+    :return: False if the pool should be deleted instead (fixed size of 0), True otherwise
+    """
+    if autoscaling_enabled:
+        if min_nodes is None or max_nodes is None:
+            raise Exception("Min and max numbers of nodes are required to autoscale node pool %s" % node_pool.name)
+    elif num_nodes is None:
+        raise Exception("A number of nodes is required to resize node pool %s" % node_pool.name)
+    node_pool.enable_auto_scaling = autoscaling_enabled
+    if autoscaling_enabled:
+        if min_nodes > max_nodes:
+            raise Exception("Cannot resize autoscalable cluster with a max number of nodes (%s) less than its min number of nodes (%s)."
+                            % (max_nodes, min_nodes))
+        logging.info("Resizing node pool %s to autoscale with %s min nodes and %s max nodes." % (node_pool.name, min_nodes, max_nodes))
+        node_pool.min_count = min_nodes
+        node_pool.max_count = max_nodes
+        return True
+    if num_nodes == 0:
+        return False
+    logging.info("Resizing node pool %s to %s" % (node_pool.name, num_nodes))
+    node_pool.count = num_nodes
+    node_pool.min_count = None
+    node_pool.max_count = None
+    return True
+
+
+def check_remaining_node_pools(node_pools, deleted_ids, created_modes=None):
+    """
+    A cluster needs at least one node pool left, and at least one in System mode.
+    """
+    remaining = [node_pool for node_pool in node_pools if node_pool.name not in deleted_ids]
+    created_modes = created_modes or []
+    if len(remaining) + len(created_modes) == 0:
+        raise Exception("Can't delete node pool, a cluster needs at least one running node pool")
+    modes = [node_pool.mode for node_pool in remaining] + created_modes
+    if len(deleted_ids) > 0 and 'System' not in modes:
+        raise Exception("Can't delete node pools %s, a cluster needs at least one node pool in System mode" % ", ".join(sorted(deleted_ids)))
+
+
+def find_node_pool(node_pools, node_pool_id):
+    """
+    Find a pool by name in a listing, the name being optional when there is only one pool.
+    """
+    if _is_none_or_blank(node_pool_id) and len(node_pools) > 1:
+        raise Exception("Cluster has %s node pools, you need to specify the node pool id" % len(node_pools))
+    for profile in node_pools:
+        if profile.name == node_pool_id or (_is_none_or_blank(node_pool_id) and len(node_pools) == 1):
+            return profile
+    raise Exception("Unable to find node pool '%s'" % (node_pool_id))
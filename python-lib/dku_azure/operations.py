@@ -0,0 +1,106 @@
+import logging, time
+
+DEFAULT_INITIAL_INTERVAL = 2 # seconds
+DEFAULT_MAX_INTERVAL = 30 # seconds
+DEFAULT_BACKOFF = 1.5
+
+
+class OperationTimeout(Exception):
+    pass
+
+
+def adaptive_intervals(initial_interval=DEFAULT_INITIAL_INTERVAL, max_interval=DEFAULT_MAX_INTERVAL, backoff=DEFAULT_BACKOFF):
+    """
+    Infinite sequence of polling intervals, growing from initial_interval up to max_interval.
+    """
+    interval = initial_interval
+    while True:
+        yield interval
+        interval = min(max_interval, interval * backoff)
+
+
+def wait_for_poller(poller, deadline=None, description="operation"):
+    """
+    Wait for an SDK long-running-operation poller, which follows the Retry-After hints of ARM.
+
+    :param deadline: absolute time (as in time.time()) after which OperationTimeout is raised
+    """
+    remaining = None if deadline is None else max(0, deadline - time.time())
+    result = poller.result(timeout=remaining)
+    if not poller.done():
+        raise OperationTimeout("%s did not finish before the deadline (status %s)" % (description, poller.status()))
+    return result
+
+
+def wait_until(check, deadline=None, description="operation", initial_interval=DEFAULT_INITIAL_INTERVAL, max_interval=DEFAULT_MAX_INTERVAL):
+    """
+    Call check() with adaptive intervals until it returns something else than None, and return that value.
+    """
+    for interval in adaptive_intervals(initial_interval, max_interval):
+        value = check()
+        if value is not None:
+            return value
+        if deadline is not None:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                raise OperationTimeout("%s did not finish before the deadline" % description)
+            interval = min(interval, remaining)
+        logging.info("Waiting %.1fs for %s" % (interval, description))
+        time.sleep(interval)
+
+
+class OperationResult(object):
+    """
+    Outcome of a wait: either done with the SDK result, or timed out while still running in Azure.
+    """
+    def __init__(self, done, result=None, status=None, progress=None):
+        self.done = done
+        self.timed_out = not done
+        self.result = result
+        self.status = status
+        self.progress = progress
+
+
+def wait_with_progress(poller, get_progress=None, progress_callback=None, deadline=None, description="operation",
+                       initial_interval=DEFAULT_INITIAL_INTERVAL, max_interval=DEFAULT_MAX_INTERVAL):
+    """
+    Wait for a poller with adaptive intervals, reporting get_progress() to progress_callback between polls.
+    Never raises on deadline, returns an OperationResult with timed_out set instead.
+    """
+    progress = None
+    for interval in adaptive_intervals(initial_interval, max_interval):
+        if deadline is not None:
+            interval = min(interval, max(0, deadline - time.time()))
+        poller.wait(timeout=interval)
+        if poller.done():
+            break
+        if get_progress is not None:
+            try:
+                progress = get_progress()
+            except Exception as e:
+                logging.warn("Unable to get progress of %s: %s" % (description, str(e)))
+            if progress is not None and progress_callback is not None:
+                progress_callback(progress)
+        logging.info("Still waiting for %s (status %s, progress %s)" % (description, poller.status(), progress))
+        if deadline is not None and time.time() >= deadline:
+            logging.warn("%s did not finish before the deadline, it keeps running in Azure" % description)
+            return OperationResult(False, status=poller.status(), progress=progress)
+    return OperationResult(True, result=poller.result(), status=poller.status(), progress=progress)
+
+
+def wait_for_agent_pool_operation(poller, clusters_client, resource_group, cluster_name, node_pool_name,
+                                  kube_config_path=None, progress_callback=None, deadline=None):
+    """
+    Wait for an operation on an agent pool, with the number of ready nodes in the pool as progress
+    (no progress is reported without a kube config to list the nodes).
+    """
+    def get_progress():
+        agent_pool = clusters_client.agent_pools.get(resource_group, cluster_name, node_pool_name)
+        logging.info("Agent pool %s is %s" % (node_pool_name, agent_pool.provisioning_state))
+        if kube_config_path is not None:
+            from dku_kube.nodes import count_ready_nodes
+            ready, total = count_ready_nodes(kube_config_path, node_pool_name)
+            logging.info("Agent pool %s has %s/%s nodes ready" % (node_pool_name, ready, total))
+            return ready
+        return None
+    return wait_with_progress(poller, get_progress, progress_callback, deadline, "operation on node pool %s" % node_pool_name)
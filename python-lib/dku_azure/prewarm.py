@@ -0,0 +1,192 @@
+import os, json, logging, hashlib, datetime, time
+
+from dku_utils.access import _is_none_or_blank
+from dku_utils.cache import get_state_dir, write_atomically
+
+WEEKDAYS = ["mon", "tue", "wed", "thu", "fri", "sat", "sun"]
+HISTORY_MIN_DAYS = 2 # a slot needs scale-ups on that many days to be pre-warmed
+PLAN_STEP_MINUTES = 15
+
+
+def parse_days(days):
+    """
+    'mon-fri', 'sat,sun', 'mon,wed-fri' or '*' to a set of weekday numbers (monday is 0).
+    """
+    if _is_none_or_blank(days) or days.strip() == '*':
+        return set(range(7))
+    result = set()
+    for part in days.lower().replace(' ', '').split(','):
+        if '-' in part:
+            first, last = [WEEKDAYS.index(d[:3]) for d in part.split('-')]
+            day = first
+            while True:
+                result.add(day)
+                if day == last:
+                    break
+                day = (day + 1) % 7
+        else:
+            result.add(WEEKDAYS.index(part[:3]))
+    return result
+
+
+def parse_time_of_day(value):
+    hours, minutes = value.strip().split(':')
+    return int(hours) * 60 + int(minutes)
+
+
+class TimeWindow(object):
+    """
+    A weekly time window during which the node pool should have at least nodes nodes.
+
+    The window can span midnight (eg. 22:00 to 02:00), in which case it starts on the given days.
+    """
+    def __init__(self, days, start, end, nodes, source="declared"):
+        self.days = days
+        self.start = start
+        self.end = end
+        self.nodes = nodes
+        self.source = source
+
+    @staticmethod
+    def from_config(config):
+        try:
+            return TimeWindow(parse_days(config.get("days", "*")), parse_time_of_day(config["start"]), parse_time_of_day(config["end"]), int(config["nodes"]))
+        except Exception as e:
+            raise Exception("Invalid pre-warm window %s: %s" % (json.dumps(config), str(e)))
+
+    def contains(self, dt):
+        minute = dt.hour * 60 + dt.minute
+        day = dt.weekday()
+        if self.start <= self.end:
+            return day in self.days and self.start <= minute < self.end
+        return (day in self.days and minute >= self.start) or ((day - 1) % 7 in self.days and minute < self.end)
+
+    def describe(self):
+        return "%s %02d:%02d-%02d:%02d (%s)" % (",".join([WEEKDAYS[d] for d in sorted(self.days)]), self.start // 60, self.start % 60,
+                                                self.end // 60, self.end % 60, self.source)
+
+
+def derive_windows(history, baseline_nodes, now=None, weeks=4):
+    """
+    One-hour windows for the weekday and hour slots in which the pool went above baseline_nodes on
+    at least HISTORY_MIN_DAYS days of the past weeks, sized with the median of the daily peaks.
+
+    :param history: list of {"t": timestamp, "nodes": node count} samples
+    """
+    now = now or datetime.datetime.now()
+    oldest = now - datetime.timedelta(weeks=weeks)
+    daily_peaks = {} # (weekday, hour) -> {date: peak}
+    for sample in history:
+        dt = datetime.datetime.fromtimestamp(sample["t"])
+        if dt < oldest:
+            continue
+        peaks = daily_peaks.setdefault((dt.weekday(), dt.hour), {})
+        peaks[dt.date()] = max(peaks.get(dt.date(), 0), sample["nodes"])
+    windows = []
+    for (weekday, hour), peaks in sorted(daily_peaks.items()):
+        values = sorted(peaks.values())
+        if len([v for v in values if v > baseline_nodes]) < HISTORY_MIN_DAYS:
+            continue
+        nodes = values[len(values) // 2]
+        if nodes > baseline_nodes:
+            windows.append(TimeWindow(set([weekday]), hour * 60, (hour + 1) * 60, nodes, source="history"))
+    return windows
+
+
+class PrewarmPolicy(object):
+    """
+    The size a node pool should have at a given time: the largest window active now or within lead_minutes.
+    """
+    def __init__(self, windows, lead_minutes=15):
+        self.windows = windows
+        self.lead = datetime.timedelta(minutes=lead_minutes)
+
+    def get_active_window(self, dt):
+        active = [w for w in self.windows if w.contains(dt) or w.contains(dt + self.lead)]
+        if len(active) == 0:
+            return None
+        return max(active, key=lambda w: w.nodes)
+
+    def plan(self, baseline_nodes, start=None, hours=24 * 7):
+        """
+        List the size changes over the coming hours, as (time, nodes, window or None) tuples.
+        """
+        start = (start or datetime.datetime.now()).replace(second=0, microsecond=0)
+        changes = []
+        current = None
+        for step in range(0, hours * 60, PLAN_STEP_MINUTES):
+            dt = start + datetime.timedelta(minutes=step)
+            window = self.get_active_window(dt)
+            nodes = max(baseline_nodes, window.nodes) if window is not None else baseline_nodes
+            if nodes != current:
+                if current is not None or nodes != baseline_nodes:
+                    changes.append((dt, nodes, window))
+                current = nodes
+        return changes
+
+
+class PrewarmState(object):
+    """
+    Per node pool files under DIP_HOME: the size of the pool before it was raised, and samples of its node count.
+
+    This is state, not a cache: losing the baseline would leave the pool raised.
+    """
+    def __init__(self, cluster_id, node_pool_name):
+        state_dir = get_state_dir("prewarm")
+        if state_dir is None:
+            raise Exception("DIP_HOME is not set, pre-warming needs it to keep the state of the node pools")
+        prefix = "{}-{}".format(hashlib.sha1(cluster_id.lower().encode("utf8")).hexdigest(), node_pool_name)
+        self.state_path = os.path.join(state_dir, prefix + ".json")
+        self.history_path = os.path.join(state_dir, prefix + "-history.jsonl")
+
+    def get_state(self):
+        if not os.path.exists(self.state_path):
+            return None
+        with open(self.state_path, "r") as f:
+            return json.load(f)
+
+    def get_baseline(self):
+        state = self.get_state()
+        return state.get("baseline", None) if state is not None else None
+
+    def get_added_nodes(self):
+        """
+        How many nodes the pre-warming itself forced into the pool, 0 when not raised.
+        """
+        state = self.get_state()
+        if state is None:
+            return 0
+        baseline = state["baseline"]
+        count_before = state.get("count_before", baseline["min_count"] if baseline["autoscaling"] else baseline["count"])
+        return max(0, state.get("raised_to", 0) - (count_before or 0))
+
+    def save_baseline(self, baseline, raised_to, count_before):
+        """
+        :param count_before: node count of the pool when it was first raised
+        """
+        write_atomically(self.state_path, json.dumps({"baseline": baseline, "raised_to": raised_to, "count_before": count_before, "since": time.time()}))
+
+    def clear_baseline(self):
+        if os.path.exists(self.state_path):
+            os.remove(self.state_path)
+
+    def record_sample(self, nodes, max_age_weeks=4):
+        with open(self.history_path, "a") as f:
+            f.write(json.dumps({"t": time.time(), "nodes": nodes}) + "\n")
+        # keep the file bounded, compacting it now and then
+        if os.path.getsize(self.history_path) > 1024 * 1024:
+            oldest = time.time() - max_age_weeks * 7 * 24 * 3600
+            samples = [s for s in self.get_history() if s["t"] >= oldest]
+            write_atomically(self.history_path, "".join([json.dumps(s) + "\n" for s in samples]))
+
+    def get_history(self):
+        if not os.path.exists(self.history_path):
+            return []
+        samples = []
+        with open(self.history_path, "r") as f:
+            for line in f:
+                try:
+                    samples.append(json.loads(line))
+                except ValueError:
+                    logging.warn("Skipping invalid line in %s" % self.history_path)
+        return samples
@@ -0,0 +1,76 @@
+import logging
+
+REGIONAL_VCPUS_QUOTA = "cores"
+SPOT_VCPUS_QUOTA = "lowPriorityCores"
+
+
+def get_node_pool_peak_nodes(agent_pool):
+    """
+    The most nodes a pool can have, ie. the autoscaler max count when autoscaling.
+    """
+    if agent_pool.enable_auto_scaling:
+        return max(agent_pool.max_count or 0, agent_pool.count or 0)
+    return agent_pool.count or 0
+
+
+def get_vcpus_demand(node_pool_changes, sku_catalog):
+    """
+    Additional vCPUs needed per quota, for pools going from current_nodes to their peak size.
+
+    :param node_pool_changes: list of (agent pool model, current number of nodes) pairs, 0 for new pools
+    :param sku_catalog: the dku_azure.skus.SkuCatalog of the region
+    :return: dict of quota name to vCPUs
+    """
+    demand = {}
+    for agent_pool, current_nodes in node_pool_changes:
+        additional_nodes = get_node_pool_peak_nodes(agent_pool) - (current_nodes or 0)
+        if additional_nodes <= 0:
+            continue
+        vm_size = sku_catalog.get(agent_pool.vm_size)
+        if vm_size is None:
+            logging.warn("VM size %s not found in the region, skipping its quota check" % agent_pool.vm_size)
+            continue
+        vcpus = additional_nodes * vm_size["vcpus"]
+        if getattr(agent_pool, "scale_set_priority", None) == "Spot":
+            quotas = [SPOT_VCPUS_QUOTA]
+        else:
+            quotas = [REGIONAL_VCPUS_QUOTA, vm_size["family"]]
+        for quota in quotas:
+            demand[quota] = demand.get(quota, 0) + vcpus
+    return demand
+
+
+def get_vcpus_quota_issues(compute_client, sku_catalog, node_pool_changes):
+    """
+    Compare the vCPU demand of the node pool changes with the regional and per-family usage and limits.
+
+    If the quotas or the VM sizes can't be read (eg. missing permission), the check is skipped rather than blocking.
+
+    :return: list of messages, one per quota that would be exceeded
+    """
+    if sku_catalog is None or len(node_pool_changes) == 0:
+        return []
+    location = sku_catalog.location
+    try:
+        usages = {usage.name.value: usage for usage in compute_client.usage.list(location)}
+    except Exception as e:
+        logging.warn("Unable to read the vCPU quotas in %s, skipping the quota check: %s" % (location, str(e)))
+        return []
+
+    issues = []
+    for quota, vcpus in sorted(get_vcpus_demand(node_pool_changes, sku_catalog).items()):
+        usage = usages.get(quota, None)
+        if usage is None:
+            logging.warn("No usage data for quota %s in %s" % (quota, location))
+            continue
+        logging.info("Quota %s in %s: %s used, %s more needed, limit %s" % (quota, location, usage.current_value, vcpus, usage.limit))
+        if usage.current_value + vcpus > usage.limit:
+            issues.append("%s: %s vCPUs needed but only %s left (%s of %s used) in %s"
+                          % (usage.name.localized_value or quota, vcpus, max(0, usage.limit - usage.current_value), usage.current_value, usage.limit, location))
+    return issues
+
+
+def check_vcpus_quotas(compute_client, sku_catalog, node_pool_changes):
+    issues = get_vcpus_quota_issues(compute_client, sku_catalog, node_pool_changes)
+    if len(issues) > 0:
+        raise Exception("Not enough vCPU quota, request a quota increase or use smaller node pools:\n - %s" % "\n - ".join(issues))
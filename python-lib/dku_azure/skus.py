@@ -0,0 +1,152 @@
+import os, json, time, logging, threading
+
+from dku_utils.cache import get_cache_dir, write_cache_file
+
+SKU_CATALOG_TTL = 24 * 3600 # seconds, VM sizes and their zones rarely change
+
+_sku_catalogs = {}
+_sku_catalogs_lock = threading.Lock()
+
+
+def _sku_to_entry(sku, location):
+    """
+    Keep what the plugin needs of a resource SKU, in a json-friendly dict.
+    """
+    capabilities = {c.name: c.value for c in sku.capabilities or []}
+    zones = set()
+    for location_info in sku.location_info or []:
+        if (location_info.location or '').lower() == location.lower():
+            zones.update(location_info.zones or [])
+    restricted_reasons = []
+    for restriction in sku.restrictions or []:
+        if restriction.type == "Zone":
+            restricted_zones = restriction.restriction_info.zones if restriction.restriction_info is not None else None
+            zones.difference_update(restricted_zones or [])
+        else:
+            restricted_reasons.append(restriction.reason_code or restriction.type)
+    def as_number(name, cast):
+        try:
+            return cast(capabilities.get(name, 0))
+        except ValueError:
+            return 0
+    return {
+        "name": sku.name,
+        "family": sku.family,
+        "vcpus": as_number("vCPUs", int),
+        "memory_gb": as_number("MemoryGB", float),
+        "gpus": as_number("GPUs", int),
+        "zones": sorted(zones),
+        "restrictions": restricted_reasons
+    }
+
+
+class SkuCatalog(object):
+    """
+    The VM sizes offered in a region to a subscription, indexed by name (case insensitive).
+    """
+    def __init__(self, subscription_id, location, entries, timestamp=None):
+        self.subscription_id = subscription_id
+        self.location = location
+        self.entries = entries
+        self.timestamp = timestamp or time.time()
+        self.index = {entry["name"].lower(): entry for entry in entries}
+
+    def get(self, vm_size):
+        if vm_size is None:
+            return None
+        return self.index.get(vm_size.lower(), None)
+
+    def get_vm_size_issue(self, vm_size):
+        """
+        Why vm_size can't be used, or None if it can.
+        """
+        entry = self.get(vm_size)
+        if entry is None:
+            return "VM size %s is not offered in %s" % (vm_size, self.location)
+        if len(entry["restrictions"]) > 0:
+            return "VM size %s is not available in %s for this subscription (%s)" % (vm_size, self.location, ", ".join(entry["restrictions"]))
+        return None
+
+    def check_vm_size(self, vm_size):
+        """
+        Return the entry of vm_size, failing if the size is unknown or not available to the subscription.
+        """
+        issue = self.get_vm_size_issue(vm_size)
+        if issue is not None:
+            raise Exception(issue)
+        return self.get(vm_size)
+
+    def get_zones(self, vm_size):
+        entry = self.get(vm_size)
+        return entry["zones"] if entry is not None else []
+
+    def get_resources(self, vm_size):
+        """
+        Size of a VM in the units of dku_kube.capacity: cpu in millicores, memory in bytes, gpu count.
+        """
+        entry = self.get(vm_size)
+        if entry is None:
+            return None
+        return {"cpu": entry["vcpus"] * 1000, "memory": int(entry["memory_gb"] * 2**30), "gpu": entry["gpus"]}
+
+    def to_json(self):
+        return json.dumps({"subscription_id": self.subscription_id, "location": self.location, "timestamp": self.timestamp, "skus": self.entries})
+
+
+def _get_sku_catalog_cache_path(subscription_id, location):
+    cache_dir = get_cache_dir("skus")
+    if cache_dir is None:
+        return None
+    return os.path.join(cache_dir, "{}-{}.json".format(subscription_id, location.lower()))
+
+
+def _read_sku_catalog(subscription_id, location, ttl):
+    cache_path = _get_sku_catalog_cache_path(subscription_id, location)
+    if cache_path is None or not os.path.exists(cache_path):
+        return None
+    try:
+        with open(cache_path, "r") as f:
+            data = json.load(f)
+    except Exception:
+        logging.warn("Unable to read SKU catalog at %s, ignoring it" % cache_path)
+        return None
+    if time.time() - data.get("timestamp", 0) > ttl:
+        return None
+    return SkuCatalog(subscription_id, location, data["skus"], data["timestamp"])
+
+
+def get_sku_catalog(compute_client, subscription_id, location, ttl=SKU_CATALOG_TTL):
+    """
+    Return the catalog of VM sizes of a region.
+
+    The catalog is memoized in the process and saved under DIP_HOME, since listing the resource SKUs
+    takes several seconds. Pass ttl=0 to force a listing.
+    """
+    key = (subscription_id, location.lower())
+    with _sku_catalogs_lock:
+        catalog = _sku_catalogs.get(key, None)
+        if catalog is not None and time.time() - catalog.timestamp <= ttl:
+            return catalog
+        catalog = _read_sku_catalog(subscription_id, location, ttl)
+        if catalog is None:
+            logging.info("Listing VM sizes of %s" % location)
+            entries = [_sku_to_entry(sku, location) for sku in compute_client.resource_skus.list(filter="location eq '%s'" % location)
+                       if sku.resource_type == "virtualMachines"]
+            catalog = SkuCatalog(subscription_id, location, entries)
+            logging.info("Found %s VM sizes in %s" % (len(entries), location))
+            cache_path = _get_sku_catalog_cache_path(subscription_id, location)
+            if cache_path is not None:
+                write_cache_file(cache_path, catalog.to_json())
+        _sku_catalogs[key] = catalog
+        return catalog
+
+
+def get_sku_catalog_or_none(compute_client, subscription_id, location, ttl=SKU_CATALOG_TTL):
+    """
+    Same as get_sku_catalog, but None if the SKUs can't be listed, so that the checks relying on it are skipped.
+    """
+    try:
+        return get_sku_catalog(compute_client, subscription_id, location, ttl)
+    except Exception as e:
+        logging.warn("Unable to list the VM sizes of %s, skipping the checks on them: %s" % (location, str(e)))
+        return None
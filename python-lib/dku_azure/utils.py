@@ -1,12 +1,20 @@
 import requests
 import logging
 import traceback
+import os, json, time, threading
 
 from azure.mgmt.resource import ResourceManagementClient
+from dku_azure.clients import get_client
 from dku_utils.access import _is_none_or_blank
+from dku_utils.cache import get_cache_dir, write_cache_file
 
 AZURE_METADATA_SERVICE="http://169.254.169.254"
 INSTANCE_API_VERSION = "2019-04-30"
+INSTANCE_METADATA_TTL = 300 # seconds, the VM placement doesn't change while DSS is running
+INSTANCE_METADATA_TIMEOUT = 5 # seconds, the metadata service answers in a few ms, or never when not on Azure
+
+_instance_metadata_cache = {}
+_instance_metadata_lock = threading.Lock()
 
 def run_and_process_cloud_error(fn):
     try:
@@ -24,13 +32,60 @@ def run_and_process_cloud_error(fn):
             raise e
         
 
-def get_instance_metadata(api_version=INSTANCE_API_VERSION):
+def _get_instance_metadata_cache_path(api_version):
+    cache_dir = get_cache_dir()
+    if cache_dir is None:
+        return None
+    return os.path.join(cache_dir, "instance-metadata-{}.json".format(api_version))
+
+def _read_instance_metadata_snapshot(api_version, ttl):
+    cache_path = _get_instance_metadata_cache_path(api_version)
+    if cache_path is None or not os.path.exists(cache_path):
+        return None
+    try:
+        with open(cache_path, "r") as f:
+            snapshot = json.load(f)
+    except Exception:
+        logging.warn("Unable to read instance metadata snapshot at %s, ignoring it" % cache_path)
+        return None
+    if time.time() - snapshot.get("timestamp", 0) > ttl:
+        return None
+    return snapshot
+
+def _write_instance_metadata_snapshot(api_version, snapshot):
+    cache_path = _get_instance_metadata_cache_path(api_version)
+    if cache_path is not None:
+        write_cache_file(cache_path, json.dumps(snapshot))
+
+def get_instance_metadata(api_version=INSTANCE_API_VERSION, ttl=INSTANCE_METADATA_TTL):
     """
     Return VM metadata.
+
+    The metadata is memoized in the process and snapshotted under DIP_HOME so that macros
+    can reuse it. Pass ttl=0 to force a call to the metadata service.
     """
+    with _instance_metadata_lock:
+        snapshot = _instance_metadata_cache.get(api_version, None)
+        if snapshot is not None and time.time() - snapshot["timestamp"] <= ttl:
+            return snapshot["metadata"]
+        if ttl > 0:
+            snapshot = _read_instance_metadata_snapshot(api_version, ttl)
+            if snapshot is not None:
+                _instance_metadata_cache[api_version] = snapshot
+                return snapshot["metadata"]
+
+    # outside of the lock, a slow metadata service mustn't block the callers that have a cached copy
     metadata_svc_endpoint = "{}/metadata/instance?api-version={}".format(AZURE_METADATA_SERVICE, api_version)
-    req = requests.get(metadata_svc_endpoint, headers={"metadata": "true"}, proxies={"http":None})
+    try:
+        req = requests.get(metadata_svc_endpoint, headers={"metadata": "true"}, proxies={"http":None}, timeout=INSTANCE_METADATA_TIMEOUT)
+    except requests.exceptions.RequestException as e:
+        raise Exception("Unable to reach the Azure instance metadata service, is DSS running on an Azure VM? (%s)" % str(e))
+    req.raise_for_status()
     resp = req.json()
+    snapshot = {"timestamp": time.time(), "metadata": resp}
+    with _instance_metadata_lock:
+        _instance_metadata_cache[api_version] = snapshot
+        _write_instance_metadata_snapshot(api_version, snapshot)
     return resp
 
 def get_subscription_id(connection_info):
@@ -79,7 +134,7 @@ def get_host_network(credentials=None, resource_group=None, connection_info=None
     logging.info("DSS host is on VNET {}".format(vm_name))
     subscription_id = get_subscription_id(connection_info)
     vm_resource_id = get_vm_resource_id(subscription_id, resource_group, vm_name)
-    resource_mgmt_client = ResourceManagementClient(credential=credentials, subscription_id=subscription_id, api_version=api_version)
+    resource_mgmt_client = get_client(ResourceManagementClient, credentials, subscription_id, api_version=api_version)
     vm_properties = resource_mgmt_client.resources.get_by_id(vm_resource_id, api_version=api_version).properties
     vm_network_interfaces = vm_properties["networkProfile"]["networkInterfaces"]
     if len(vm_network_interfaces) > 1:
@@ -0,0 +1,216 @@
+import os, json, base64, logging, tempfile, threading, atexit
+import requests
+import yaml
+from requests.adapters import HTTPAdapter
+
+from dku_utils.access import _is_none_or_blank
+
+FIELD_MANAGER = "dss-plugin-aks-clusters"
+POOL_MAXSIZE = 16
+
+# kinds that don't live in a namespace
+CLUSTER_SCOPED_KINDS = set(["Namespace", "Node", "PersistentVolume", "ClusterRole", "ClusterRoleBinding",
+                            "StorageClass", "CustomResourceDefinition", "PriorityClass"])
+IRREGULAR_PLURALS = {"Ingress": "ingresses", "NetworkPolicy": "networkpolicies", "PriorityClass": "priorityclasses",
+                     "StorageClass": "storageclasses", "Endpoints": "endpoints"}
+
+
+class KubeClientUnsupported(Exception):
+    """
+    The kubeconfig can't be used in-process (eg. exec or auth-provider based users), callers should fall back to kubectl.
+    """
+    pass
+
+
+class KubeApiException(Exception):
+    def __init__(self, message, status_code, body):
+        super(KubeApiException, self).__init__(message)
+        self.status_code = status_code
+        self.body = body
+
+
+def _resource_path(api_version, kind, namespace=None, name=None):
+    prefix = "/api/v1" if api_version == "v1" else "/apis/{}".format(api_version)
+    plural = IRREGULAR_PLURALS.get(kind, kind.lower() + "s")
+    path = prefix
+    if namespace is not None and kind not in CLUSTER_SCOPED_KINDS:
+        path += "/namespaces/{}".format(namespace)
+    path += "/" + plural
+    if name is not None:
+        path += "/" + name
+    return path
+
+
+class KubeApiClient(object):
+    """
+    Minimal Kubernetes API client reading a kubeconfig file, with a persistent HTTPS connection pool.
+    """
+
+    def __init__(self, kube_config_path, context=None):
+        with open(kube_config_path, "r") as f:
+            kube_config = yaml.safe_load(f)
+        self.kube_config_path = kube_config_path
+        self.temp_files = []
+        context_name = context or kube_config.get("current-context")
+        context = self._find(kube_config, "contexts", context_name)["context"]
+        cluster = self._find(kube_config, "clusters", context["cluster"])["cluster"]
+        user = self._find(kube_config, "users", context["user"])["user"]
+        if "exec" in user or "auth-provider" in user:
+            raise KubeClientUnsupported("User %s uses an external authentication plugin" % context["user"])
+
+        self.server = cluster["server"].rstrip("/")
+        self.session = requests.Session()
+        self.session.mount("https://", HTTPAdapter(pool_connections=1, pool_maxsize=POOL_MAXSIZE))
+        if cluster.get("insecure-skip-tls-verify", False):
+            self.session.verify = False
+        elif "certificate-authority-data" in cluster:
+            self.session.verify = self._to_file(cluster["certificate-authority-data"])
+        elif "certificate-authority" in cluster:
+            self.session.verify = cluster["certificate-authority"]
+        cert = user.get("client-certificate") or self._to_file(user.get("client-certificate-data"))
+        key = user.get("client-key") or self._to_file(user.get("client-key-data"))
+        if cert is not None and key is not None:
+            self.session.cert = (cert, key)
+        if not _is_none_or_blank(user.get("token", None)):
+            self.session.headers["Authorization"] = "Bearer {}".format(user["token"])
+        # only take the proxy from the environment, like kubectl does (HTTPS_PROXY, NO_PROXY): with trust_env,
+        # REQUESTS_CA_BUNDLE and .netrc would also override the CA and credentials of the kubeconfig
+        self.session.trust_env = False
+        self.session.proxies = requests.utils.get_environ_proxies(self.server)
+
+    def _find(self, kube_config, section, name):
+        for element in kube_config.get(section, []):
+            if element.get("name", None) == name:
+                return element
+        raise KubeClientUnsupported("No %s named %s in kubeconfig" % (section, name))
+
+    def _to_file(self, b64_data):
+        if b64_data is None:
+            return None
+        fd, path = tempfile.mkstemp(prefix="dku-kube-")
+        with os.fdopen(fd, "wb") as f:
+            f.write(base64.b64decode(b64_data))
+        self.temp_files.append(path)
+        return path
+
+    def close(self):
+        self.session.close()
+        for path in self.temp_files:
+            if os.path.exists(path):
+                os.remove(path)
+        self.temp_files = []
+
+    def request(self, method, path, params=None, body=None, content_type="application/json", timeout=10, stream=False):
+        headers = {"Accept": "application/json"}
+        data = None
+        if body is not None:
+            headers["Content-Type"] = content_type
+            data = body if isinstance(body, (bytes, str)) else json.dumps(body)
+        resp = self.session.request(method, self.server + path, params=params, data=data, headers=headers, timeout=timeout, stream=stream)
+        if resp.status_code >= 400:
+            raise KubeApiException("%s %s failed with %s" % (method, path, resp.status_code), resp.status_code, resp.text)
+        return resp
+
+    def get(self, api_version, kind, name=None, namespace=None, label_selector=None, field_selector=None, ignore_not_found=False, timeout=10):
+        params = {}
+        if label_selector is not None:
+            params["labelSelector"] = label_selector
+        if field_selector is not None:
+            params["fieldSelector"] = field_selector
+        try:
+            return self.request("GET", _resource_path(api_version, kind, namespace, name), params=params, timeout=timeout).json()
+        except KubeApiException as e:
+            if ignore_not_found and e.status_code == 404:
+                return None
+            raise e
+
+    def apply(self, obj, timeout=10):
+        """
+        Server-side apply of a manifest, creating or updating it.
+        """
+        metadata = obj.get("metadata", {})
+        path = _resource_path(obj["apiVersion"], obj["kind"], metadata.get("namespace", "default"), metadata["name"])
+        params = {"fieldManager": FIELD_MANAGER, "force": "true"}
+        return self.request("PATCH", path, params=params, body=obj, content_type="application/apply-patch+yaml", timeout=timeout).json()
+
+    def patch(self, api_version, kind, name, patch, namespace=None, timeout=10):
+        path = _resource_path(api_version, kind, namespace, name)
+        return self.request("PATCH", path, body=patch, content_type="application/strategic-merge-patch+json", timeout=timeout).json()
+
+    def delete(self, api_version, kind, name, namespace=None, ignore_not_found=True, timeout=10):
+        try:
+            return self.request("DELETE", _resource_path(api_version, kind, namespace, name), timeout=timeout).json()
+        except KubeApiException as e:
+            if ignore_not_found and e.status_code == 404:
+                return None
+            raise e
+
+    def watch(self, api_version, kind, namespace=None, label_selector=None, field_selector=None, timeout_seconds=10, resource_version=None):
+        """
+        Yield (event type, object) pairs until the server closes the watch after timeout_seconds.
+
+        With resource_version, the watch starts right after that version, so no change in between is missed.
+        """
+        params = {"watch": "true", "timeoutSeconds": int(max(1, timeout_seconds))}
+        if resource_version is not None:
+            params["resourceVersion"] = resource_version
+        if label_selector is not None:
+            params["labelSelector"] = label_selector
+        if field_selector is not None:
+            params["fieldSelector"] = field_selector
+        resp = self.request("GET", _resource_path(api_version, kind, namespace), params=params, timeout=timeout_seconds + 5, stream=True)
+        try:
+            for line in resp.iter_lines():
+                if not line:
+                    continue
+                event = json.loads(line)
+                yield event["type"], event["object"]
+        finally:
+            resp.close()
+
+    def exec_cmd(self, pod_name, cmd, namespace="default", timeout=5):
+        """
+        Exec needs a websocket/SPDY upgrade, which is left to kubectl.
+        """
+        from .kubectl_command import run_with_timeout
+        env = os.environ.copy()
+        env["KUBECONFIG"] = self.kube_config_path
+        kcmd = ["kubectl", "exec", "-n", namespace, pod_name, "--"] + cmd
+        return run_with_timeout(kcmd, env=env, timeout=timeout)
+
+
+_clients = {}
+_clients_lock = threading.Lock()
+
+def get_kube_client(kube_config_path):
+    """
+    Return a client for this kubeconfig, shared in the process, or None if kubectl has to be used instead.
+    """
+    if os.environ.get("DKU_AKS_FORCE_KUBECTL", "0") == "1":
+        return None
+    kube_config_path = os.path.abspath(kube_config_path)
+    try:
+        mtime = os.path.getmtime(kube_config_path)
+    except OSError:
+        return None
+    with _clients_lock:
+        entry = _clients.get(kube_config_path, None)
+        if entry is not None and entry[0] == mtime:
+            return entry[1]
+        if entry is not None:
+            entry[1].close()
+        try:
+            client = KubeApiClient(kube_config_path)
+        except KubeClientUnsupported as e:
+            logging.info("Cannot use the in-process kubernetes client, falling back to kubectl: %s" % str(e))
+            return None
+        _clients[kube_config_path] = (mtime, client)
+        return client
+
+def _close_clients():
+    with _clients_lock:
+        for _, client in _clients.values():
+            client.close()
+        _clients.clear()
+
+atexit.register(_close_clients)
@@ -1,21 +1,44 @@
-import os, json, yaml, logging, random, time
+import os, json, yaml, logging, random, time, tempfile
 from .kubectl_command import run_with_timeout
+from .api_client import get_kube_client
+
+WARM_POD_NAMESPACE = "dku-network-probe"
+WARM_POD_NAME_PREFIX = "busybox-warm-"
+WARM_POD_LABEL = "dataiku.com/network-probe"
+WARM_POD_IDLE_EXPIRY = 3600 # seconds
 
 class BusyboxPod(object):
-    def __init__(self, kube_config_path):
+    """
+    A busybox pod to run network checks from inside the cluster.
+
+    In warm mode, a labelled long-lived pod in a dedicated namespace is reused across runs. It is
+    checked for liveness before use, and exits by itself after idle_expiry seconds without use. Each
+    run that finds no running warm pod creates its own, with a unique name, so that concurrent runs
+    never delete or replace a pod another run is starting or using.
+    """
+    def __init__(self, kube_config_path, warm=False, idle_expiry=WARM_POD_IDLE_EXPIRY, node_name=None, start_timeout=10):
         self.env = os.environ.copy()
         self.env['KUBECONFIG'] = kube_config_path
+        self.client = get_kube_client(kube_config_path)
+        self.warm = warm
+        self.idle_expiry = idle_expiry
+        self.node_name = node_name
+        self.start_timeout = start_timeout
         uid = ''.join([random.choice('abcdefghijklmnopqrstuvwxyz0123456789') for i in range(0,8)])
-        self.pod_name = "busybox-" + uid
-        
-    def __enter__(self):
-        # create pod
+        if warm:
+            self.namespace = WARM_POD_NAMESPACE
+            self.pod_name = WARM_POD_NAME_PREFIX + uid
+        else:
+            self.namespace = "default"
+            self.pod_name = "busybox-" + uid
+
+    def _get_pod_yaml(self):
         pod_yaml = {
             "apiVersion": "v1",
             "kind": "Pod",
             "metadata": {
                 "name": self.pod_name,
-                "namespace": "default"
+                "namespace": self.namespace
             },
             "spec": {
                 "containers": [
@@ -29,47 +52,168 @@ class BusyboxPod(object):
                 "restartPolicy": "Always"
             }
         }
-        pod_file_path = 'busybox_pod.yaml'
-        with open(pod_file_path, "w") as f:
-            yaml.safe_dump(pod_yaml, f)
-
-        cmd = ['kubectl', 'create', '-f', os.path.abspath(pod_file_path)]
-        logging.info("Create pod with : %s" % json.dumps(cmd))
-        run_with_timeout(cmd, env=self.env, timeout=5)
-        
+        if self.node_name is not None:
+            # pin the pod on the node, whatever its taints
+            pod_yaml["spec"]["nodeName"] = self.node_name
+            pod_yaml["spec"]["tolerations"] = [{"operator": "Exists"}]
+        if self.warm:
+            # the pod stops by itself when /tmp/last-used hasn't been touched for a while
+            idle_loop = "touch /tmp/last-used; while [ $(( $(date +%s) - $(stat -c %Y /tmp/last-used) )) -lt {} ]; do sleep 30; done".format(int(self.idle_expiry))
+            pod_yaml["metadata"]["labels"] = {WARM_POD_LABEL: "busybox"}
+            pod_yaml["spec"]["containers"][0]["command"] = ["sh", "-c", idle_loop]
+            pod_yaml["spec"]["restartPolicy"] = "Never"
+        return pod_yaml
+
+    def _apply(self, obj):
+        if self.client is not None:
+            self.client.apply(obj, timeout=5)
+        else:
+            with tempfile.NamedTemporaryFile("w", suffix=".yaml", delete=False) as f:
+                yaml.safe_dump(obj, f)
+            try:
+                cmd = ['kubectl', 'apply', '-f', f.name]
+                logging.info("Apply with : %s" % json.dumps(cmd))
+                run_with_timeout(cmd, env=self.env, timeout=5)
+            finally:
+                os.remove(f.name)
+
+    def _list_warm_pods(self):
+        label_selector = '%s=busybox' % WARM_POD_LABEL
+        if self.client is not None:
+            return self.client.get('v1', 'Pod', namespace=self.namespace, label_selector=label_selector, timeout=5).get('items', [])
+        cmd = ['kubectl', 'get', 'pods', '-n', self.namespace, '-l', label_selector, '-o', 'json']
+        logging.info("List warm probe pods with : %s" % json.dumps(cmd))
+        out, err = run_with_timeout(cmd, env=self.env, timeout=5)
+        return json.loads(out).get('items', [])
+
+    def _reuse_warm_pod(self):
+        """
+        Take over a running warm pod, newest first. Pods that are still starting may belong to a
+        concurrent run and are left alone, the ones that expired or failed are cleaned up.
+        """
+        own_pod_name = self.pod_name
+        try:
+            pods = self._list_warm_pods()
+        except Exception as e:
+            logging.info("No warm probe pod found (%s)" % str(e))
+            return False
+        pods = sorted(pods, key=lambda pod: pod.get('metadata', {}).get('creationTimestamp', ''), reverse=True)
+        for pod in pods:
+            self.pod_name = pod['metadata']['name']
+            pod_state = pod.get('status', {}).get('phase', '').lower()
+            if pod_state in ('succeeded', 'failed'):
+                logging.info("Warm probe pod %s is %s, removing it" % (self.pod_name, pod_state))
+                self.delete_pod()
+                continue
+            if pod_state != 'running':
+                logging.info("Warm probe pod %s is %s, leaving it to the run that started it" % (self.pod_name, pod_state))
+                continue
+            try:
+                # liveness check, also resets the idle expiry of the pod
+                self.exec_cmd(['touch', '/tmp/last-used'])
+                logging.info("Reusing warm probe pod %s/%s" % (self.namespace, self.pod_name))
+                return True
+            except Exception as e:
+                logging.info("Warm probe pod %s is not responsive (%s)" % (self.pod_name, str(e)))
+        self.pod_name = own_pod_name
+        return False
+
+    def __enter__(self):
+        if self.warm:
+            if self._reuse_warm_pod():
+                return self
+            self._apply({"apiVersion": "v1", "kind": "Namespace", "metadata": {"name": self.namespace}})
+
+        # create pod
+        pod_yaml = self._get_pod_yaml()
+        logging.info("Create pod %s" % self.pod_name)
+        # through a temp file with kubectl, pods can be created from several threads
+        self._apply(pod_yaml)
+
         # wait for it to actually run (could be stuck in pending if no resource available)
-        waited = 0
-        pod_state = self.get_pod_state()
-        while pod_state != 'running' and waited < 10:
-            time.sleep(1)
-            waited += 1
-            pod_state = self.get_pod_state()
-        
-        if pod_state != 'running':
+        if not self.wait_for_running(timeout=self.start_timeout):
             self.delete_pod()
-            raise Exception('Busybox did not start in 10s')
-            
+            raise Exception('Busybox did not start in %ss' % self.start_timeout)
+
         return self
-    
+
+    def wait_for_running(self, timeout=10):
+        """
+        Wait for the pod to be running, by watching its phase instead of polling it.
+        """
+        if self.client is None:
+            cmd = ['kubectl', 'wait', '-n', self.namespace, 'pod/%s' % self.pod_name, '--for=condition=Ready', '--timeout=%ss' % int(timeout)]
+            logging.info("Wait for pod with : %s" % json.dumps(cmd))
+            try:
+                run_with_timeout(cmd, env=self.env, timeout=timeout + 5)
+                return True
+            except Exception as e:
+                logging.info("Pod did not become ready: %s" % str(e))
+                return False
+
+        deadline = time.time() + timeout
+        if self.get_pod_state() == 'running':
+            return True
+        while time.time() < deadline:
+            for event_type, pod in self.client.watch('v1', 'Pod', namespace=self.namespace,
+                                                     field_selector='metadata.name=%s' % self.pod_name,
+                                                     timeout_seconds=max(1, deadline - time.time())):
+                phase = pod.get('status', {}).get('phase', '').lower()
+                logging.info("Pod %s is %s" % (self.pod_name, phase))
+                if phase == 'running':
+                    return True
+                if event_type == 'DELETED' or phase in ('failed', 'succeeded'):
+                    return False
+        return False
+
     def get_pod_state(self):
-        cmd = ['kubectl', 'get', 'pod', self.pod_name, '-o', 'json']
+        if self.client is not None:
+            pod = self.client.get('v1', 'Pod', self.pod_name, namespace=self.namespace, timeout=5)
+            return pod['status']['phase'].lower()
+        cmd = ['kubectl', 'get', 'pod', '-n', self.namespace, self.pod_name, '-o', 'json']
         logging.info("Poll pod state with : %s" % json.dumps(cmd))
         out, err = run_with_timeout(cmd, env=self.env, timeout=5)
         return json.loads(out)['status']['phase'].lower()
 
-    def delete_pod(self):
-        cmd = ['kubectl', 'delete', 'pods', self.pod_name]
+    def delete_pod(self, wait=False):
+        if self.client is not None:
+            logging.info("Delete pod %s" % self.pod_name)
+            try:
+                pod = self.client.delete('v1', 'Pod', self.pod_name, namespace=self.namespace, timeout=3)
+                # a Status instead of the Pod means it's already gone
+                if wait and pod is not None and pod.get('kind') == 'Pod':
+                    # watch from the version of the deletion, so that a pod gone before the watch opens isn't missed
+                    resource_version = pod.get('metadata', {}).get('resourceVersion')
+                    for event_type, _ in self.client.watch('v1', 'Pod', namespace=self.namespace,
+                                                           field_selector='metadata.name=%s' % self.pod_name,
+                                                           timeout_seconds=30, resource_version=resource_version):
+                        if event_type == 'DELETED':
+                            break
+                        if event_type == 'ERROR':
+                            # eg. the version is already compacted, only able to check once
+                            if self.client.get('v1', 'Pod', self.pod_name, namespace=self.namespace, ignore_not_found=True, timeout=3) is not None:
+                                logging.warn("Unable to watch the deletion of pod %s" % self.pod_name)
+                            break
+            except Exception as e:
+                logging.warn("Failed to delete pod %s: %s" % (self.pod_name, str(e)))
+            return
+        cmd = ['kubectl', 'delete', 'pods', '-n', self.namespace, self.pod_name]
         logging.info("Delete pod with : %s" % json.dumps(cmd))
-        run_with_timeout(cmd, env=self.env, timeout=3, nokill=True) # fire and forget
-    
+        if wait:
+            run_with_timeout(cmd + ['--ignore-not-found', '--wait=true'], env=self.env, timeout=30, nokill=True)
+        else:
+            run_with_timeout(cmd, env=self.env, timeout=3, nokill=True) # fire and forget
+
     def __exit__(self, exc_type, exc_val, exc_tb):
+        if self.warm:
+            logging.info("Keeping warm probe pod %s/%s for later runs" % (self.namespace, self.pod_name))
+            return False
         self.delete_pod()
         logging.info("Exited busybox")
         return False
-    
+
     def exec_cmd(self, cmd, timeout=5):
-        kcmd = ['kubectl', 'exec', self.pod_name, '--'] + cmd
+        kcmd = ['kubectl', 'exec', '-n', self.namespace, self.pod_name, '--'] + cmd
         logging.info("Execute in pod with : %s" % json.dumps(kcmd))
         out, err = run_with_timeout(kcmd, env=self.env, timeout=timeout)
         return out, err
-    
\ No newline at end of file
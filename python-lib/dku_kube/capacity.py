@@ -0,0 +1,306 @@
+import os, re, json, logging
+
+from .kubectl_command import run_with_timeout
+from .api_client import get_kube_client
+from .nodes import get_nodes, get_node_pool, get_node_zone, is_node_ready
+
+GPU_RESOURCE = "nvidia.com/gpu"
+# pods is the max-pods of a node in allocatable, and 1 per pod in requests
+RESOURCES = ["cpu", "memory", "gpu", "pods"]
+# conditions for which status True is the healthy state
+HEALTHY_WHEN_TRUE_CONDITIONS = set(["Ready"])
+
+_CPU_PATTERN = re.compile(r'^([0-9.]+)(m?)$')
+_MEMORY_PATTERN = re.compile(r'^([0-9.]+(?:[eE][0-9]+)?)([KMGTPE]i?|[kmu]|)$')
+_MEMORY_UNITS = {"": 1, "k": 1e3, "K": 1e3, "M": 1e6, "G": 1e9, "T": 1e12, "P": 1e15, "E": 1e18,
+                 "Ki": 2**10, "Mi": 2**20, "Gi": 2**30, "Ti": 2**40, "Pi": 2**50, "Ei": 2**60, "m": 1e-3, "u": 1e-6}
+
+
+def parse_cpu(quantity):
+    """
+    Kubernetes cpu quantity ('500m', '2', '0.5') to millicores.
+    """
+    if quantity is None:
+        return 0
+    m = _CPU_PATTERN.match(str(quantity))
+    if m is None:
+        logging.warn("Unable to parse cpu quantity %s" % quantity)
+        return 0
+    value = float(m.group(1))
+    return int(round(value if m.group(2) == 'm' else value * 1000))
+
+
+def parse_memory(quantity):
+    """
+    Kubernetes memory quantity ('512Mi', '1G', '1073741824') to bytes.
+    """
+    if quantity is None:
+        return 0
+    m = _MEMORY_PATTERN.match(str(quantity))
+    if m is None:
+        logging.warn("Unable to parse memory quantity %s" % quantity)
+        return 0
+    return int(float(m.group(1)) * _MEMORY_UNITS[m.group(2)])
+
+
+def empty_resources():
+    return {k: 0 for k in RESOURCES}
+
+
+def parse_resources(resources):
+    resources = resources or {}
+    return {"cpu": parse_cpu(resources.get("cpu")),
+            "memory": parse_memory(resources.get("memory")),
+            "gpu": int(resources.get(GPU_RESOURCE, 0) or 0),
+            "pods": int(resources.get("pods", 0) or 0)}
+
+
+def get_pod_requests(pod):
+    """
+    Resources requested by a pod, as the scheduler counts them: the sum over the containers, at
+    least the largest init container, plus the pod overhead.
+    """
+    spec = pod.get('spec', {})
+    total = empty_resources()
+    for container in spec.get('containers', []):
+        requests = parse_resources(container.get('resources', {}).get('requests'))
+        for k in total:
+            total[k] += requests[k]
+    for container in spec.get('initContainers', []):
+        requests = parse_resources(container.get('resources', {}).get('requests'))
+        for k in total:
+            total[k] = max(total[k], requests[k])
+    overhead = parse_resources(spec.get('overhead'))
+    for k in total:
+        total[k] += overhead[k]
+    total["pods"] = 1
+    return total
+
+
+def get_active_pods(kube_config_path, label_selector=None, timeout=30):
+    """
+    Return the pods of all namespaces that hold (or wait for) resources, ie. not terminated.
+    """
+    field_selector = 'status.phase!=Succeeded,status.phase!=Failed'
+    client = get_kube_client(kube_config_path)
+    if client is not None:
+        pods = client.get('v1', 'Pod', label_selector=label_selector, field_selector=field_selector, timeout=timeout)
+    else:
+        env = os.environ.copy()
+        env['KUBECONFIG'] = kube_config_path
+        cmd = ['kubectl', 'get', 'pods', '--all-namespaces', '-o', 'json', '--field-selector', field_selector]
+        if label_selector is not None:
+            cmd += ['-l', label_selector]
+        out, _ = run_with_timeout(cmd, env=env, timeout=timeout)
+        pods = json.loads(out)
+    return pods.get('items', [])
+
+
+def is_pod_pending(pod):
+    return pod.get('status', {}).get('phase') == 'Pending' and pod.get('spec', {}).get('nodeName') is None
+
+
+def get_pod_target_pool(pod):
+    """
+    The node pool a pending pod is explicitly pinned to with a node selector, if any.
+    """
+    node_selector = pod.get('spec', {}).get('nodeSelector', {}) or {}
+    return node_selector.get('kubernetes.azure.com/agentpool', node_selector.get('agentpool'))
+
+
+def get_node_problems(node):
+    """
+    Conditions of the node that are not in their healthy state.
+    """
+    problems = []
+    for condition in node.get('status', {}).get('conditions', []):
+        healthy = (condition.get('status') == 'True') == (condition.get('type') in HEALTHY_WHEN_TRUE_CONDITIONS)
+        if not healthy:
+            problems.append(condition.get('type'))
+    if node.get('spec', {}).get('unschedulable', False):
+        problems.append('Unschedulable')
+    return problems
+
+
+def get_nodes_usage(nodes, pods):
+    """
+    Join nodes and pods into one dict per node with its allocatable and requested resources.
+    """
+    usage = {}
+    for node in nodes:
+        name = node['metadata']['name']
+        usage[name] = {
+            "name": name,
+            "pool": get_node_pool(node),
+            "zone": get_node_zone(node),
+            "ready": is_node_ready(node),
+            "problems": get_node_problems(node),
+            "allocatable": parse_resources(node.get('status', {}).get('allocatable')),
+            "requested": empty_resources(),
+            "pods": 0
+        }
+    for pod in pods:
+        node_usage = usage.get(pod.get('spec', {}).get('nodeName'))
+        if node_usage is None:
+            continue
+        requests = get_pod_requests(pod)
+        for k in requests:
+            node_usage["requested"][k] += requests[k]
+        node_usage["pods"] += 1
+    return list(usage.values())
+
+
+def get_pools_usage(nodes_usage, pods):
+    """
+    Aggregate the nodes usage per node pool, with the pending pods of each pool (None for pods not pinned to a pool).
+    """
+    pools = {}
+    def get_pool(name):
+        if name not in pools:
+            pools[name] = {"pool": name, "nodes": 0, "ready": 0, "problems": {}, "pods": 0, "pending_pods": 0,
+                           "allocatable": empty_resources(), "requested": empty_resources()}
+        return pools[name]
+    for node_usage in nodes_usage:
+        pool = get_pool(node_usage["pool"])
+        pool["nodes"] += 1
+        pool["ready"] += 1 if node_usage["ready"] else 0
+        pool["pods"] += node_usage["pods"]
+        for problem in node_usage["problems"]:
+            pool["problems"][problem] = pool["problems"].get(problem, 0) + 1
+        for k in pool["allocatable"]:
+            pool["allocatable"][k] += node_usage["allocatable"][k]
+            pool["requested"][k] += node_usage["requested"][k]
+    for pod in pods:
+        if is_pod_pending(pod):
+            get_pool(get_pod_target_pool(pod))["pending_pods"] += 1
+    return pools
+
+
+def is_daemonset_pod(pod):
+    return any([owner.get('kind') == 'DaemonSet' for owner in pod.get('metadata', {}).get('ownerReferences', []) or []])
+
+
+def pack_pods(requests, node_capacity):
+    """
+    First-fit decreasing packing of pod requests on identical nodes.
+
+    Identical requests (typically the executors of a job) are placed together, so the cost is in
+    the number of distinct requests times the number of nodes, not in the number of pods.
+
+    :param requests: list of {"cpu", "memory", "gpu", "pods"} dicts
+    :param node_capacity: {"cpu", "memory", "gpu", "pods"} dict of what a node can hold
+    :return: (number of nodes needed, number of pods that fit on no node)
+    """
+    keys = RESOURCES
+    counts = {}
+    for request in requests:
+        vector = tuple([request.get(k, 0) for k in keys])
+        counts[vector] = counts.get(vector, 0) + 1
+    capacity = [node_capacity.get(k, 0) for k in keys]
+
+    unplaceable = 0
+    nodes = [] # remaining room on each node
+    # biggest first, relative to the node size on the most constrained dimension
+    def dominant_share(vector):
+        return max([float(v) / c if c > 0 else (float('inf') if v > 0 else 0) for v, c in zip(vector, capacity)])
+    for vector in sorted(counts.keys(), key=dominant_share, reverse=True):
+        remaining = counts[vector]
+        if any([v > c for v, c in zip(vector, capacity)]):
+            unplaceable += remaining
+            continue
+        def fits(room):
+            return min([room[i] // vector[i] if vector[i] > 0 else remaining for i in range(len(keys))])
+        for room in nodes:
+            if remaining == 0:
+                break
+            placed = min(remaining, fits(room))
+            for i in range(len(keys)):
+                room[i] -= placed * vector[i]
+            remaining -= placed
+        while remaining > 0:
+            room = list(capacity)
+            placed = min(remaining, fits(room))
+            for i in range(len(keys)):
+                room[i] -= placed * vector[i]
+            remaining -= placed
+            nodes.append(room)
+    return len(nodes), unplaceable
+
+
+def recommend_pool_size(pool_name, nodes, pods, target_utilization=0.8, include_unpinned_pending=False, vm_size_resources=None):
+    """
+    Size a node pool for the pods running on it and the pods waiting for it.
+
+    DaemonSet pods run on every node, so their requests are taken out of the room of each node
+    rather than packed. Node room is the allocatable of the pool's nodes times target_utilization.
+    A pool without nodes (eg. scaled to 0) falls back to vm_size_resources, the size of its VMs, which
+    is a bit more than what kubernetes can allocate on them.
+
+    :return: dict with the needed node counts and the figures behind them, to show to the user
+    """
+    pool_nodes = [node for node in nodes if get_node_pool(node) == pool_name]
+    if len(pool_nodes) == 0 and vm_size_resources is None:
+        raise Exception("Node pool %s has no node to sample the allocatable resources from" % pool_name)
+    pool_node_names = set([node['metadata']['name'] for node in pool_nodes])
+    allocatable = empty_resources()
+    if len(pool_nodes) == 0:
+        logging.info("Node pool %s has no node, using the size of its VMs" % pool_name)
+        allocatable.update(vm_size_resources)
+    for node in pool_nodes:
+        node_allocatable = parse_resources(node.get('status', {}).get('allocatable'))
+        for k in allocatable:
+            allocatable[k] = max(allocatable[k], node_allocatable[k])
+
+    daemonset_overhead = empty_resources()
+    daemonset_overhead_node = None
+    running, pending, unpinned_pending = [], [], 0
+    for pod in pods:
+        node_name = pod.get('spec', {}).get('nodeName')
+        if node_name in pool_node_names:
+            if is_daemonset_pod(pod):
+                # count the daemonsets of one node, they are the same on all nodes of the pool
+                if daemonset_overhead_node is None:
+                    daemonset_overhead_node = node_name
+                if node_name == daemonset_overhead_node:
+                    requests = get_pod_requests(pod)
+                    for k in daemonset_overhead:
+                        daemonset_overhead[k] += requests[k]
+            else:
+                running.append(get_pod_requests(pod))
+        elif is_pod_pending(pod):
+            target_pool = get_pod_target_pool(pod)
+            if target_pool == pool_name:
+                pending.append(get_pod_requests(pod))
+            elif target_pool is None:
+                unpinned_pending += 1
+                if include_unpinned_pending:
+                    pending.append(get_pod_requests(pod))
+
+    node_capacity = {}
+    for k in allocatable:
+        # the gpu and pods counts are hard limits, no headroom to keep on them
+        node_capacity[k] = int((allocatable[k] - daemonset_overhead[k]) * (target_utilization if k in ("cpu", "memory") else 1))
+    if allocatable["pods"] == 0:
+        logging.warn("Max pods per node of node pool %s is unknown, not packing on it" % pool_name)
+        node_capacity["pods"] = len(running) + len(pending)
+    running_nodes, running_unplaceable = pack_pods(running, node_capacity)
+    all_nodes, all_unplaceable = pack_pods(running + pending, node_capacity)
+    demand = empty_resources()
+    for request in running + pending:
+        for k in demand:
+            demand[k] += request[k]
+    return {
+        "pool": pool_name,
+        "current_nodes": len(pool_nodes),
+        "node_allocatable": allocatable,
+        "daemonset_overhead": daemonset_overhead,
+        "node_capacity": node_capacity,
+        "target_utilization": target_utilization,
+        "running_pods": len(running),
+        "pending_pods": len(pending),
+        "unpinned_pending_pods": unpinned_pending,
+        "demand": demand,
+        "nodes_for_running": max(1, running_nodes),
+        "nodes_for_all": max(1, all_nodes),
+        "unplaceable_pods": all_unplaceable
+    }
@@ -1,5 +1,6 @@
-import os, json, yaml, logging
+import os, re, hashlib, logging
 from dku_utils.access import _has_not_blank_property
+from dku_utils.cache import get_state_dir, write_atomically
 
 def get_first_kube_config(kube_config_path=None):
     if kube_config_path is None:
@@ -9,41 +10,31 @@ def get_first_kube_config(kube_config_path=None):
             kube_config_path = os.path.join(os.environ['HOME'], '.kube', 'config')
     return kube_config_path
 
-def merge_or_write_config(config, kube_config_path=None):
-    kube_config_path = get_first_kube_config(kube_config_path)
-    
-    if os.path.exists(kube_config_path):
-        logging.info("A kube config exists at %s => merging" % kube_config_path)
-        with open(kube_config_path, "r") as f:
-            existing = yaml.safe_load(f)
-        for k in ['users', 'clusters', 'contexts']:
-            elements = existing.get(k, [])
-            existing[k] = elements
-            new_elements = config.get(k, [])
-            for new_element in new_elements:
-                name = new_element.get("name", "")
-                element_idx = None
-                for i in range(0, len(elements)):
-                    if elements[i].get("name", None) == name:
-                        element_idx = i
-                logging.info("  %s > %s : %s" % (k, name, 'replace' if element_idx is not None else 'append'))
-                if element_idx is not None:
-                    elements[element_idx] = new_element
-                else:
-                    elements.append(new_element)
-        """
-        if len(config.get("current-context", "")) > 0:
-            current_context = config.get("current-context")
-            logging.info("Setting current context to %s" % current_context)
-            existing["current-context"] = current_context
-        """
-        
-        logging.info("Final state is %s" % json.dumps(existing, indent=2))
-            
-        with open(kube_config_path, "w") as f:
-            yaml.safe_dump(existing, f)
-    else:
-        logging.info("No kube config file found at %s => writing" % kube_config_path)
+def get_kube_config_dir():
+    """
+    Folder of the per-cluster kube config files, under DIP_HOME.
+    """
+    kube_config_dir = get_state_dir("kube-configs")
+    if kube_config_dir is None:
+        raise Exception("Unable to use a folder for the kube config files under DIP_HOME (%s)" % os.environ.get("DIP_HOME", "not set"))
+    return kube_config_dir
+
+def get_kube_config_fragment_path(cluster_id):
+    # readable and unique file name, whatever characters the DSS cluster id has
+    safe_id = re.sub(r'[^A-Za-z0-9_.-]', '_', cluster_id)
+    return os.path.join(get_kube_config_dir(), "%s-%s.yaml" % (safe_id, hashlib.sha1(cluster_id.encode("utf8")).hexdigest()[:8]))
 
-        with open(kube_config_path, "w") as f:
-            yaml.safe_dump(config, f)
+def write_kube_config_fragment(cluster_id, kube_config_content):
+    """
+    Write the kube config of one cluster in its own file, so that clusters starting at the same time don't contend.
+    """
+    kube_config_path = get_kube_config_fragment_path(cluster_id)
+    logging.info("Writing kubeconfig file %s" % kube_config_path)
+    write_atomically(kube_config_path, kube_config_content, private=True)
+    return kube_config_path
+
+def remove_kube_config_fragment(cluster_id):
+    kube_config_path = get_kube_config_fragment_path(cluster_id)
+    if os.path.exists(kube_config_path):
+        logging.info("Removing kubeconfig file %s" % kube_config_path)
+        os.remove(kube_config_path)
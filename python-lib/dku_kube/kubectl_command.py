@@ -1,31 +1,58 @@
-import subprocess, time
+import subprocess, time, logging
 
 class KubeCommandException(Exception):
     def __init__(self, message, out, err):
         super(KubeCommandException, self).__init__(message)
         self.out = out
         self.err = err
-        
-def run_with_timeout(cmd, env=None, timeout=3, nokill=False):
+
+
+class KubeCommandResult(object):
+    """
+    Outcome of one command: exit code, duration and outputs.
+    """
+    def __init__(self, cmd):
+        self.cmd = cmd
+        self.returncode = None
+        self.out = None
+        self.err = None
+        self.duration = None
+        self.timed_out = False
+
+
+def run_command(cmd, env=None, timeout=3, nokill=False):
+    """
+    Run a command and wait for its completion, without polling.
+    """
+    result = KubeCommandResult(cmd)
+    start = time.time()
     p = subprocess.Popen(cmd,
                          stdout=subprocess.PIPE,
                          stderr=subprocess.PIPE,
                          env=env,
                          universal_newlines=True)
-    waited = 0
-    while waited < timeout and p.poll() is None:
-        time.sleep(1)
-        waited += 1
-    if p.poll() is None:
+    try:
+        result.out, result.err = p.communicate(timeout=timeout)
+    except subprocess.TimeoutExpired:
+        result.timed_out = True
+        result.duration = time.time() - start
+        if not nokill:
+            p.kill()
+            p.communicate()
+        return result
+    result.duration = time.time() - start
+    result.returncode = p.returncode
+    logging.debug("Command %s finished in %.3fs with %s" % (cmd[:3], result.duration, result.returncode))
+    return result
+
+
+def run_with_timeout(cmd, env=None, timeout=3, nokill=False):
+    result = run_command(cmd, env=env, timeout=timeout, nokill=nokill)
+    if result.timed_out:
         if nokill:
             return None, None
         else:
-            p.kill()
             raise Exception("Process did not finish after %s" % timeout)
-    out, err = p.communicate()
-    rv = p.wait()
-    if rv != 0:
-        raise KubeCommandException("Command failed with %s" % rv, out, err)
-    return out, err
-
-
+    if result.returncode != 0:
+        raise KubeCommandException("Command failed with %s" % result.returncode, result.out, result.err)
+    return result.out, result.err
@@ -0,0 +1,88 @@
+import re, time, logging, ipaddress
+from concurrent.futures import ThreadPoolExecutor
+from six import text_type
+
+from .busybox_pod import BusyboxPod
+from .kubectl_command import KubeCommandException
+from .nodes import get_nodes, get_node_pool, get_node_zone
+
+DEFAULT_MAX_WORKERS = 20
+PINNED_POD_START_TIMEOUT = 60 # seconds, the image may have to be pulled on each node
+
+
+def parse_nslookup_ip(out):
+    ip = None
+    for line in out.split('\n'):
+        m = re.match('^Address.*\\s([0-9]+\\.[0-9]+\\.[0-9]+\\.[0-9]+[^\\s]*)\\s.*$', line)
+        if m is not None:
+            ip = m.group(1)
+    return ip
+
+
+def list_nodes(kube_config_path):
+    """
+    Return the nodes of the cluster as dicts with name, pool and zone.
+    """
+    return [{"name": node['metadata']['name'], "pool": get_node_pool(node), "zone": get_node_zone(node)} for node in get_nodes(kube_config_path)]
+
+
+def select_probe_nodes(nodes, scope):
+    """
+    scope is 'node' (every node) or 'pool-zone' (one node per node pool and zone).
+    """
+    if scope == 'node':
+        return nodes
+    selected = {}
+    for node in nodes:
+        selected.setdefault((node["pool"], node["zone"]), node)
+    return list(selected.values())
+
+
+def probe_from_pod(busybox, host, port):
+    """
+    Resolve host and connect to port from inside the pod, with latencies.
+    """
+    result = {"resolved_ip": None, "resolve_latency": None, "connect_latency": None, "ok": False, "error": None}
+    try:
+        ip = text_type(ipaddress.ip_address(host))
+    except ValueError:
+        start = time.time()
+        out, err = busybox.exec_cmd(['nslookup', host])
+        result["resolve_latency"] = round(time.time() - start, 3)
+        ip = parse_nslookup_ip(out)
+        if ip is None:
+            raise Exception('Hostname resolution of DSS node failed: %s' % out)
+    result["resolved_ip"] = ip
+    start = time.time()
+    out, err = busybox.exec_cmd(['nc', '-vz', ip, str(port), '-w', '5'], timeout=10)
+    result["connect_latency"] = round(time.time() - start, 3)
+    if 'no route to host' in err.lower():
+        raise Exception("DSS node resolved but unreachable on port %s : %s" % (str(port), err))
+    result["ok"] = True
+    return result
+
+
+def probe_nodes(kube_config_path, host, port, scope='node', max_workers=DEFAULT_MAX_WORKERS):
+    """
+    Run the connectivity probe from a pod pinned on each selected node, all at once.
+    """
+    nodes = select_probe_nodes(list_nodes(kube_config_path), scope)
+    logging.info("Probing connectivity to %s:%s from %s nodes" % (host, port, len(nodes)))
+
+    def probe_node(node):
+        row = dict(node)
+        start = time.time()
+        try:
+            with BusyboxPod(kube_config_path, node_name=node["name"], start_timeout=PINNED_POD_START_TIMEOUT) as b:
+                row["pod_start_latency"] = round(time.time() - start, 3)
+                row.update(probe_from_pod(b, host, port))
+        except KubeCommandException as e:
+            row.update({"ok": False, "error": "%s %s" % (str(e), e.err)})
+        except Exception as e:
+            row.update({"ok": False, "error": str(e)})
+        return row
+
+    if len(nodes) == 0:
+        return []
+    with ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(nodes)))) as executor:
+        return list(executor.map(probe_node, nodes))
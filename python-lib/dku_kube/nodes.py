@@ -0,0 +1,56 @@
+import os, json, logging
+
+from .kubectl_command import run_with_timeout
+from .api_client import get_kube_client
+
+AGENT_POOL_LABELS = ["kubernetes.azure.com/agentpool", "agentpool"]
+ZONE_LABELS = ["topology.kubernetes.io/zone", "failure-domain.beta.kubernetes.io/zone"]
+
+
+def _first_label(labels, keys):
+    for key in keys:
+        if key in labels:
+            return labels[key]
+    return None
+
+
+def get_nodes(kube_config_path, label_selector=None, timeout=10):
+    """
+    Return the raw node objects of the cluster.
+    """
+    client = get_kube_client(kube_config_path)
+    if client is not None:
+        nodes = client.get('v1', 'Node', label_selector=label_selector, timeout=timeout)
+    else:
+        env = os.environ.copy()
+        env['KUBECONFIG'] = kube_config_path
+        cmd = ['kubectl', 'get', 'nodes', '-o', 'json']
+        if label_selector is not None:
+            cmd += ['-l', label_selector]
+        out, _ = run_with_timeout(cmd, env=env, timeout=timeout)
+        nodes = json.loads(out)
+    return nodes.get('items', [])
+
+
+def get_node_pool(node):
+    return _first_label(node.get('metadata', {}).get('labels', {}), AGENT_POOL_LABELS)
+
+
+def get_node_zone(node):
+    return _first_label(node.get('metadata', {}).get('labels', {}), ZONE_LABELS)
+
+
+def is_node_ready(node):
+    for condition in node.get('status', {}).get('conditions', []):
+        if condition.get('type') == 'Ready':
+            return condition.get('status') == 'True'
+    return False
+
+
+def count_ready_nodes(kube_config_path, node_pool_name):
+    """
+    Return (ready, total) node counts for a node pool.
+    """
+    nodes = get_nodes(kube_config_path, label_selector='kubernetes.azure.com/agentpool=%s' % node_pool_name, timeout=5)
+    ready = len([node for node in nodes if is_node_ready(node)])
+    return ready, len(nodes)
@@ -1,12 +1,83 @@
-import os, json, logging
+import os, json, logging, time
 import requests
 import yaml
 
 from .kubectl_command import run_with_timeout
+from .api_client import get_kube_client
 from dku_utils.access import _is_none_or_blank
+from dku_utils.cache import get_cache_dir, write_cache_file
 from dku_utils.taints import Toleration
 
+NVIDIA_DEVICE_PLUGIN_VERSION = "v0.17.0"
+NVIDIA_DEVICE_PLUGIN_URL = "https://raw.githubusercontent.com/NVIDIA/k8s-device-plugin/{version}/deployments/static/nvidia-device-plugin.yml"
+NVIDIA_DEVICE_PLUGIN_REVALIDATE_AFTER = 24 * 3600 # seconds
+NVIDIA_DAEMONSET_NAME = "nvidia-device-plugin-daemonset"
+BUNDLED_MANIFESTS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..", "resource", "nvidia")
+
+def _get_bundled_manifest(version):
+    bundled_path = os.path.join(BUNDLED_MANIFESTS_DIR, "nvidia-device-plugin-{}.yml".format(version))
+    if not os.path.exists(bundled_path):
+        return None
+    with open(bundled_path, "r") as f:
+        return f.read()
+
+def get_nvidia_device_plugin_manifest(version=NVIDIA_DEVICE_PLUGIN_VERSION):
+    """
+    Return the raw NVIDIA device plugin manifest for a pinned version.
+
+    The manifest is cached under DIP_HOME, seeded from the copy bundled with the plugin, and
+    revalidated against GitHub with its ETag once a day. Network failures fall back to the cache.
+    """
+    cache_dir = get_cache_dir("nvidia-device-plugin")
+    manifest_path = os.path.join(cache_dir, "{}.yml".format(version)) if cache_dir is not None else None
+    etag_path = os.path.join(cache_dir, "{}.etag".format(version)) if cache_dir is not None else None
+
+    manifest, etag = None, None
+    if manifest_path is not None and os.path.exists(manifest_path):
+        with open(manifest_path, "r") as f:
+            manifest = f.read()
+        if os.path.exists(etag_path):
+            with open(etag_path, "r") as f:
+                etag = f.read().strip()
+        if time.time() - os.path.getmtime(manifest_path) < NVIDIA_DEVICE_PLUGIN_REVALIDATE_AFTER:
+            logging.info("Using cached NVIDIA device plugin manifest %s" % version)
+            return manifest
+    if manifest is None:
+        manifest = _get_bundled_manifest(version)
+        if manifest is not None and manifest_path is not None:
+            logging.info("Seeding NVIDIA device plugin manifest cache with bundled %s" % version)
+            write_cache_file(manifest_path, manifest)
+
+    url = NVIDIA_DEVICE_PLUGIN_URL.format(version=version)
+    headers = {}
+    if not _is_none_or_blank(etag):
+        headers["If-None-Match"] = etag
+    try:
+        resp = requests.get(url, headers=headers, timeout=5)
+        if resp.status_code == 304:
+            logging.info("Cached NVIDIA device plugin manifest %s is up to date" % version)
+            if manifest_path is not None:
+                os.utime(manifest_path, None)
+            return manifest
+        resp.raise_for_status()
+        manifest = resp.text
+        if manifest_path is not None:
+            write_cache_file(manifest_path, manifest)
+            if not _is_none_or_blank(resp.headers.get("ETag", None)):
+                write_cache_file(etag_path, resp.headers["ETag"])
+        logging.info("Downloaded NVIDIA device plugin manifest %s" % version)
+    except Exception as e:
+        if manifest is None:
+            raise Exception("Unable to download the NVIDIA device plugin manifest %s from %s: %s" % (version, url, str(e)))
+        logging.warn("Unable to revalidate the NVIDIA device plugin manifest, using the cached one: %s" % str(e))
+    return manifest
+
 def has_gpu_driver(kube_config_path):
+    client = get_kube_client(kube_config_path)
+    if client is not None:
+        logging.info("Checking if NVIDIA GPU drivers are installed")
+        pods = client.get('v1', 'Pod', namespace='kube-system', label_selector='name=nvidia-device-plugin-ds', timeout=5)
+        return len(pods.get('items', [])) > 0
     env = os.environ.copy()
     env['KUBECONFIG'] = kube_config_path
     cmd = ['kubectl', 'get', 'pods', '--namespace', 'kube-system', '-l', 'name=nvidia-device-plugin-ds', '--ignore-not-found']
@@ -14,47 +85,90 @@ def has_gpu_driver(kube_config_path):
     out, err = run_with_timeout(cmd, env=env, timeout=5)
     return len(out.strip()) > 0
 
-def add_gpu_driver_if_needed(kube_config_path, cluster_id, taints):
+def _get_pod_spec(daemonset):
+    return (daemonset or {}).get("spec", {}).get("template", {}).get("spec", {})
+
+def _get_images(daemonset):
+    return sorted([container.get("image", None) for container in _get_pod_spec(daemonset).get("containers", [])])
+
+def _get_live_daemonset(client, env):
+    if client is not None:
+        return client.get("apps/v1", "DaemonSet", NVIDIA_DAEMONSET_NAME, namespace="kube-system", ignore_not_found=True, timeout=5)
+    cmd = ["kubectl", "get", "daemonset", NVIDIA_DAEMONSET_NAME, "-n", "kube-system", "-o", "json", "--ignore-not-found"]
+    logging.info("Retrieving NVIDIA GPU driver daemonset with : %s" % json.dumps(cmd))
+    out, err = run_with_timeout(cmd, env=env, timeout=5)
+    if _is_none_or_blank(out):
+        return None
+    return json.loads(out)
+
+def describe_gpu_driver_summary(summary):
+    """
+    One line for users about what add_gpu_driver_if_needed did.
+    """
+    actions = {"skipped": "already installed with the required tolerations",
+               "patched": "tolerations updated",
+               "applied": "installed"}
+    message = "GPU driver %s" % actions.get(summary.get("action"), summary.get("action"))
+    added_tolerations = summary.get("added_tolerations", [])
+    if len(added_tolerations) > 0:
+        def describe(toleration):
+            description = toleration.get("key") or "*"
+            if toleration.get("value"):
+                description += "=" + toleration["value"]
+            if toleration.get("effect"):
+                description += ":" + toleration["effect"]
+            return description
+        message += ", tolerations added: %s" % ", ".join([describe(t) for t in added_tolerations])
+    return message
+
+def add_gpu_driver_if_needed(kube_config_path, cluster_id, taints, force_apply=False):
+    """
+    Install the NVIDIA device plugin, or update its tolerations to cover the taints of GPU node pools.
+
+    The desired daemonset is compared with the live one first: nothing is done when the tolerations
+    and images already match, and only the tolerations are patched when the images match.
+    Return a summary of the action taken, see describe_gpu_driver_summary.
+
+    :param cluster_id: the id of the DSS cluster, whose DIP_HOME/clusters folder receives the applied manifest
+    """
     env = os.environ.copy()
     env['KUBECONFIG'] = kube_config_path
+    client = get_kube_client(kube_config_path)
 
-    # Get the Nvidia driver plugin configuration from the repository
-    nvidia_config_raw = requests.get(
-        "https://raw.githubusercontent.com/NVIDIA/k8s-device-plugin/main/deployments/static/nvidia-device-plugin.yml"
-    ).text
+    # Get the Nvidia driver plugin configuration, pinned and cached locally
+    nvidia_config_raw = get_nvidia_device_plugin_manifest()
     nvidia_config = yaml.safe_load(nvidia_config_raw)
     tolerations = set()
 
     # Get any tolerations from the plugin configuration
-    if (
-        "spec" in nvidia_config
-        and "template" in nvidia_config["spec"]
-        and "spec" in nvidia_config["spec"]["template"]
-        and "tolerations" in nvidia_config["spec"]["template"]["spec"]
-    ):
-        tolerations.update(Toleration.from_dict(nvidia_config["spec"]["template"]["spec"]["tolerations"]))
+    tolerations.update(Toleration.from_dict(_get_pod_spec(nvidia_config).get("tolerations", None)))
 
     # Retrieve the tolerations on the daemonset currently deployed to the cluster.
-    if has_gpu_driver(kube_config_path):
-        cmd = [
-            "kubectl",
-            "get",
-            "daemonset",
-            "nvidia-device-plugin-daemonset",
-            "-n",
-            "kube-system",
-            "-o",
-            'jsonpath="{.spec.template.spec.tolerations}"',
-        ]
-        cmd_result, err = run_with_timeout(cmd, env=env, timeout=5)
-        tolerations_json = cmd_result[1:-1]
-        if not _is_none_or_blank(tolerations_json):
-            tolerations.update(Toleration.from_json(tolerations_json))
+    live_daemonset = _get_live_daemonset(client, env)
+    live_tolerations = set(Toleration.from_dict(_get_pod_spec(live_daemonset).get("tolerations", None)))
+    tolerations.update(live_tolerations)
 
     # If there are any taints to patch the daemonset with in the node group(s) to create,
     # we add them to the GPU plugin configuration before updating with another `kubectl apply`
     tolerations.update(Toleration.from_dict(taints))
 
+    added_tolerations = Toleration.to_list(tolerations - live_tolerations)
+    summary = {"action": None, "added_tolerations": added_tolerations}
+    if live_daemonset is not None and not force_apply and _get_images(live_daemonset) == _get_images(nvidia_config):
+        if len(added_tolerations) == 0:
+            logging.info("NVIDIA GPU driver is already installed with the required tolerations, nothing to do")
+            summary["action"] = "skipped"
+            return summary
+        logging.info("Patching NVIDIA GPU driver tolerations, adding %s" % json.dumps(added_tolerations))
+        patch = {"spec": {"template": {"spec": {"tolerations": Toleration.to_list(tolerations)}}}}
+        if client is not None:
+            client.patch("apps/v1", "DaemonSet", NVIDIA_DAEMONSET_NAME, patch, namespace="kube-system", timeout=5)
+        else:
+            cmd = ["kubectl", "patch", "daemonset", NVIDIA_DAEMONSET_NAME, "-n", "kube-system", "-p", json.dumps(patch)]
+            run_with_timeout(cmd, env=env, timeout=5)
+        summary["action"] = "patched"
+        return summary
+
     # Patch the Nvidia driver configuration with the tolerations derived from node group(s) taints,
     # initial Nvidia driver configuration tolerations and Nvidia daemonset tolerations (when applicable)
     if "spec" not in nvidia_config:
@@ -73,11 +187,16 @@ def add_gpu_driver_if_needed(kube_config_path, cluster_id, taints):
         yaml.safe_dump(nvidia_config, f)
 
     # Apply the patched Nvidia driver configuration to the cluster
-    cmd = ["kubectl", "apply", "-f", local_nvidia_plugin_config]
-    logging.info("Running command to install Nvidia drivers: %s", " ".join(cmd))
     logging.info(
         "NVIDIA GPU driver config: %s"
         % yaml.safe_dump(nvidia_config, default_flow_style=False)
     )
-
-    run_with_timeout(cmd, env=env, timeout=5)
+    if client is not None:
+        logging.info("Applying Nvidia drivers configuration")
+        client.apply(nvidia_config, timeout=5)
+    else:
+        cmd = ["kubectl", "apply", "-f", local_nvidia_plugin_config]
+        logging.info("Running command to install Nvidia drivers: %s", " ".join(cmd))
+        run_with_timeout(cmd, env=env, timeout=5)
+    summary["action"] = "applied"
+    return summary
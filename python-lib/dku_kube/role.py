@@ -1,15 +1,37 @@
 import os, subprocess, logging
-from dku_google.gcloud import get_account
 from dku_utils.access import _is_none_or_blank
+from .api_client import get_kube_client
+from .kubeconfig import get_first_kube_config
 
-def create_admin_binding(user_name=None, kube_config_path=None):
+def create_admin_binding(user_name, kube_config_path=None):
+    """
+    Bind the cluster-admin role to user_name, if no cluster-admin-binding exists yet.
+
+    user_name is required: it used to default to the account of the gcloud CLI, a leftover that can't
+    resolve on Azure (dku_google is not part of this plugin), so callers must now pass it explicitly.
+    """
     if _is_none_or_blank(user_name):
-        user_name = get_account()
-    
+        raise Exception("A user name is required to create the cluster admin binding")
+
+    client = get_kube_client(get_first_kube_config(kube_config_path))
+    if client is not None:
+        existing = client.get("rbac.authorization.k8s.io/v1", "ClusterRoleBinding", "cluster-admin-binding", ignore_not_found=True)
+        if existing is not None:
+            logging.info("Clusterrolebinding already exist")
+        else:
+            client.request("POST", "/apis/rbac.authorization.k8s.io/v1/clusterrolebindings", body={
+                "apiVersion": "rbac.authorization.k8s.io/v1",
+                "kind": "ClusterRoleBinding",
+                "metadata": {"name": "cluster-admin-binding"},
+                "roleRef": {"apiGroup": "rbac.authorization.k8s.io", "kind": "ClusterRole", "name": "cluster-admin"},
+                "subjects": [{"apiGroup": "rbac.authorization.k8s.io", "kind": "User", "name": user_name}]
+            })
+        return
+
     env = os.environ.copy()
     if not _is_none_or_blank(kube_config_path):
         env['KUBECONFIG'] = kube_config_path
-    out = subprocess.check_output(["kubectl", "get", "clusterrolebinding", "cluster-admin-binding", "--ignore-not-found"], env=env)
+    out = subprocess.check_output(["kubectl", "get", "clusterrolebinding", "cluster-admin-binding", "--ignore-not-found"], env=env, universal_newlines=True)
     if not _is_none_or_blank(out):
         logging.info("Clusterrolebinding already exist")
     else:
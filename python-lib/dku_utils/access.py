@@ -3,7 +3,7 @@ try:
     from collections.abc import Mapping, Iterable # py3
 except ImportError:
     from collections import Mapping, Iterable # py2
-import sys
+import sys, os, re
 import json
 
 if sys.version_info > (3,):
@@ -82,23 +82,55 @@ def _merge_objects(a, b):
     else:
         return a_orig
 
-def _object_to_json(o):
-    r = o
-    if hasattr(o, '__dict__'):
-        r = o.__dict__
-    if isinstance(r, dku_basestring_type):
+# Diagnostic serialization: a copy of the object graph as plain json types, with the secrets redacted
+# and the output capped. Nothing is computed until the log record is actually emitted.
+DIAGNOSTICS_MAX_SIZE = int(os.environ.get("DKU_AKS_DIAGNOSTICS_MAX_SIZE", "20000")) # characters
+DIAGNOSTICS_MAX_DEPTH = 20
+REDACTED = "**redacted**"
+_SECRET_KEY_PATTERN = re.compile(r'(secret|password|token|credential|private.?key)', re.IGNORECASE)
+
+def _object_to_json(o, _depth=0, _seen=None):
+    """
+    Plain json copy of an object graph, going through the __dict__ of objects. Doesn't modify o.
+    """
+    _seen = _seen if _seen is not None else set()
+    r = o.__dict__ if hasattr(o, '__dict__') else o
+    if r is None or isinstance(r, (dku_basestring_type, bool, int, float)):
         return r
+    if _depth >= DIAGNOSTICS_MAX_DEPTH or id(r) in _seen:
+        return "..."
+    if isinstance(r, Mapping):
+        _seen.add(id(r))
+        ret = {}
+        for field, value in r.items():
+            if isinstance(field, dku_basestring_type) and _SECRET_KEY_PATTERN.search(field) and value is not None:
+                ret[field] = REDACTED
+            else:
+                ret[str(field)] = _object_to_json(value, _depth + 1, _seen)
+        _seen.discard(id(r))
+        return ret
     if isinstance(r, Iterable):
-        if hasattr(r, 'keys'):
-            for field in r.keys():
-                r[field] = _object_to_json(r[field])
-            return r
-        else:
-            arr = []
-            for entry in r:
-                arr.append(_object_to_json(entry))
-            return arr
-    return r
+        _seen.add(id(r))
+        ret = [_object_to_json(entry, _depth + 1, _seen) for entry in r]
+        _seen.discard(id(r))
+        return ret
+    return str(r)
+
+def _print_as_json(o, max_size=None):
+    max_size = max_size or DIAGNOSTICS_MAX_SIZE
+    dumped = json.dumps(_object_to_json(o), default=str)
+    if len(dumped) > max_size:
+        return "%s... (%s more characters)" % (dumped[:max_size], len(dumped) - max_size)
+    return dumped
+
+class LazyJson(object):
+    """
+    Pass as a logging argument, ie. logging.info("Config: %s", LazyJson(o)), so that the
+    serialization only happens when the record is emitted.
+    """
+    def __init__(self, o, max_size=None):
+        self.o = o
+        self.max_size = max_size
 
-def _print_as_json(o):
-    return json.dumps(_object_to_json(o))
\ No newline at end of file
+    def __str__(self):
+        return _print_as_json(self.o, self.max_size)
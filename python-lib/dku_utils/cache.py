@@ -0,0 +1,61 @@
+import os, logging, threading
+
+from dku_utils.access import _is_none_or_blank
+
+CACHE_ROOT = ["caches", "aks-clusters"]
+STATE_ROOT = ["aks-clusters"]
+
+def _get_dip_home_dir(root, subdirs):
+    """
+    Return (and create) a folder under DIP_HOME, or None when DIP_HOME isn't set or the folder can't be created.
+    """
+    dip_home = os.environ.get("DIP_HOME", None)
+    if _is_none_or_blank(dip_home):
+        return None
+    folder = os.path.join(dip_home, *(root + list(subdirs)))
+    if not os.path.exists(folder):
+        try:
+            os.makedirs(folder)
+        except OSError as e:
+            if not os.path.isdir(folder):
+                logging.warn("Unable to create folder %s: %s" % (folder, str(e)))
+                return None
+    return folder
+
+def get_cache_dir(*subdirs):
+    """
+    Return (and create) a cache folder under DIP_HOME/caches, which can be purged at any time.
+    None when DIP_HOME isn't set, in which case caching is disabled.
+    """
+    return _get_dip_home_dir(CACHE_ROOT, subdirs)
+
+def get_state_dir(*subdirs):
+    """
+    Return (and create) a folder under DIP_HOME for files the plugin can't lose, ie. not a cache.
+    None when DIP_HOME isn't set.
+    """
+    return _get_dip_home_dir(STATE_ROOT, subdirs)
+
+def write_atomically(path, content, mode="w", private=False):
+    """
+    Write to a temp file next to path, then rename it, so that readers never see a partial file.
+    With private=True, the file is only readable by the current user.
+    """
+    tmp_path = "{}.{}-{}.tmp".format(path, os.getpid(), threading.current_thread().ident)
+    if private:
+        fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        f = os.fdopen(fd, mode)
+    else:
+        f = open(tmp_path, mode)
+    with f:
+        f.write(content)
+    os.rename(tmp_path, path)
+
+def write_cache_file(path, content, mode="w", private=False):
+    """
+    Same as write_atomically, but a cache that can't be written is only logged.
+    """
+    try:
+        write_atomically(path, content, mode, private=private)
+    except Exception as e:
+        logging.warn("Unable to write cache file %s, ignoring it: %s" % (path, str(e)))
@@ -1,10 +1,17 @@
-import json, logging
+import os, json, logging, hashlib, threading, time
 import dataiku
 from azure.mgmt.containerservice import ContainerServiceClient
 from dataiku.core.intercom import backend_json_call
+from dku_azure.clients import get_client
 from dku_azure.auth import get_credentials_from_connection_info, get_credentials_from_connection_infoV2
 from dku_azure.utils import get_subscription_id
 from dku_utils.access import _is_none_or_blank
+from dku_utils.cache import get_cache_dir, write_cache_file
+
+CLUSTER_SNAPSHOT_TTL = 30 # seconds during which a snapshot is served without calling ARM
+
+_cluster_snapshots = {}
+_cluster_snapshots_lock = threading.Lock()
 
 
 def make_overrides(config, kube_config, kube_config_path, acr_name=None):
@@ -34,32 +41,156 @@ def get_cluster_from_connection_info(config, plugin_config):
         connection_info_v2 = config.get("connectionInfoV2",{"identityType":"default"})
         credentials, _ = get_credentials_from_connection_infoV2(connection_info_v2)
         subscription_id = get_subscription_id(connection_info_v2)
-    clusters_client = ContainerServiceClient(credentials, subscription_id)
+    clusters_client = get_client(ContainerServiceClient, credentials, subscription_id)
     return clusters_client, connection_info, credentials
 
+def _is_not_found(e):
+    """
+    Whether a DSS public API call failed with a 404. The DataikuException of dataikuapi is raised
+    while handling the HTTPError of requests, which carries the response.
+    """
+    while e is not None:
+        response = getattr(e, "response", None)
+        if getattr(e, "status_code", None) == 404 or getattr(response, "status_code", None) == 404:
+            return True
+        e = e.__cause__ or e.__context__
+    return False
+
+def get_resolved_cluster_config(dss_cluster_settings):
+    """
+    Resolve the presets in the cluster settings, through the backend.
+
+    Not cached: the resolved settings hold secrets, and presets change without changing the cluster settings,
+    so a cache keyed on them would serve stale credentials.
+    """
+    raw_config = dss_cluster_settings.get_raw()['params']['config']
+    element_type = dss_cluster_settings.get_raw()['type']
+    # resolve since we get the config with the raw preset setup
+    return backend_json_call('plugins/get-resolved-settings', data={'elementConfig':json.dumps(raw_config), 'elementType':element_type})
+
 def get_cluster_from_dss_cluster(dss_cluster_id):
     # get the public API client
     client = dataiku.api_client()
 
-    # get the cluster object in DSS
-    found = False
-    for c in client.list_clusters():
-        if c['name'] == dss_cluster_id:
-            found = True
-    if not found:
-        raise Exception("DSS cluster %s doesn't exist" % dss_cluster_id)
+    # get the cluster object in DSS, directly (its settings can't be read if it doesn't exist)
     dss_cluster = client.get_cluster(dss_cluster_id)
+    try:
+        dss_cluster_settings = dss_cluster.get_settings()
+    except Exception as e:
+        if _is_not_found(e):
+            raise Exception("DSS cluster %s doesn't exist" % dss_cluster_id)
+        raise Exception("Unable to get the settings of DSS cluster %s: %s" % (dss_cluster_id, str(e)))
 
     # get the settings in it
-    dss_cluster_settings = dss_cluster.get_settings()
-    dss_cluster_config = dss_cluster_settings.get_raw()['params']['config']
-    # resolve since we get the config with the raw preset setup
-    dss_cluster_config = backend_json_call('plugins/get-resolved-settings', data={'elementConfig':json.dumps(dss_cluster_config), 'elementType':dss_cluster_settings.get_raw()['type']})
-    logging.info("Resolved cluster config : %s" % json.dumps(dss_cluster_config))
+    dss_cluster_config = get_resolved_cluster_config(dss_cluster_settings)
+    logging.info("Resolved cluster config with keys : %s" % sorted(dss_cluster_config.get("config", {}).keys()))
     # build the helper class from the cluster settings (the macro doesn't have the params)
     clusters, connection_info, credentials = get_cluster_from_connection_info(dss_cluster_config.get("config"), dss_cluster_config.get("pluginConfig"))
 
     cluster_data = dss_cluster_settings.get_plugin_data()
 
     return cluster_data, clusters, dss_cluster_settings, dss_cluster_config, connection_info, credentials
-    
+
+
+class ClusterSnapshot(object):
+    """
+    The AKS cluster and its agent pools, as read from ARM at some point in time.
+
+    Models are deserialized again on each access, so callers can modify them freely.
+    """
+    def __init__(self, clusters_client, data):
+        self.clusters_client = clusters_client
+        self.data = data
+        self.etag = data["etag"]
+        self.timestamp = data["timestamp"]
+
+    @property
+    def cluster(self):
+        return self.clusters_client.managed_clusters._deserialize("ManagedCluster", self.data["cluster"])
+
+    @property
+    def agent_pools(self):
+        return [self.clusters_client.agent_pools._deserialize("AgentPool", agent_pool) for agent_pool in self.data["agent_pools"]]
+
+
+def _get_cluster_version(cluster):
+    """
+    The ETag of the cluster, or a fingerprint of the node pools for API versions without ETag.
+    """
+    etag = getattr(cluster, "e_tag", None)
+    if not _is_none_or_blank(etag):
+        return etag
+    profiles = [profile.serialize(keep_readonly=True) for profile in (cluster.agent_pool_profiles or [])]
+    fingerprint = json.dumps([cluster.provisioning_state, profiles], sort_keys=True, default=str)
+    return "fp-" + hashlib.sha1(fingerprint.encode("utf8")).hexdigest()
+
+def _get_cluster_snapshot_path(cluster_id):
+    cache_dir = get_cache_dir("snapshots")
+    if cache_dir is None:
+        return None
+    return os.path.join(cache_dir, "cluster-{}.json".format(hashlib.sha1(cluster_id.lower().encode("utf8")).hexdigest()))
+
+def _read_cluster_snapshot(cluster_id):
+    snapshot = _cluster_snapshots.get(cluster_id.lower(), None)
+    if snapshot is not None:
+        return snapshot
+    cache_path = _get_cluster_snapshot_path(cluster_id)
+    if cache_path is None or not os.path.exists(cache_path):
+        return None
+    try:
+        with open(cache_path, "r") as f:
+            return json.load(f)
+    except Exception:
+        logging.warn("Unable to read cluster snapshot at %s, ignoring it" % cache_path)
+        return None
+
+def _write_cluster_snapshot(cluster_id, snapshot):
+    _cluster_snapshots[cluster_id.lower()] = snapshot
+    cache_path = _get_cluster_snapshot_path(cluster_id)
+    if cache_path is not None:
+        write_cache_file(cache_path, json.dumps(snapshot))
+
+def invalidate_cluster_snapshot(cluster_id):
+    """
+    To call after any operation modifying the cluster or its node pools.
+    """
+    with _cluster_snapshots_lock:
+        _cluster_snapshots.pop(cluster_id.lower(), None)
+        cache_path = _get_cluster_snapshot_path(cluster_id)
+        if cache_path is not None and os.path.exists(cache_path):
+            try:
+                os.remove(cache_path)
+            except OSError as e:
+                logging.warn("Unable to remove cluster snapshot %s: %s" % (cache_path, str(e)))
+
+def get_cluster_snapshot(clusters_client, cluster_id, max_age=CLUSTER_SNAPSHOT_TTL):
+    """
+    Return a ClusterSnapshot of the AKS cluster with ARM id cluster_id.
+
+    A snapshot younger than max_age seconds is returned as is. An older one is revalidated with a
+    single get of the cluster, and the agent pools are only listed again when its ETag changed.
+    Pass max_age=0 before modifying the node pools.
+    """
+    _,_,_,_,resource_group,_,_,_,cluster_name = cluster_id.split("/")
+    with _cluster_snapshots_lock:
+        snapshot = _read_cluster_snapshot(cluster_id)
+        if snapshot is not None and time.time() - snapshot.get("timestamp", 0) <= max_age:
+            logging.info("Using snapshot of cluster %s from %.1fs ago" % (cluster_name, time.time() - snapshot["timestamp"]))
+            return ClusterSnapshot(clusters_client, snapshot)
+
+        cluster = clusters_client.managed_clusters.get(resource_group, cluster_name)
+        etag = _get_cluster_version(cluster)
+        if snapshot is not None and snapshot.get("etag", None) == etag:
+            logging.info("Cluster %s didn't change since its last snapshot" % cluster_name)
+            agent_pools = snapshot["agent_pools"]
+        else:
+            logging.info("Listing node pools of cluster %s" % cluster_name)
+            agent_pools = [agent_pool.serialize(keep_readonly=True) for agent_pool in clusters_client.agent_pools.list(resource_group, cluster_name)]
+        snapshot = {
+            "timestamp": time.time(),
+            "etag": etag,
+            "cluster": cluster.serialize(keep_readonly=True),
+            "agent_pools": agent_pools
+        }
+        _write_cluster_snapshot(cluster_id, snapshot)
+        return ClusterSnapshot(clusters_client, snapshot)
@@ -0,0 +1,116 @@
+import logging, traceback, time
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+DEFAULT_MAX_WORKERS = 5
+
+
+class ConcurrentTasksException(Exception):
+    """
+    Gather the failures of several tasks run together, instead of stopping at the first one.
+    """
+    def __init__(self, message, errors):
+        lines = [message]
+        for name, error in errors.items():
+            lines.append(" - %s: %s" % (name, str(error)))
+        super(ConcurrentTasksException, self).__init__("\n".join(lines))
+        self.errors = errors
+
+
+def run_concurrently(tasks, max_workers=DEFAULT_MAX_WORKERS):
+    """
+    Run independent callables on a bounded thread pool.
+
+    :param tasks: dict of task name to callable without arguments
+    :return: a (results, errors) pair of dicts keyed by task name
+    """
+    results, errors = {}, {}
+    if len(tasks) == 0:
+        return results, errors
+    with ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(tasks)))) as executor:
+        futures = {name: executor.submit(fn) for name, fn in tasks.items()}
+        for name, future in futures.items():
+            try:
+                results[name] = future.result()
+            except Exception as e:
+                logging.error("Task %s failed: %s" % (name, str(e)))
+                logging.debug(traceback.format_exc())
+                errors[name] = e
+    return results, errors
+
+
+def run_concurrently_or_fail(tasks, message, max_workers=DEFAULT_MAX_WORKERS):
+    """
+    Same as run_concurrently, but raise one exception listing all the failures.
+    """
+    results, errors = run_concurrently(tasks, max_workers=max_workers)
+    if len(errors) > 0:
+        raise ConcurrentTasksException(message, errors)
+    return results
+
+
+class TaskGraph(object):
+    """
+    Run callables according to their declared dependencies, independent branches in parallel.
+
+    Tasks take no argument, they can read the output of their dependencies in graph.results.
+    A task whose dependency failed is skipped.
+    """
+
+    def __init__(self, max_workers=DEFAULT_MAX_WORKERS):
+        self.max_workers = max_workers
+        self.tasks = {}
+        self.dependencies = {}
+        self.results = {}
+        self.errors = {}
+        self.timings = {}
+
+    def add_task(self, name, fn, depends_on=None):
+        depends_on = depends_on or []
+        for dependency in depends_on:
+            if dependency not in self.tasks:
+                raise Exception("Task %s depends on unknown task %s" % (name, dependency))
+        self.tasks[name] = fn
+        self.dependencies[name] = list(depends_on)
+        return self
+
+    def _timed(self, name):
+        start = time.time()
+        self.timings[name] = {"status": "running", "start": start}
+        try:
+            return self.tasks[name]()
+        finally:
+            self.timings[name]["duration"] = round(time.time() - start, 3)
+
+    def run(self, message="Some tasks failed:"):
+        pending = dict(self.dependencies)
+        running = {}
+        with ThreadPoolExecutor(max_workers=max(1, self.max_workers)) as executor:
+            while len(pending) > 0 or len(running) > 0:
+                for name in list(pending.keys()):
+                    dependencies = pending[name]
+                    if any(d in self.errors or self.timings.get(d, {}).get("status") == "skipped" for d in dependencies):
+                        logging.info("Skipping task %s, a dependency failed" % name)
+                        self.timings[name] = {"status": "skipped", "duration": 0}
+                        del pending[name]
+                    elif all(d in self.results for d in dependencies):
+                        running[executor.submit(self._timed, name)] = name
+                        del pending[name]
+                if len(running) == 0:
+                    continue
+                done, _ = wait(list(running.keys()), return_when=FIRST_COMPLETED)
+                for future in done:
+                    name = running.pop(future)
+                    try:
+                        self.results[name] = future.result()
+                        self.timings[name]["status"] = "done"
+                    except Exception as e:
+                        logging.error("Task %s failed: %s" % (name, str(e)))
+                        logging.debug(traceback.format_exc())
+                        self.errors[name] = e
+                        self.timings[name]["status"] = "failed"
+        for timing in self.timings.values():
+            timing.pop("start", None)
+        logging.info("Task timings: %s" % self.timings)
+        if len(self.errors) > 0:
+            raise ConcurrentTasksException(message, self.errors)
+        return self.results
@@ -1,9 +1,9 @@
 import json, logging
-from dku_utils.access import _is_none_or_blank
+from dku_utils.access import _is_none_or_blank, LazyJson
 
 class Taint(dict):
     def __init__(self, taint):
-        logging.debug("Creating taint from '%s'" % json.dumps(taint))
+        logging.debug("Creating taint from '%s'", LazyJson(taint))
         if isinstance(taint, str):
             logging.debug("Taint is a raw string, it requires parsing.")
             try:
@@ -0,0 +1,69 @@
+import os, json, time, logging, threading
+from contextlib import contextmanager
+
+from dku_utils.access import _is_none_or_blank
+
+# path of a file to append the timings of each cluster operation to, as json lines
+TIMINGS_FILE_ENV = "DKU_AKS_TIMINGS_FILE"
+
+
+class Timer(object):
+    """
+    Record how long the phases (spans) of an operation take, phases possibly running in several threads.
+    """
+    def __init__(self, operation, **context):
+        self.operation = operation
+        self.context = context
+        self.start = time.time()
+        self.spans = []
+        self.lock = threading.Lock()
+
+    @contextmanager
+    def span(self, name):
+        start = time.time()
+        status = "failed"
+        try:
+            yield
+            status = "done"
+        finally:
+            self._add_span(name, start, status)
+
+    def wrap(self, name, fn):
+        """
+        Make a callable that runs fn in a span, for the tasks handed to dku_utils.concurrency.
+        """
+        def timed():
+            with self.span(name):
+                return fn()
+        return timed
+
+    def _add_span(self, name, start, status):
+        duration = time.time() - start
+        with self.lock:
+            self.spans.append({"name": name, "offset": round(start - self.start, 3), "duration": round(duration, 3), "status": status})
+        logging.info("%s: %s %s in %.1fs" % (self.operation, name, status, duration))
+
+    def to_dict(self):
+        with self.lock:
+            spans = sorted(self.spans, key=lambda s: s["offset"])
+        return {"operation": self.operation, "timestamp": self.start, "total": round(time.time() - self.start, 3), "spans": spans}
+
+    def finish(self, status="done"):
+        """
+        Log the breakdown of the operation, and append it to the file in DKU_AKS_TIMINGS_FILE if set.
+
+        :return: the breakdown, as a json-friendly dict
+        """
+        timings = self.to_dict()
+        timings["status"] = status
+        timings.update(self.context)
+        logging.info("%s %s in %.1fs (%s)" % (self.operation, status, timings["total"],
+                                             ", ".join(["%s %.1fs" % (s["name"], s["duration"]) for s in timings["spans"]])))
+        timings_path = os.environ.get(TIMINGS_FILE_ENV, None)
+        if not _is_none_or_blank(timings_path):
+            try:
+                with open(timings_path, "a") as f:
+                    f.write(json.dumps(timings) + "\n")
+            except Exception as e:
+                logging.warn("Unable to write timings to %s: %s" % (timings_path, str(e)))
+        return timings
@@ -0,0 +1,184 @@
+from dataiku.runnables import Runnable
+import json, logging, time, html, threading
+from dku_utils.cluster import get_cluster_from_dss_cluster, get_cluster_snapshot, invalidate_cluster_snapshot
+from dku_utils.concurrency import run_concurrently
+from dku_azure.clusters import NetworkResolutionCache, NodePoolBuilder
+from dku_azure.node_pools import build_agent_pool, next_node_pool_name, apply_node_count, check_remaining_node_pools
+from dku_azure.operations import wait_for_agent_pool_operation
+from dku_azure.quotas import get_vcpus_quota_issues
+from dku_azure.skus import get_sku_catalog_or_none
+from dku_azure.clients import get_client
+from azure.mgmt.compute import ComputeManagementClient
+from dku_azure.utils import run_and_process_cloud_error, get_instance_metadata
+from dku_kube.nvidia_utils import add_gpu_driver_if_needed, describe_gpu_driver_summary
+
+DEFAULT_MAX_PARALLELISM = 4
+DEFAULT_WAIT_TIMEOUT_MINUTES = 60
+
+class MyRunnable(Runnable):
+    def __init__(self, project_key, config, plugin_config):
+        self.project_key = project_key
+        self.config = config
+        self.plugin_config = plugin_config
+
+    def get_progress_target(self):
+        # progress is the number of node pool operations finished
+        return (max(1, len(self.config.get("nodePoolsToCreate", None) or []) + len(self.config.get("nodePoolChanges", None) or [])), 'NONE')
+
+    def run(self, progress_callback):
+        cluster_data, clusters, dss_cluster_settings, dss_cluster_config, connection_info, credentials = get_cluster_from_dss_cluster(self.config['clusterId'])
+
+        # retrieve the actual name in the cluster's data
+        if cluster_data is None:
+            raise Exception("No cluster data (not started?)")
+        cluster_def = cluster_data.get("cluster", None)
+        if cluster_def is None:
+            raise Exception("No cluster definition (starting failed?)")
+        cluster_id = cluster_def["id"]
+        _,_,subscription_id,_,resource_group,_,_,_,cluster_name = cluster_id.split("/")
+
+        node_pools_to_create = self.config.get("nodePoolsToCreate", None) or []
+        node_pool_changes = self.config.get("nodePoolChanges", None) or []
+        if len(node_pools_to_create) == 0 and len(node_pool_changes) == 0:
+            raise Exception("No node pool to create or resize")
+
+        # validate everything against one listing of the pools, before submitting anything
+        snapshot = get_cluster_snapshot(clusters, cluster_id, max_age=0)
+        node_pools = snapshot.agent_pools
+        current_nodes = {node_pool.name: node_pool.count for node_pool in node_pools}
+        node_pools_by_id = {node_pool.name: node_pool for node_pool in node_pools}
+        actions = [] # (action, node pool id, agent pool model, requested size)
+        errors = []
+
+        for node_pool_change in node_pool_changes:
+            node_pool_id = node_pool_change.get("nodePoolId", None)
+            if node_pool_id not in node_pools_by_id:
+                errors.append("Unable to find node pool '%s'" % node_pool_id)
+                continue
+            if node_pool_id in [action[1] for action in actions]:
+                errors.append("Node pool '%s' is listed several times" % node_pool_id)
+                continue
+            node_pool = node_pools_by_id[node_pool_id]
+            autoscaling_enabled = node_pool_change.get("autoScaling", False)
+            try:
+                if apply_node_count(node_pool, autoscaling_enabled, num_nodes=node_pool_change.get("numNodes", None),
+                                    min_nodes=node_pool_change.get("minNumNodes", None), max_nodes=node_pool_change.get("maxNumNodes", None)):
+                    requested = "%s-%s" % (node_pool.min_count, node_pool.max_count) if autoscaling_enabled else node_pool.count
+                    actions.append(("resize", node_pool_id, node_pool, requested))
+                else:
+                    actions.append(("delete", node_pool_id, None, 0))
+            except Exception as e:
+                errors.append("%s: %s" % (node_pool_id, str(e)))
+
+        dss_host_resource_group = None
+        if len(node_pools_to_create) > 0:
+            dss_host_resource_group = get_instance_metadata()["compute"]["resourceGroupName"]
+        network_cache = NetworkResolutionCache()
+        compute_client = get_client(ComputeManagementClient, credentials, subscription_id)
+        sku_catalog = get_sku_catalog_or_none(compute_client, subscription_id, snapshot.cluster.location)
+        gpu_node_pools_taints = set()
+        has_gpu = False
+        taken_ids = set(node_pools_by_id.keys())
+        for node_pool_config in node_pools_to_create:
+            node_pool_id = next_node_pool_name(taken_ids)
+            taken_ids.add(node_pool_id)
+            try:
+                agent_pool, gpu_taints = build_agent_pool(node_pool_id, node_pool_config, node_pools, dss_cluster_config,
+                                                          connection_info, credentials, resource_group, dss_host_resource_group,
+                                                          node_pool_builder=NodePoolBuilder(None, network_cache=network_cache, sku_catalog=sku_catalog))
+                gpu_node_pools_taints.update(gpu_taints)
+                has_gpu = has_gpu or node_pool_config.get("enableGPU", False)
+                actions.append(("create", node_pool_id, agent_pool, agent_pool.count))
+            except Exception as e:
+                errors.append("%s: %s" % (node_pool_id, str(e)))
+
+        try:
+            check_remaining_node_pools(node_pools, [action[1] for action in actions if action[0] == "delete"],
+                                       [action[2].mode for action in actions if action[0] == "create"])
+        except Exception as e:
+            errors.append(str(e))
+
+        if len(errors) == 0:
+            # all the resizes and creations together, the deletions only free quota once done
+            errors += get_vcpus_quota_issues(compute_client, sku_catalog, [(action[2], current_nodes.get(action[1], 0)) for action in actions if action[0] != "delete"])
+
+        if len(errors) > 0:
+            raise Exception("Invalid node pool operations, nothing was submitted:\n - %s" % "\n - ".join(errors))
+
+        # submit all operations, at most maxParallelism at a time
+        max_parallelism = self.config.get("maxParallelism", None) or DEFAULT_MAX_PARALLELISM
+        deadline = time.time() + 60 * (self.config.get("waitTimeoutMinutes", None) or DEFAULT_WAIT_TIMEOUT_MINUTES)
+        kube_config_path = cluster_data.get("kube_config_path", None)
+        durations = {}
+        finished = []
+        finished_lock = threading.Lock()
+
+        def make_task(action, node_pool_id, agent_pool):
+            def do_operation():
+                start = time.time()
+                try:
+                    if action == "delete":
+                        logging.info("Deleting node pool %s" % node_pool_id)
+                        op = clusters.agent_pools.begin_delete(resource_group, cluster_name, node_pool_id)
+                    else:
+                        logging.info("Submitting %s of node pool %s" % (action, node_pool_id))
+                        op = clusters.agent_pools.begin_create_or_update(resource_group, cluster_name, node_pool_id, agent_pool)
+                    return wait_for_agent_pool_operation(op, clusters, resource_group, cluster_name, node_pool_id,
+                                                         kube_config_path=None if action == "delete" else kube_config_path,
+                                                         deadline=deadline)
+                finally:
+                    invalidate_cluster_snapshot(cluster_id)
+                    durations[node_pool_id] = round(time.time() - start, 1)
+                    with finished_lock:
+                        finished.append(node_pool_id)
+                        progress_callback(len(finished))
+            return lambda: run_and_process_cloud_error(do_operation)
+
+        tasks = {node_pool_id: make_task(action, node_pool_id, agent_pool) for action, node_pool_id, agent_pool, _ in actions}
+        results, failures = run_concurrently(tasks, max_workers=max_parallelism)
+        logging.info("Cluster updated")
+
+        created_gpu = has_gpu and any([action[0] == "create" and action[1] in results and results[action[1]].done for action in actions])
+        gpu_driver_status, gpu_driver_summary = None, None
+        if created_gpu:
+            if kube_config_path is None:
+                gpu_driver_status = "No kube config for the cluster, the GPU driver was not installed"
+            else:
+                try:
+                    gpu_driver_summary = add_gpu_driver_if_needed(kube_config_path, self.config['clusterId'], gpu_node_pools_taints)
+                    logging.info("GPU driver: %s" % json.dumps(gpu_driver_summary))
+                except Exception as e:
+                    logging.error("Failed to install the GPU driver: %s" % str(e))
+                    gpu_driver_status = "GPU driver not installed, run again once the node pools are created: %s" % str(e)
+
+        return self._format_results(actions, results, failures, durations, created_gpu, gpu_driver_status, gpu_driver_summary)
+
+    def _format_results(self, actions, results, failures, durations, created_gpu=False, gpu_driver_status=None, gpu_driver_summary=None):
+        def fmt(v):
+            return '' if v is None else html.escape(str(v))
+        table = '<table class="table table-condensed"><tr><th>Node pool</th><th>Action</th><th>Requested nodes</th><th>Status</th><th>Provisioning state</th><th>Duration (s)</th></tr>'
+        for action, node_pool_id, _, requested in actions:
+            provisioning_state = None
+            if node_pool_id in failures:
+                status = '<span class="text-error">%s</span>' % fmt(failures[node_pool_id])
+            elif results[node_pool_id].timed_out:
+                status = 'Still running in Azure'
+                provisioning_state = results[node_pool_id].status
+            else:
+                status = 'Done'
+                result = results[node_pool_id].result
+                provisioning_state = getattr(result, 'provisioning_state', None) if result is not None else None
+            table += '<tr><td>%s</td><td>%s</td><td>%s</td><td>%s</td><td>%s</td><td>%s</td></tr>' % (
+                fmt(node_pool_id), fmt(action), fmt(requested), status, fmt(provisioning_state), fmt(durations.get(node_pool_id)))
+        if created_gpu:
+            if gpu_driver_status is not None:
+                status = '<span class="text-error">%s</span>' % fmt(gpu_driver_status)
+            else:
+                status = fmt(describe_gpu_driver_summary(gpu_driver_summary))
+            table += '<tr><td></td><td>install GPU driver</td><td></td><td>%s</td><td></td><td></td></tr>' % status
+        table += '</table>'
+        if len(failures) > 0:
+            summary = '<div class="alert alert-error">%s of %s node pool operations failed</div>' % (len(failures), len(actions))
+        else:
+            summary = '<h5>%s node pool operations submitted</h5>' % len(actions)
+        return summary + table
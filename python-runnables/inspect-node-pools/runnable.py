@@ -1,6 +1,9 @@
 from dataiku.runnables import Runnable
-import json
-from dku_utils.cluster import get_cluster_from_dss_cluster
+import json, html, logging
+from dku_utils.cluster import get_cluster_from_dss_cluster, get_cluster_snapshot
+from dku_utils.concurrency import run_concurrently
+from dku_kube.nodes import get_nodes
+from dku_kube.capacity import get_active_pods, get_nodes_usage, get_pools_usage
 
 class MyRunnable(Runnable):
     def __init__(self, project_key, config, plugin_config):
@@ -20,7 +23,66 @@ class MyRunnable(Runnable):
         if cluster_def is None:
             raise Exception("No cluster definition (starting failed?)")
         cluster_id = cluster_def["id"]
-        _,_,subscription_id,_,resource_group,_,_,_,cluster_name = cluster_id.split("/")
-        node_pools = clusters.agent_pools.list(resource_group, cluster_name)
-        node_pools = [node_pool for node_pool in node_pools]
-        return '<pre class="debug">%s</pre>' % json.dumps([node_pool.as_dict() for node_pool in node_pools], indent=2)
+
+        if self.config.get("outputFormat", "capacity") == "json":
+            node_pools = get_cluster_snapshot(clusters, cluster_id).agent_pools
+            return '<pre class="debug">%s</pre>' % json.dumps([node_pool.as_dict() for node_pool in node_pools], indent=2)
+
+        # ARM and kubernetes sides are independent, fetch them all at once
+        kube_config_path = cluster_data.get("kube_config_path", None)
+        tasks = {"node pools": lambda: get_cluster_snapshot(clusters, cluster_id).agent_pools}
+        if kube_config_path is not None:
+            tasks["nodes"] = lambda: get_nodes(kube_config_path, timeout=30)
+            tasks["pods"] = lambda: get_active_pods(kube_config_path)
+        results, errors = run_concurrently(tasks)
+        if "node pools" in errors:
+            raise errors["node pools"]
+
+        warnings = ['Unable to get %s from the cluster: %s' % (name, str(error)) for name, error in errors.items()]
+        if kube_config_path is None:
+            warnings.append('No kube config for the cluster, only showing the node pools definitions')
+        pods = results.get("pods", [])
+        nodes_usage = get_nodes_usage(results.get("nodes", []), pods)
+        pools_usage = get_pools_usage(nodes_usage, pods)
+        return self._format_pools(results["node pools"], pools_usage, warnings)
+
+    def _format_pools(self, node_pools, pools_usage, warnings):
+        def fmt(v):
+            return '' if v is None else html.escape(str(v))
+        def fmt_usage(usage, k, unit_divider=1, unit=''):
+            allocatable = usage["allocatable"][k]
+            if allocatable == 0:
+                return '-' if usage["requested"][k] == 0 else '%.1f%s requested' % (usage["requested"][k] / float(unit_divider), unit)
+            ratio = 100.0 * usage["requested"][k] / allocatable
+            cell = '%.1f / %.1f%s (%d%%)' % (usage["requested"][k] / float(unit_divider), allocatable / float(unit_divider), unit, ratio)
+            return '<span class="text-error">%s</span>' % cell if ratio >= 90 else cell
+
+        table = '<table class="table table-condensed"><tr><th>Node pool</th><th>Mode</th><th>VM size</th><th>Size</th><th>State</th><th>Nodes ready</th><th>Pods</th><th>Pending pods</th><th>CPU requested / allocatable</th><th>Memory requested / allocatable</th><th>GPU requested / allocatable</th><th>Node problems</th></tr>'
+        for node_pool in sorted(node_pools, key=lambda p: p.name):
+            usage = pools_usage.pop(node_pool.name, None)
+            if node_pool.enable_auto_scaling:
+                size = '%s (autoscaling %s-%s)' % (node_pool.count, node_pool.min_count, node_pool.max_count)
+            else:
+                size = '%s' % node_pool.count
+            if usage is None:
+                cells = '<td>0</td><td></td><td></td><td></td><td></td><td></td><td></td>'
+            else:
+                problems = ', '.join(['%s on %s nodes' % (problem, cnt) for problem, cnt in sorted(usage["problems"].items())])
+                cells = '<td>%s/%s</td><td>%s</td><td>%s</td><td>%s</td><td>%s</td><td>%s</td><td>%s</td>' % (
+                    usage["ready"], usage["nodes"], usage["pods"],
+                    '<span class="text-error">%s</span>' % usage["pending_pods"] if usage["pending_pods"] > 0 else 0,
+                    fmt_usage(usage, "cpu", 1000), fmt_usage(usage, "memory", 2**30, 'Gi'), fmt_usage(usage, "gpu"),
+                    '<span class="text-error">%s</span>' % fmt(problems) if problems else '')
+            table += '<tr><td>%s</td><td>%s</td><td>%s</td><td>%s</td><td>%s</td>%s</tr>' % (
+                fmt(node_pool.name), fmt(node_pool.mode), fmt(node_pool.vm_size), fmt(size), fmt(node_pool.provisioning_state), cells)
+        table += '</table>'
+
+        # pending pods not pinned to a given pool, and nodes of pools that ARM didn't list
+        unassigned = pools_usage.pop(None, None)
+        if unassigned is not None and unassigned["pending_pods"] > 0:
+            warnings.append('%s pending pods are not pinned to a node pool' % unassigned["pending_pods"])
+        for pool_name in sorted(pools_usage.keys()):
+            warnings.append('Nodes of pool %s are not in the node pools of the cluster' % pool_name)
+        for warning in warnings:
+            logging.warn(warning)
+        return ''.join(['<div class="alert alert-warning">%s</div>' % fmt(warning) for warning in warnings]) + table
@@ -0,0 +1,119 @@
+from dataiku.runnables import Runnable
+import logging, time, html, datetime
+from dku_utils.cluster import get_cluster_from_dss_cluster, get_cluster_snapshot, invalidate_cluster_snapshot
+from dku_azure.utils import run_and_process_cloud_error
+from dku_azure.operations import wait_for_agent_pool_operation
+from dku_azure.node_pools import find_node_pool, apply_node_count
+from dku_azure.prewarm import TimeWindow, PrewarmPolicy, PrewarmState, derive_windows
+
+DEFAULT_WAIT_TIMEOUT_MINUTES = 60
+
+class MyRunnable(Runnable):
+    def __init__(self, project_key, config, plugin_config):
+        self.project_key = project_key
+        self.config = config
+        self.plugin_config = plugin_config
+
+    def get_progress_target(self):
+        return None
+
+    def run(self, progress_callback):
+        cluster_data, clusters, dss_cluster_settings, dss_cluster_config, _, _ = get_cluster_from_dss_cluster(self.config['clusterId'])
+
+        # retrieve the actual name in the cluster's data
+        if cluster_data is None:
+            raise Exception("No cluster data (not started?)")
+        cluster_def = cluster_data.get("cluster", None)
+        if cluster_def is None:
+            raise Exception("No cluster definition (starting failed?)")
+        cluster_id = cluster_def["id"]
+        _,_,subscription_id,_,resource_group,_,_,_,cluster_name = cluster_id.split("/")
+
+        node_pools = get_cluster_snapshot(clusters, cluster_id, max_age=0).agent_pools
+        node_pool = find_node_pool(node_pools, self.config.get('nodePoolId', None))
+        node_pool_id = node_pool.name
+        dry_run = self.config.get('dryRun', True)
+
+        # the size set by the user, saved when the pool was raised
+        state = PrewarmState(cluster_id, node_pool_id)
+        saved_state = state.get_state()
+        saved_baseline = saved_state["baseline"] if saved_state is not None else None
+        baseline = saved_baseline or {"autoscaling": bool(node_pool.enable_auto_scaling), "count": node_pool.count,
+                                      "min_count": node_pool.min_count, "max_count": node_pool.max_count}
+        baseline_nodes = baseline["min_count"] if baseline["autoscaling"] else baseline["count"]
+        # sample on every run, pre-warmed or not, otherwise the history of a pre-warmed slot would age out.
+        # Only the nodes the pre-warming forced in are left out, the autoscaler can still add more
+        state.record_sample(max(0, (node_pool.count or 0) - state.get_added_nodes()))
+
+        windows = [TimeWindow.from_config(w) for w in self.config.get('windows', None) or []]
+        if self.config.get('deriveFromHistory', False):
+            windows += derive_windows(state.get_history(), baseline_nodes, weeks=self.config.get('historyWeeks', None) or 4)
+        policy = PrewarmPolicy(windows, lead_minutes=self.config.get('leadMinutes', 15))
+
+        now = datetime.datetime.now()
+        window = policy.get_active_window(now)
+        current_nodes = node_pool.min_count if node_pool.enable_auto_scaling else node_pool.count
+        if window is not None and window.nodes > baseline_nodes:
+            desired = window.nodes
+            if desired == current_nodes:
+                action = None
+            else:
+                action = "Raise node pool %s from %s to %s nodes for window %s" % (node_pool_id, current_nodes, desired, window.describe())
+        elif saved_baseline is not None:
+            desired = baseline_nodes
+            action = "Lower node pool %s back from %s to %s nodes" % (node_pool_id, current_nodes, desired)
+        else:
+            desired = current_nodes
+            action = None
+
+        result = self._format_plan(node_pool_id, windows, policy, baseline_nodes, action, dry_run)
+        if action is None or dry_run:
+            return result
+
+        logging.info(action)
+        if desired == baseline_nodes:
+            if not apply_node_count(node_pool, baseline["autoscaling"], num_nodes=baseline["count"],
+                                    min_nodes=baseline["min_count"], max_nodes=baseline["max_count"]):
+                # a fixed pool of 0 nodes, scaled down rather than deleted like the resize macro would
+                node_pool.count = 0
+                node_pool.min_count = None
+                node_pool.max_count = None
+        else:
+            count_before = saved_state.get("count_before", baseline_nodes) if saved_state is not None else node_pool.count
+            state.save_baseline(baseline, desired, count_before)
+            apply_node_count(node_pool, baseline["autoscaling"], num_nodes=desired,
+                             min_nodes=desired, max_nodes=max(desired, baseline["max_count"] or 0))
+            # a min count doesn't make the autoscaler add the nodes right away
+            node_pool.count = max(node_pool.count or 0, desired)
+
+        deadline = time.time() + 60 * (self.config.get("waitTimeoutMinutes", None) or DEFAULT_WAIT_TIMEOUT_MINUTES)
+        def do_update():
+            cluster_update_op = clusters.agent_pools.begin_create_or_update(resource_group, cluster_name, node_pool_id, node_pool)
+            invalidate_cluster_snapshot(cluster_id)
+            return wait_for_agent_pool_operation(cluster_update_op, clusters, resource_group, cluster_name, node_pool_id, deadline=deadline)
+        update_operation = run_and_process_cloud_error(do_update)
+        # keep the baseline until the pool is actually back to it, the next run lowers it again otherwise
+        if desired == baseline_nodes and not update_operation.timed_out:
+            state.clear_baseline()
+        if update_operation.timed_out:
+            return '<div>Node pool %s is still being resized in Azure (status %s)</div>' % (html.escape(node_pool_id), update_operation.status) + result
+        logging.info("Cluster updated")
+        return result
+
+    def _format_plan(self, node_pool_id, windows, policy, baseline_nodes, action, dry_run):
+        def fmt(v):
+            return '' if v is None else html.escape(str(v))
+        if action is None:
+            result = '<h5>Node pool %s is already at the right size</h5>' % fmt(node_pool_id)
+        elif dry_run:
+            result = '<h5>Would %s%s</h5>' % (fmt(action[0].lower()), fmt(action[1:]))
+        else:
+            result = '<h5>%s</h5>' % fmt(action)
+        if len(windows) == 0:
+            return result + '<div class="alert alert-warning">No pre-warm window, declared or learnt from history</div>'
+        result += '<div>Base size %s nodes, windows:</div><ul>%s</ul>' % (baseline_nodes, ''.join(['<li>%s : %s nodes</li>' % (fmt(w.describe()), w.nodes) for w in windows]))
+        table = '<table class="table table-condensed"><tr><th>Time</th><th>Nodes</th><th>Window</th></tr>'
+        for dt, nodes, window in policy.plan(baseline_nodes):
+            table += '<tr><td>%s</td><td>%s</td><td>%s</td></tr>' % (dt.strftime('%a %Y-%m-%d %H:%M'), nodes, fmt(window.describe()) if window is not None else 'back to base size')
+        table += '</table>'
+        return result + '<h5>Planned changes over the next 7 days</h5>' + table
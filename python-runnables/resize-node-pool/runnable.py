@@ -1,8 +1,20 @@
 from dataiku.runnables import Runnable
-import json, logging
-from dku_utils.cluster import get_cluster_from_dss_cluster
-from dku_utils.access import _is_none_or_blank
+import json, logging, time, html
+from dku_utils.concurrency import run_concurrently_or_fail
+from dku_utils.access import LazyJson
+from dku_utils.cluster import get_cluster_from_dss_cluster, get_cluster_snapshot, invalidate_cluster_snapshot
 from dku_azure.utils import run_and_process_cloud_error
+from dku_azure.operations import wait_for_agent_pool_operation
+from dku_azure.quotas import check_vcpus_quotas
+from dku_azure.skus import get_sku_catalog_or_none
+from dku_azure.clients import get_client
+from azure.mgmt.compute import ComputeManagementClient
+from dku_azure.node_pools import find_node_pool, apply_node_count, check_remaining_node_pools
+from dku_kube.nodes import get_nodes
+from dku_kube.capacity import get_active_pods, recommend_pool_size
+
+DEFAULT_WAIT_TIMEOUT_MINUTES = 60
+DEFAULT_TARGET_UTILIZATION = 80 # percent
 
 class MyRunnable(Runnable):
     def __init__(self, project_key, config, plugin_config):
@@ -11,10 +23,15 @@ class MyRunnable(Runnable):
         self.plugin_config = plugin_config
         
     def get_progress_target(self):
-        return None
+        # progress is the number of nodes ready in the pool, or 0/1 for a deletion
+        if self.config.get('autoScaling', False):
+            target = self.config.get('minNumNodes', None)
+        else:
+            target = self.config.get('numNodes', None)
+        return (max(1, target or 1), 'NONE')
 
     def run(self, progress_callback):
-        cluster_data, clusters, dss_cluster_settings, dss_cluster_config, _, _ = get_cluster_from_dss_cluster(self.config['clusterId'])
+        cluster_data, clusters, dss_cluster_settings, dss_cluster_config, _, credentials = get_cluster_from_dss_cluster(self.config['clusterId'])
 
         # retrieve the actual name in the cluster's data
         if cluster_data is None:
@@ -24,59 +41,111 @@ class MyRunnable(Runnable):
             raise Exception("No cluster definition (starting failed?)")
         cluster_id = cluster_def["id"]
         _,_,subscription_id,_,resource_group,_,_,_,cluster_name = cluster_id.split("/")
-        cluster = clusters.managed_clusters.get(resource_group, cluster_name)
-        
-        # get the object for the cluster, AKS side
-        cluster = clusters.managed_clusters.get(resource_group, cluster_name)
         
         node_pool_id = self.config.get('nodePoolId', None)
-        node_pool = None
-        node_pools = [node_pool for node_pool in clusters.agent_pools.list(resource_group, cluster_name)]
-        if _is_none_or_blank(node_pool_id) and len(node_pools) > 1:
-            raise Exception("Cluster has %s node pools, you need to specify the node pool id" % len(node_pools))
-        for profile in node_pools:
-            if profile.name == node_pool_id or (_is_none_or_blank(node_pool_id) and len(node_pools) == 1):
-                node_pool = profile
-        if node_pool is None:
-            raise Exception("Unable to find node pool '%s'" % (node_pool_id))
+        snapshot = get_cluster_snapshot(clusters, cluster_id, max_age=0)
+        node_pools = snapshot.agent_pools
+        node_pool = find_node_pool(node_pools, node_pool_id)
         node_pool_id = node_pool.name
+        current_nodes = node_pool.count
+        compute_client = get_client(ComputeManagementClient, credentials, subscription_id)
+        sku_catalog = get_sku_catalog_or_none(compute_client, subscription_id, snapshot.cluster.location)
         logging.info("Node pool selected is %s " % node_pool_id)
 
         autoscaling_enabled = self.config['autoScaling']
-        node_pool.enable_auto_scaling = autoscaling_enabled
-        if autoscaling_enabled:
-            min_nodes = self.config['minNumNodes']
-            max_nodes = self.config['maxNumNodes']
-            if min_nodes > max_nodes:
-                raise Exception("Cannot resize autoscalable cluster with a max number of nodes (%s) less than its min number of nodes (%s)."
-                                % (max_nodes, min_nodes))
+        num_nodes = self.config.get('numNodes', None)
+        min_nodes = self.config.get('minNumNodes', None)
+        max_nodes = self.config.get('maxNumNodes', None)
+        result_prefix = ''
+        if self.config.get('mode', 'apply') == 'recommend':
+            recommendation = self._recommend(cluster_data, node_pool, sku_catalog)
+            result_prefix = self._format_recommendation(recommendation, node_pool, autoscaling_enabled)
+            if not self.config.get('applyRecommendation', False):
+                return result_prefix
+            if autoscaling_enabled:
+                min_nodes = recommendation["nodes_for_running"]
+                max_nodes = recommendation["nodes_for_all"]
             else:
-                logging.info("Resizing cluster to autoscale with %s min nodes and %s max nodes."
-                             % (min_nodes, max_nodes))
-                node_pool.min_count = min_nodes
-                node_pool.max_count = max_nodes
+                num_nodes = recommendation["nodes_for_all"]
+            target = max(1, min_nodes if autoscaling_enabled else num_nodes)
         else:
-            desired_count = self.config['numNodes']
-            logging.info("Resize to %s" % desired_count)
-            if desired_count == 0:
-                if len(node_pools) == 1:
-                    raise Exception("Can't delete node pool, a cluster needs at least one running node pool")
-                def do_delete():
-                    cluster_update_op = clusters.agent_pools.begin_delete(resource_group, cluster_name, node_pool_id)
-                    return cluster_update_op.result()
-                delete_result = run_and_process_cloud_error(do_delete)
-                logging.info("Cluster updated")
-                return '<pre class="debug">Node pool %s deleted</pre>' % node_pool_id
-            else:
-                node_pool.count = desired_count
-                node_pool.min_count = None
-                node_pool.max_count = None
-                logging.info("Waiting for cluster resize")
+            target, _ = self.get_progress_target()
+
+        deadline = time.time() + 60 * (self.config.get("waitTimeoutMinutes", None) or DEFAULT_WAIT_TIMEOUT_MINUTES)
+        kube_config_path = cluster_data.get("kube_config_path", None)
+        def wait_for(op, count_nodes=True):
+            return wait_for_agent_pool_operation(op, clusters, resource_group, cluster_name, node_pool_id,
+                                                 kube_config_path=kube_config_path if count_nodes else None,
+                                                 progress_callback=lambda ready: progress_callback(min(ready, target)),
+                                                 deadline=deadline)
+
+        if not apply_node_count(node_pool, autoscaling_enabled, num_nodes=num_nodes, min_nodes=min_nodes, max_nodes=max_nodes):
+            check_remaining_node_pools(node_pools, [node_pool_id])
+            def do_delete():
+                cluster_update_op = clusters.agent_pools.begin_delete(resource_group, cluster_name, node_pool_id)
+                invalidate_cluster_snapshot(cluster_id)
+                return wait_for(cluster_update_op, count_nodes=False)
+            delete_operation = run_and_process_cloud_error(do_delete)
+            if delete_operation.timed_out:
+                return '<div>Node pool %s is still being deleted in Azure (status %s), check the cluster again later</div>' % (node_pool_id, delete_operation.status)
+            progress_callback(target)
+            logging.info("Cluster updated")
+            return '<pre class="debug">Node pool %s deleted</pre>' % node_pool_id
+        check_vcpus_quotas(compute_client, sku_catalog, [(node_pool, current_nodes)])
+        logging.info("Waiting for cluster resize")
 
         def do_update():
             cluster_update_op = clusters.agent_pools.begin_create_or_update(resource_group, cluster_name, node_pool_id, node_pool)
-            return cluster_update_op.result()
-        update_result = run_and_process_cloud_error(do_update)
+            invalidate_cluster_snapshot(cluster_id)
+            return wait_for(cluster_update_op)
+        update_operation = run_and_process_cloud_error(do_update)
+        if update_operation.timed_out:
+            return '<div>Node pool %s is still being resized in Azure (status %s, %s/%s nodes ready), check the cluster again later</div>' % (node_pool_id, update_operation.status, update_operation.progress or 0, target)
+        progress_callback(target)
         logging.info("Cluster updated")
-        return '<pre class="debug">%s</pre>' % json.dumps(update_result.as_dict(), indent=2)
-        
+        return result_prefix + '<pre class="debug">%s</pre>' % json.dumps(update_operation.result.as_dict(), indent=2)
+
+    def _recommend(self, cluster_data, node_pool, sku_catalog):
+        kube_config_path = cluster_data.get("kube_config_path", None)
+        if kube_config_path is None:
+            raise Exception("No kube config for the cluster, can't sample its workload")
+        results = run_concurrently_or_fail({"nodes": lambda: get_nodes(kube_config_path, timeout=30),
+                                            "pods": lambda: get_active_pods(kube_config_path)},
+                                           "Unable to sample the workload of the cluster:")
+        target_utilization = (self.config.get('targetUtilization', None) or DEFAULT_TARGET_UTILIZATION) / 100.0
+        recommendation = recommend_pool_size(node_pool.name, results["nodes"], results["pods"], target_utilization=target_utilization,
+                                             include_unpinned_pending=self.config.get('includeUnpinnedPendingPods', False),
+                                             vm_size_resources=self._get_vm_size_resources(node_pool, sku_catalog))
+        logging.info("Recommendation for node pool %s : %s", node_pool.name, LazyJson(recommendation))
+        return recommendation
+
+    def _get_vm_size_resources(self, node_pool, sku_catalog):
+        resources = sku_catalog.get_resources(node_pool.vm_size) if sku_catalog is not None else None
+        if resources is not None:
+            resources["pods"] = node_pool.max_pods or 0
+        return resources
+
+    def _format_recommendation(self, recommendation, node_pool, autoscaling_enabled):
+        def fmt_resources(r):
+            return '%.2f CPU, %.1f GiB memory, %s GPU, %s pods' % (r["cpu"] / 1000.0, r["memory"] / float(2**30), r["gpu"], r["pods"])
+        if autoscaling_enabled:
+            proposal = 'autoscaling between %s and %s nodes' % (recommendation["nodes_for_running"], recommendation["nodes_for_all"])
+        else:
+            proposal = '%s nodes' % recommendation["nodes_for_all"]
+        if node_pool.enable_auto_scaling:
+            current = 'autoscaling between %s and %s nodes, %s nodes now' % (node_pool.min_count, node_pool.max_count, recommendation["current_nodes"])
+        else:
+            current = '%s nodes' % recommendation["current_nodes"]
+        reasons = [
+            'Each %s node can allocate %s' % (node_pool.vm_size, fmt_resources(recommendation["node_allocatable"])),
+            'DaemonSets take %s on each node' % fmt_resources(recommendation["daemonset_overhead"]),
+            'Packing pods up to %d%% of the rest leaves room for %s per node' % (100 * recommendation["target_utilization"], fmt_resources(recommendation["node_capacity"])),
+            '%s running pods and %s pending pods request %s in total' % (recommendation["running_pods"], recommendation["pending_pods"], fmt_resources(recommendation["demand"])),
+            'Running pods fit on %s nodes, running and pending pods on %s nodes' % (recommendation["nodes_for_running"], recommendation["nodes_for_all"])
+        ]
+        if recommendation["unpinned_pending_pods"] > 0:
+            reasons.append('%s pending pods are not pinned to a node pool%s' % (recommendation["unpinned_pending_pods"], '' if self.config.get('includeUnpinnedPendingPods', False) else ', they are not counted'))
+        if recommendation["unplaceable_pods"] > 0:
+            reasons.append('<span class="text-error">%s pods request more than a node can hold, a bigger VM size is needed for them</span>' % recommendation["unplaceable_pods"])
+        return '<h5>Recommended size for node pool %s: %s (currently %s)</h5><ul>%s</ul>' % (
+            html.escape(node_pool.name), proposal, current, ''.join(['<li>%s</li>' % reason for reason in reasons]))
@@ -1,6 +1,7 @@
 from dataiku.runnables import Runnable
-import os, json, socket, re, traceback, ipaddress
+import os, json, socket, traceback, ipaddress, html
 from dku_kube.busybox_pod import BusyboxPod
+from dku_kube.network_probe import parse_nslookup_ip, probe_nodes
 from dku_kube.kubectl_command import KubeCommandException
 from dku_utils.cluster import get_cluster_from_dss_cluster
 from six import text_type
@@ -41,7 +42,10 @@ class MyRunnable(Runnable):
             # sanity check
             if host.startswith("127.0.0") or 'localhost' in host:
                 raise Exception('Host appears to not be a public hostname. Set DKU_BACKEND_EXT_HOST')
-            with BusyboxPod(kube_config_path) as b:
+            probe_scope = self.config.get('probeScope', 'single')
+            if probe_scope != 'single':
+                return '<div>%s%s</div>' % (result, self._probe_nodes(kube_config_path, host, port, probe_scope))
+            with BusyboxPod(kube_config_path, warm=self.config.get('useWarmProbePod', False)) as b:
                 try:
                     ip = text_type(ipaddress.ip_address((host)))
                     result = result + '<h5>Host %s is an ip. No need to resolve it, testing connection directly</h5>' % (host)
@@ -52,10 +56,7 @@ class MyRunnable(Runnable):
                     cmd = ['nslookup', host]
                     out, err = b.exec_cmd(cmd)
                     result =  result + '<h5>Resolve host</h5><div style="margin-left: 20px;"><div>Command</div><pre class="debug">%s</pre><div>Output</div><pre class="debug">%s</pre><div>Error</div><pre class="debug">%s</pre></div>' % (json.dumps(cmd), out, err)
-                    for line in out.split('\n'):
-                        m = re.match('^Address.*\\s([0-9]+\\.[0-9]+\\.[0-9]+\\.[0-9]+[^\\s]*)\\s.*$', line)
-                        if m is not None:
-                            ip = m.group(1)
+                    ip = parse_nslookup_ip(out)
                     if ip is None:
                         raise Exception('Hostname resolution of DSS node failed: %s' % out)
                     
@@ -78,3 +79,21 @@ class MyRunnable(Runnable):
             result = result + '<div class="alert alert-error">%s</div>' % str(e)
                 
         return '<div>%s</div>' % result
+
+    def _probe_nodes(self, kube_config_path, host, port, probe_scope):
+        rows = probe_nodes(kube_config_path, host, port, scope=probe_scope)
+        failed = [row for row in rows if not row["ok"]]
+        def fmt(v):
+            return '' if v is None else html.escape(str(v))
+        table = '<table class="table table-condensed"><tr><th>Node</th><th>Pool</th><th>Zone</th><th>Resolved IP</th><th>Resolve (s)</th><th>Connect (s)</th><th>Status</th></tr>'
+        for row in sorted(rows, key=lambda r: (fmt(r["pool"]), fmt(r["zone"]), r["name"])):
+            status = 'OK' if row["ok"] else '<span class="text-error">%s</span>' % fmt(row.get("error"))
+            table += '<tr><td>%s</td><td>%s</td><td>%s</td><td>%s</td><td>%s</td><td>%s</td><td>%s</td></tr>' % (
+                fmt(row["name"]), fmt(row["pool"]), fmt(row["zone"]), fmt(row.get("resolved_ip")),
+                fmt(row.get("resolve_latency")), fmt(row.get("connect_latency")), status)
+        table += '</table>'
+        if len(failed) > 0:
+            summary = '<div class="alert alert-error">Connection failed from %s of %s nodes</div>' % (len(failed), len(rows))
+        else:
+            summary = '<h5>Connection successful from %s nodes</h5>' % len(rows)
+        return summary + table
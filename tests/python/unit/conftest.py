@@ -0,0 +1,4 @@
+import os, sys
+
+# the plugin's python-lib is on the path of the clusters and macros in DSS
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "..", "..", "python-lib"))
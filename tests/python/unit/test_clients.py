@@ -0,0 +1,47 @@
+import pytest
+
+pytest.importorskip("azure.core")
+pytest.importorskip("azure.identity")
+
+from dku_azure.auth import get_credentials_from_connection_info, get_credentials_from_connection_infoV2
+from dku_azure.clients import AzureClientFactory
+
+
+class FakeClient(object):
+    def __init__(self, credentials, subscription_id, transport=None, user_agent_policy=None, **kwargs):
+        self.credentials = credentials
+        self.subscription_id = subscription_id
+        self.kwargs = kwargs
+
+
+def test_same_identity_gives_same_client():
+    factory = AzureClientFactory(usage_attribution=False)
+    connection_info = {"clientId": "client", "tenantId": "tenant", "password": "secret"}
+    client = factory.get_client(FakeClient, get_credentials_from_connection_info(connection_info, None), "sub")
+    again = factory.get_client(FakeClient, get_credentials_from_connection_info(dict(connection_info), None), "sub")
+    assert again is client
+    assert factory.get_stats()["clients_created"] == 1
+    assert factory.get_stats()["clients_reused"] == 1
+
+
+def test_different_settings_give_different_clients():
+    factory = AzureClientFactory(usage_attribution=False)
+    credentials, _ = get_credentials_from_connection_infoV2({"identityType": "service-principal", "clientId": "client",
+                                                             "tenantId": "tenant", "password": "secret"})
+    other_credentials, _ = get_credentials_from_connection_infoV2({"identityType": "service-principal", "clientId": "client",
+                                                                   "tenantId": "tenant", "password": "rotated"})
+    client = factory.get_client(FakeClient, credentials, "sub")
+    assert factory.get_client(FakeClient, other_credentials, "sub") is not client
+    assert factory.get_client(FakeClient, credentials, "other-sub") is not client
+    assert factory.get_client(FakeClient, credentials, "sub", api_version="2021-04-01") is not client
+    assert factory.get_client(FakeClient, credentials, "sub") is client
+
+
+def test_clients_are_bounded():
+    factory = AzureClientFactory(usage_attribution=False, max_clients=2)
+    credentials = get_credentials_from_connection_info({"clientId": "client", "tenantId": "tenant", "password": "secret"}, None)
+    first = factory.get_client(FakeClient, credentials, "sub-1")
+    factory.get_client(FakeClient, credentials, "sub-2")
+    factory.get_client(FakeClient, credentials, "sub-3")
+    assert len(factory.clients) == 2
+    assert factory.get_client(FakeClient, credentials, "sub-1") is not first
@@ -0,0 +1,95 @@
+import pytest
+
+pytest.importorskip("azure.mgmt.containerservice")
+
+from dku_azure.clusters import ClusterBuilder, NodePoolBuilder, validate_cluster_config, format_cluster_plan
+from dku_azure.skus import SkuCatalog
+
+ENTRIES = [
+    {"name": "Standard_D8s_v5", "family": "standardDSv5Family", "vcpus": 8, "memory_gb": 32.0, "gpus": 0, "zones": ["1", "2"], "restrictions": []},
+    {"name": "Standard_NC6", "family": "standardNCFamily", "vcpus": 6, "memory_gb": 56.0, "gpus": 1, "zones": [], "restrictions": ["NotAvailableForSubscription"]}
+]
+
+
+class StubManagedClusters(object):
+    def __init__(self):
+        self.calls = []
+
+    def begin_create_or_update(self, resource_group, name, cluster_config):
+        self.calls.append((resource_group, name, cluster_config))
+        return None
+
+
+class StubClustersClient(object):
+    def __init__(self):
+        self.managed_clusters = StubManagedClusters()
+
+
+def make_cluster_builder(vm_sizes):
+    cluster_builder = ClusterBuilder(StubClustersClient())
+    cluster_builder.with_name("dss-cluster")
+    cluster_builder.with_dns_prefix("dss-cluster-dns")
+    cluster_builder.with_resource_group("rg")
+    cluster_builder.with_location("westeurope")
+    cluster_builder.with_sku_catalog(SkuCatalog("sub", "westeurope", ENTRIES))
+    cluster_builder.with_managed_identity()
+    cluster_builder.with_auto_upgrade_profile()
+    for idx, vm_size in enumerate(vm_sizes):
+        node_pool_builder = cluster_builder.get_node_pool_builder()
+        node_pool_builder.with_idx(idx)
+        node_pool_builder.with_vm_size(vm_size)
+        node_pool_builder.with_availability_zones(use_availability_zones=True)
+        node_pool_builder.with_node_count(enable_autoscaling=False, num_nodes=2, min_num_nodes=None, max_num_nodes=None)
+        node_pool_builder.with_mode(mode="Automatic", system_pods_only=False)
+        node_pool_builder.with_disk_size_gb(disk_size_gb=0)
+        node_pool_builder.build()
+        cluster_builder.with_node_pool(node_pool=node_pool_builder.agent_pool_profile)
+    return cluster_builder
+
+
+def test_plan_without_issue():
+    cluster_builder = make_cluster_builder(["Standard_D8s_v5"])
+    summary, issues = cluster_builder.plan()
+    assert issues == []
+    assert summary["node_pools"][0]["availability_zones"] == ["1", "2"]
+    assert "No issue found" in format_cluster_plan(summary, issues)
+    assert cluster_builder.clusters_client.managed_clusters.calls == []
+
+
+def test_plan_collects_vm_size_issues():
+    cluster_builder = make_cluster_builder(["Standard_D8s_v5", "Standard_NC6", "Standard_Unknown"])
+    summary, issues = cluster_builder.plan()
+    assert len(summary["node_pools"]) == 3
+    assert len(issues) == 2
+    assert issues[0].startswith("Node pool nodepool1: ") and "NotAvailableForSubscription" in issues[0]
+    assert issues[1].startswith("Node pool nodepool2: ") and "not offered" in issues[1]
+    assert cluster_builder.clusters_client.managed_clusters.calls == []
+
+
+def test_build_fails_on_vm_size_issues_before_calling_azure():
+    cluster_builder = make_cluster_builder(["Standard_Unknown"])
+    with pytest.raises(Exception) as e:
+        cluster_builder.build()
+    assert "Standard_Unknown" in str(e.value)
+    assert cluster_builder.clusters_client.managed_clusters.calls == []
+
+
+def test_node_pool_builder_alone_still_fails_on_vm_size():
+    node_pool_builder = NodePoolBuilder(None, sku_catalog=SkuCatalog("sub", "westeurope", ENTRIES))
+    node_pool_builder.with_idx(1).with_vm_size("Standard_NC6").with_availability_zones(use_availability_zones=False)
+    node_pool_builder.with_node_count(enable_autoscaling=False, num_nodes=1, min_num_nodes=None, max_num_nodes=None)
+    node_pool_builder.with_mode(mode="User", system_pods_only=False)
+    node_pool_builder.with_disk_size_gb(disk_size_gb=0)
+    with pytest.raises(Exception):
+        node_pool_builder.build()
+
+
+def test_validate_custom_config_dicts():
+    issues = validate_cluster_config({
+        "location": "westeurope",
+        "dnsPrefix": "dns",
+        "identity": {"type": "SystemAssigned"},
+        "agentPoolProfiles": [{"name": "Pool-1", "vmSize": "Standard_D8s_v5", "count": 0, "mode": "System"}]
+    })
+    assert any("the name must be lowercase" in issue for issue in issues)
+    assert any("System node pool needs at least one node" in issue for issue in issues)
@@ -0,0 +1,111 @@
+import json, threading
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from urllib.parse import urlparse, parse_qs
+
+import pytest
+import yaml
+
+from dku_kube.api_client import KubeApiClient, KubeApiException, KubeClientUnsupported
+
+POD = {"apiVersion": "v1", "kind": "Pod", "metadata": {"name": "busybox", "namespace": "default"}}
+
+
+class StubApiServer(BaseHTTPRequestHandler):
+    """
+    Answers like an API server knowing only the busybox pod, and records the requests it got.
+    """
+    requests = []
+
+    def log_message(self, *args):
+        pass
+
+    def _handle(self):
+        url = urlparse(self.path)
+        length = int(self.headers.get("Content-Length", 0) or 0)
+        body = self.rfile.read(length).decode("utf8") if length > 0 else None
+        self.requests.append({"method": self.command, "path": url.path, "query": parse_qs(url.query),
+                              "content_type": self.headers.get("Content-Type"), "authorization": self.headers.get("Authorization"),
+                              "body": body})
+        if url.path == "/api/v1/namespaces/default/pods":
+            self._reply(200, {"kind": "PodList", "items": [POD]})
+        elif url.path == "/api/v1/namespaces/default/pods/busybox":
+            self._reply(200, POD)
+        else:
+            self._reply(404, {"kind": "Status", "reason": "NotFound"})
+
+    def _reply(self, status, obj):
+        data = json.dumps(obj).encode("utf8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    do_GET = do_PATCH = do_DELETE = do_POST = _handle
+
+
+@pytest.fixture
+def client(tmp_path, monkeypatch):
+    for var in ["HTTP_PROXY", "HTTPS_PROXY", "http_proxy", "https_proxy", "ALL_PROXY", "all_proxy"]:
+        monkeypatch.delenv(var, raising=False)
+    StubApiServer.requests = []
+    server = HTTPServer(("127.0.0.1", 0), StubApiServer)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    kube_config_path = str(tmp_path / "kube_config")
+    with open(kube_config_path, "w") as f:
+        yaml.safe_dump({
+            "current-context": "stub",
+            "contexts": [{"name": "stub", "context": {"cluster": "stub", "user": "stub"}}],
+            "clusters": [{"name": "stub", "cluster": {"server": "http://127.0.0.1:%s" % server.server_port}}],
+            "users": [{"name": "stub", "user": {"token": "secret-token"}}]
+        }, f)
+    kube_client = KubeApiClient(kube_config_path)
+    yield kube_client
+    kube_client.close()
+    server.shutdown()
+    server.server_close()
+
+
+def test_get_and_list(client):
+    assert client.get("v1", "Pod", namespace="default", label_selector="app=busybox")["items"] == [POD]
+    assert client.get("v1", "Pod", "busybox", namespace="default") == POD
+    listing = StubApiServer.requests[0]
+    assert listing["path"] == "/api/v1/namespaces/default/pods"
+    assert listing["query"] == {"labelSelector": ["app=busybox"]}
+    assert listing["authorization"] == "Bearer secret-token"
+
+
+def test_server_side_apply(client):
+    assert client.apply(POD) == POD
+    request = StubApiServer.requests[0]
+    assert request["method"] == "PATCH"
+    assert request["path"] == "/api/v1/namespaces/default/pods/busybox"
+    assert request["content_type"] == "application/apply-patch+yaml"
+    assert request["query"] == {"fieldManager": ["dss-plugin-aks-clusters"], "force": ["true"]}
+    assert json.loads(request["body"]) == POD
+
+
+def test_not_found(client):
+    assert client.get("v1", "Pod", "missing", namespace="default", ignore_not_found=True) is None
+    with pytest.raises(KubeApiException) as e:
+        client.get("v1", "Pod", "missing", namespace="default")
+    assert e.value.status_code == 404
+    assert client.delete("v1", "Pod", "missing", namespace="default") is None
+    with pytest.raises(KubeApiException):
+        client.delete("v1", "Pod", "missing", namespace="default", ignore_not_found=False)
+    assert client.get("rbac.authorization.k8s.io/v1", "ClusterRoleBinding", "missing", ignore_not_found=True) is None
+    assert StubApiServer.requests[-1]["path"] == "/apis/rbac.authorization.k8s.io/v1/clusterrolebindings/missing"
+
+
+def test_exec_users_fall_back_to_kubectl(tmp_path):
+    kube_config_path = str(tmp_path / "kube_config")
+    with open(kube_config_path, "w") as f:
+        yaml.safe_dump({
+            "current-context": "aad",
+            "contexts": [{"name": "aad", "context": {"cluster": "aad", "user": "aad"}}],
+            "clusters": [{"name": "aad", "cluster": {"server": "https://example.invalid"}}],
+            "users": [{"name": "aad", "user": {"exec": {"command": "kubelogin"}}}]
+        }, f)
+    with pytest.raises(KubeClientUnsupported):
+        KubeApiClient(kube_config_path)
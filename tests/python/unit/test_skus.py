@@ -0,0 +1,25 @@
+import pytest
+
+from dku_azure.skus import SkuCatalog
+
+ENTRIES = [
+    {"name": "Standard_D8s_v5", "family": "standardDSv5Family", "vcpus": 8, "memory_gb": 32.0, "gpus": 0, "zones": ["1", "2", "3"], "restrictions": []},
+    {"name": "Standard_NC6", "family": "standardNCFamily", "vcpus": 6, "memory_gb": 56.0, "gpus": 1, "zones": [], "restrictions": ["NotAvailableForSubscription"]}
+]
+
+
+def test_vm_size_lookup_is_case_insensitive():
+    catalog = SkuCatalog("sub", "westeurope", ENTRIES)
+    assert catalog.get("standard_d8s_v5")["vcpus"] == 8
+    assert catalog.get_zones("STANDARD_D8S_V5") == ["1", "2", "3"]
+    assert catalog.get_resources("Standard_D8s_v5") == {"cpu": 8000, "memory": 32 * 2**30, "gpu": 0}
+
+
+def test_vm_size_issues():
+    catalog = SkuCatalog("sub", "westeurope", ENTRIES)
+    assert catalog.get_vm_size_issue("Standard_D8s_v5") is None
+    assert "not offered in westeurope" in catalog.get_vm_size_issue("Standard_Unknown")
+    assert "NotAvailableForSubscription" in catalog.get_vm_size_issue("Standard_NC6")
+    assert catalog.check_vm_size("Standard_D8s_v5")["name"] == "Standard_D8s_v5"
+    with pytest.raises(Exception):
+        catalog.check_vm_size("Standard_NC6")